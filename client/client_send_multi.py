@@ -1,10 +1,19 @@
 import os
+import gzip
+import json
 import time
+import heapq
 import argparse
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import requests
+import numpy as np
 import pandas as pd
+from requests.adapters import HTTPAdapter
 
 SERVER_URL = "http://127.0.0.1:5000/api/data"  # URL server
+BATCH_URL = SERVER_URL + "/batch"
 
 SENSOR_FILES = {
     "wrist_acc": ["ax", "ay", "az"],
@@ -15,51 +24,311 @@ SENSOR_FILES = {
     "wrist_skin_temperature": ["temp"]
 }
 
-def send_user_data(username, folder, speed):
-    print(f"\n📦 Invio dati per utente: {username}")
-    
-    for sensor, columns in SENSOR_FILES.items():
+CHUNK_ROWS = 50000  # righe lette per volta da ogni CSV
+BUSY_RETRIES = 5  # tentativi quando la coda di ingestione del server è piena (429/503)
+SERVER_MAX_BATCH_SIZE = 5000  # MAX_BATCH_SIZE del server: oltre, /api/data/batch risponde 413
+
+
+def make_session(pool_size=10):
+    """Sessione HTTP con connessioni keep-alive riutilizzate."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=3)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def read_sensor_chunks(file_path, sensor, chunk_rows=CHUNK_ROWS):
+    """Legge un CSV a blocchi e restituisce (timestamps_ms, values) come array NumPy.
+
+    Per i sensori a più assi values ha una colonna per asse (wrist_acc: n x 3).
+    """
+    for chunk in pd.read_csv(file_path, chunksize=chunk_rows):
+        timestamps = chunk["timestamp"].to_numpy(dtype=np.int64)
+        if len(SENSOR_FILES[sensor]) > 1:
+            values = chunk[SENSOR_FILES[sensor]].to_numpy(dtype=np.float64)
+        else:
+            # Usa la prima colonna dopo timestamp
+            values = chunk[chunk.columns[1]].to_numpy(dtype=np.float64)
+        yield timestamps, values
+
+
+def split_batches(timestamps, values, batch_size, window_ms=None):
+    """Divide gli array in batch di al più batch_size righe, senza attraversare finestre temporali."""
+    if window_ms:
+        cuts = np.flatnonzero(np.diff(timestamps // window_ms)) + 1
+    else:
+        cuts = []
+    start = 0
+    for end in list(cuts) + [len(timestamps)]:
+        for i in range(start, end, batch_size):
+            j = min(i + batch_size, end)
+            yield timestamps[i:j], values[i:j]
+        start = end
+
+
+def iter_sensor_batches(folder, sensor, batch_size, window_ms=None, offset_ms=0):
+    """Genera (ultimo_timestamp, sensore, timestamps, values) per un file sensore."""
+    file_path = os.path.join(folder, f"{sensor}.csv")
+    if not os.path.exists(file_path):
+        print(f"⚠️ File non trovato: {file_path}")
+        return
+    print(f"📂 Lettura {file_path}...")
+    for timestamps, values in read_sensor_chunks(file_path, sensor):
+        timestamps = timestamps + offset_ms
+        for ts, vals in split_batches(timestamps, values, batch_size, window_ms):
+            yield int(ts[-1]), sensor, ts, vals
+
+
+def make_series(username, sensor, timestamps, values):
+    """Serie colonnare per /api/data/batch; gli assi viaggiano come liste separate in "axes"."""
+    series = {"username": username, "sensor_type": sensor, "timestamps": timestamps.tolist()}
+    if values.ndim == 2:
+        series["axes"] = {axis: column.tolist() for axis, column in zip("xyz", values.T)}
+    else:
+        series["values"] = values.tolist()
+    return series
+
+
+def encode_payload(series, compress=False):
+    """Payload colonnare per /api/data/batch, opzionalmente compresso in gzip."""
+    body = json.dumps({"series": series}, separators=(",", ":")).encode()
+    headers = {"Content-Type": "application/json"}
+    if compress:
+        body = gzip.compress(body, compresslevel=5)
+        headers["Content-Encoding"] = "gzip"
+    return body, headers
+
+
+def post_batch(session, username, sensor, timestamps, values, compress=False, url=BATCH_URL):
+    """Invia un batch; restituisce (letture accettate, letture scartate)."""
+    series = [make_series(username, sensor, timestamps, values)]
+    body, headers = encode_payload(series, compress)
+    for attempt in range(BUSY_RETRIES + 1):
+        r = session.post(url, data=body, headers=headers, timeout=30)
+        if r.status_code not in (429, 503) or attempt == BUSY_RETRIES:
+            break
+        # Server in backpressure: si riprova dopo l'attesa indicata
+        time.sleep(float(r.headers.get("Retry-After", 1)))
+    # 202: letture in coda sul server (ingestione asincrona)
+    if r.status_code not in (200, 202):
+        print(f"❌ {r.status_code}: {r.text}")
+        return 0, len(values)
+    result = r.json()
+    return result["accepted"], result["rejected"]
+
+
+def first_timestamp(folder):
+    """Timestamp minimo tra i file sensore della cartella (inizio registrazione)."""
+    firsts = []
+    for sensor in SENSOR_FILES:
         file_path = os.path.join(folder, f"{sensor}.csv")
-        if not os.path.exists(file_path):
-            print(f"⚠️ File non trovato: {file_path}")
+        if os.path.exists(file_path):
+            first = pd.read_csv(file_path, nrows=1)
+            if len(first):
+                firsts.append(int(first["timestamp"].iloc[0]))
+    return min(firsts) if firsts else None
+
+
+def send_user_data(username, folder, speed, batch_size=1000, window_ms=None, compress=False,
+                   rebase=False, session=None):
+    """Invia tutti i sensori di un utente, interlacciati in ordine di timestamp.
+
+    speed è il moltiplicatore rispetto al tempo reale (0 = il più veloce possibile);
+    i timestamp originali viaggiano con i dati, quindi la timeline lato server resta
+    corretta a qualsiasi velocità.
+    """
+    print(f"\n📦 Invio dati per utente: {username}")
+    session = session or make_session()
+
+    start_ts = first_timestamp(folder)
+    if start_ts is None:
+        print(f"⚠️ Nessun file sensore in {folder}")
+        return
+    # Con --rebase la registrazione viene traslata in modo che inizi adesso
+    offset_ms = int(time.time() * 1000) - start_ts if rebase else 0
+    start_ts += offset_ms
+
+    streams = [iter_sensor_batches(folder, sensor, batch_size, window_ms, offset_ms) for sensor in SENSOR_FILES]
+    accepted = rejected = 0
+    t0 = time.monotonic()
+
+    for last_ts, sensor, timestamps, values in heapq.merge(*streams, key=lambda b: b[0]):
+        if speed > 0:
+            # Il batch parte quando il suo ultimo campione è "avvenuto" alla velocità scelta
+            delay = (last_ts - start_ts) / 1000.0 / speed - (time.monotonic() - t0)
+            if delay > 0:
+                time.sleep(delay)
+        try:
+            ok, ko = post_batch(session, username, sensor, timestamps, values, compress)
+        except requests.RequestException as e:
+            print(f"🚨 Errore invio dati: {e}")
+            ok, ko = 0, len(values)
+        accepted += ok
+        rejected += ko
+
+    elapsed = time.monotonic() - t0
+    rate = accepted / elapsed if elapsed > 0 else 0
+    print(f"✅ {username}: {accepted} letture inviate, {rejected} scartate in {elapsed:.1f}s ({rate:,.0f} righe/s)")
+
+
+class LoadStats:
+    """Raccoglie latenze, throughput ed errori delle richieste in modalità load test."""
+
+    LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies_ms = []
+        self.errors = Counter()
+        self.rows_per_second = Counter()
+        self.accepted = 0
+        self.rejected = 0
+        self.t0 = time.monotonic()
+
+    def record(self, latency_s, accepted, rejected, error=None):
+        with self.lock:
+            self.latencies_ms.append(latency_s * 1000)
+            self.accepted += accepted
+            self.rejected += rejected
+            self.rows_per_second[int(time.monotonic() - self.t0)] += accepted
+            if error:
+                self.errors[error] += 1
+
+    @staticmethod
+    def _bar(count, total, width=40):
+        return "#" * max(1 if count else 0, round(width * count / total)) if total else ""
+
+    def report(self):
+        elapsed = time.monotonic() - self.t0
+        requests_count = len(self.latencies_ms)
+        print(f"\n📊 Risultati load test ({elapsed:.1f}s)")
+        print(f"   Richieste: {requests_count}, letture accettate: {self.accepted}, scartate: {self.rejected}")
+        if elapsed > 0:
+            print(f"   Throughput medio: {self.accepted / elapsed:,.0f} righe/s, {requests_count / elapsed:,.1f} req/s")
+        if not requests_count:
+            return
+
+        latencies = np.array(self.latencies_ms)
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        print(f"\n⏱️ Latenza (ms): p50={p50:.1f} p90={p90:.1f} p99={p99:.1f} max={latencies.max():.1f}")
+        edges = [0] + self.LATENCY_BUCKETS_MS + [float("inf")]
+        counts, _ = np.histogram(latencies, bins=edges)
+        for low, high, count in zip(edges[:-1], edges[1:], counts):
+            label = f"{low:>5g}-{high:<5g}" if high != float("inf") else f"{low:>5g}+     "
+            print(f"   {label} ms | {count:>7} {self._bar(count, requests_count)}")
+
+        rates = np.array([self.rows_per_second.get(s, 0) for s in range(int(elapsed) + 1)])
+        print(f"\n🚀 Throughput per secondo (righe/s): min={rates.min():,} media={rates.mean():,.0f} max={rates.max():,}")
+        counts, edges = np.histogram(rates, bins=min(10, max(1, len(rates))))
+        for low, high, count in zip(edges[:-1], edges[1:], counts):
+            print(f"   {low:>9,.0f}-{high:<9,.0f} | {count:>5} {self._bar(count, len(rates))}")
+
+        print("\n🚨 Errori:" if self.errors else "\n✅ Nessun errore")
+        for error, count in self.errors.most_common():
+            print(f"   {error}: {count} {self._bar(count, requests_count)}")
+
+
+def _relative_batches(username, folder, sensor, start_ts, batch_size, window_ms, offset_ms):
+    # Chiave = ms dall'inizio della registrazione, per allineare utenti diversi
+    for last_ts, _, timestamps, values in iter_sensor_batches(folder, sensor, batch_size, window_ms, offset_ms):
+        yield last_ts - offset_ms - start_ts, username, sensor, timestamps, values
+
+
+def run_load(user_pairs, workers=8, speed=0, rate=None, batch_size=1000, window_ms=None,
+             compress=False, rebase=False):
+    """Replay concorrente di più utenti e di tutti i loro sensori.
+
+    I batch di tutti gli stream vengono interlacciati secondo il timestamp relativo
+    all'inizio di ciascuna registrazione e distribuiti a un pool di thread. Il ritmo
+    è dato da speed (moltiplicatore del tempo reale) e/o da rate (righe/s aggregate):
+    se sono impostati entrambi vale il più lento.
+    """
+    streams = []
+    for username, folder in user_pairs:
+        start_ts = first_timestamp(folder)
+        if start_ts is None:
+            print(f"⚠️ Nessun file sensore in {folder}")
             continue
+        offset_ms = int(time.time() * 1000) - start_ts if rebase else 0
+        for sensor in SENSOR_FILES:
+            streams.append(_relative_batches(username, folder, sensor, start_ts, batch_size, window_ms, offset_ms))
 
-        df = pd.read_csv(file_path)
-        print(f"📂 Lettura {file_path}...")
+    stats = LoadStats()
+    local = threading.local()
+    in_flight = threading.BoundedSemaphore(workers * 4)
 
-        for _, row in df.iterrows():
-            if sensor == "wrist_acc":
-                value = float(row[["ax", "ay", "az"]].mean())
+    def send(username, sensor, timestamps, values):
+        if not hasattr(local, "session"):
+            local.session = make_session(pool_size=1)
+        t = time.perf_counter()
+        try:
+            series = [make_series(username, sensor, timestamps, values)]
+            body, headers = encode_payload(series, compress)
+            r = local.session.post(BATCH_URL, data=body, headers=headers, timeout=30)
+            latency = time.perf_counter() - t
+            if r.status_code in (200, 202):
+                result = r.json()
+                error = "item_rejected" if result["rejected"] else None
+                stats.record(latency, result["accepted"], result["rejected"], error)
             else:
-                # Usa la prima colonna dopo timestamp
-                col = df.columns[1]  # timestamp + valore specifico
-                value = float(row[col])
+                stats.record(latency, 0, len(values), f"HTTP {r.status_code}")
+        except requests.RequestException as e:
+            stats.record(time.perf_counter() - t, 0, len(values), type(e).__name__)
+        finally:
+            in_flight.release()
 
-            payload = {
-                "username": username,
-                "sensor_type": sensor,
-                "value": value
-            }
+    print(f"\n🚦 Load test: {len(user_pairs)} utenti, {len(streams)} stream, {workers} worker")
+    scheduled_rows = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        stats.t0 = t0 = time.monotonic()
+        for rel_ms, username, sensor, timestamps, values in heapq.merge(*streams, key=lambda b: b[0]):
+            due = 0.0
+            if speed > 0:
+                due = rel_ms / 1000.0 / speed
+            if rate:
+                due = max(due, scheduled_rows / rate)
+            delay = due - (time.monotonic() - t0)
+            if delay > 0:
+                time.sleep(delay)
+            in_flight.acquire()
+            pool.submit(send, username, sensor, timestamps, values)
+            scheduled_rows += len(values)
 
-            try:
-                r = requests.post(SERVER_URL, json=payload)
-                if r.status_code == 200:
-                    print(f"✅ {sensor}: {value}")
-                else:
-                    print(f"❌ {r.status_code}: {r.text}")
-            except Exception as e:
-                print(f"🚨 Errore invio dati: {e}")
+    stats.report()
+    return stats
 
-            time.sleep(1 / speed)
+
+def batch_size_arg(text):
+    """Tipo argparse per --batch-size: intero positivo entro il limite del server."""
+    value = int(text)
+    if not 1 <= value <= SERVER_MAX_BATCH_SIZE:
+        raise argparse.ArgumentTypeError(
+            f"deve essere tra 1 e {SERVER_MAX_BATCH_SIZE} (MAX_BATCH_SIZE del server)")
+    return value
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--speed", type=float, default=1, help="righe al secondo")
+    parser.add_argument("--speed", type=float, default=1,
+                        help="moltiplicatore del tempo reale (0 = il più veloce possibile)")
     parser.add_argument("--users", nargs="+", required=True,
                         help="Lista utenti nel formato user:folder_dataset")
+    parser.add_argument("--batch-size", type=batch_size_arg, default=1000,
+                        help=f"letture massime per richiesta (max {SERVER_MAX_BATCH_SIZE})")
+    parser.add_argument("--window-ms", type=int, default=None,
+                        help="chiude i batch ai confini di finestre temporali di questa durata")
+    parser.add_argument("--gzip", action="store_true", help="comprime il payload in gzip")
+    parser.add_argument("--rebase", action="store_true",
+                        help="trasla i timestamp in modo che la registrazione inizi adesso")
+    parser.add_argument("--load", action="store_true",
+                        help="modalità load test: tutti gli utenti e i sensori in parallelo")
+    parser.add_argument("--workers", type=int, default=8, help="thread di invio in modalità --load")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="righe/s aggregate da mantenere in modalità --load")
     args = parser.parse_args()
 
+    user_pairs = []
     for user_pair in args.users:
         if ":" not in user_pair:
             print(f"⚠️ Formato errato: {user_pair}, deve essere username:folder")
@@ -68,4 +337,13 @@ if __name__ == "__main__":
         if not os.path.exists(folder):
             print(f"⚠️ Cartella non trovata: {folder}")
             continue
-        send_user_data(username, folder, args.speed)
+        user_pairs.append((username, folder))
+
+    if args.load:
+        run_load(user_pairs, args.workers, args.speed, args.rate, args.batch_size, args.window_ms,
+                 args.gzip, args.rebase)
+    else:
+        session = make_session()
+        for username, folder in user_pairs:
+            send_user_data(username, folder, args.speed, args.batch_size, args.window_ms,
+                           args.gzip, args.rebase, session)
@@ -158,173 +158,8 @@ class EmailNotifier:
         return sensor_names.get(sensor_type, sensor_type.upper())
 
 
-# utils/anomaly_detector.py
-import numpy as np
-from collections import deque
-from datetime import datetime, timedelta
-
-class AnomalyDetector:
-    def __init__(self, window_size=20, z_threshold=3):
-        """
-        Inizializza il rilevatore di anomalie
-        
-        Args:
-            window_size: Dimensione della finestra per la media mobile
-            z_threshold: Soglia Z-score per rilevare anomalie
-        """
-        self.window_size = window_size
-        self.z_threshold = z_threshold
-        self.data_windows = {}  # Dizionario per memorizzare le finestre per ogni sensore/utente
-        
-        # Soglie specifiche per sensore (valori normali)
-        self.sensor_thresholds = {
-            'hr': {'min': 40, 'max': 180},      # Frequenza cardiaca
-            'temp': {'min': 35, 'max': 39},     # Temperatura corporea
-            'eda': {'min': 0.01, 'max': 20},    # Attività elettrodermica
-            'bvp': {'min': -100, 'max': 100},   # Blood volume pulse
-            'ibi': {'min': 300, 'max': 2000},   # Inter-beat interval (ms)
-            'acc': {'min': 0, 'max': 5}         # Accelerazione (g)
-        }
-    
-    def add_value(self, user_id, sensor_type, value):
-        """Aggiunge un valore e controlla se è un'anomalia"""
-        
-        key = f"{user_id}_{sensor_type}"
-        
-        # Inizializza la finestra se non esiste
-        if key not in self.data_windows:
-            self.data_windows[key] = deque(maxlen=self.window_size)
-        
-        window = self.data_windows[key]
-        
-        # Aggiungi il valore alla finestra
-        window.append(value)
-        
-        # Controlla anomalie solo se abbiamo abbastanza dati
-        if len(window) >= self.window_size // 2:
-            return self.detect_anomaly(sensor_type, value, window)
-        
-        return None
-    
-    def detect_anomaly(self, sensor_type, current_value, window):
-        """
-        Rileva anomalie usando multiple tecniche
-        
-        Returns:
-            dict con informazioni sull'anomalia o None
-        """
-        
-        anomalies = []
-        
-        # 1. Controllo soglie assolute
-        if sensor_type in self.sensor_thresholds:
-            thresholds = self.sensor_thresholds[sensor_type]
-            if current_value < thresholds['min'] or current_value > thresholds['max']:
-                anomalies.append({
-                    'type': 'absolute_threshold',
-                    'message': f"Valore fuori range normale ({thresholds['min']}-{thresholds['max']})",
-                    'severity': 'high'
-                })
-        
-        # 2. Z-score (deviazione dalla media)
-        if len(window) >= 3:
-            mean = np.mean(window)
-            std = np.std(window)
-            
-            if std > 0:
-                z_score = abs((current_value - mean) / std)
-                if z_score > self.z_threshold:
-                    anomalies.append({
-                        'type': 'statistical',
-                        'message': f"Deviazione significativa dalla media (Z-score: {z_score:.2f})",
-                        'severity': 'medium' if z_score < 4 else 'high',
-                        'z_score': z_score,
-                        'mean': mean,
-                        'std': std
-                    })
-        
-        # 3. Cambio rapido (confronto con valore precedente)
-        if len(window) >= 2:
-            prev_value = window[-2]
-            change_rate = abs((current_value - prev_value) / prev_value * 100) if prev_value != 0 else 0
-            
-            # Soglie di cambio rapido per sensore
-            rapid_change_thresholds = {
-                'hr': 30,    # 30% di cambio
-                'temp': 5,   # 5% di cambio
-                'eda': 50,   # 50% di cambio
-                'bvp': 40,   # 40% di cambio
-                'ibi': 25,   # 25% di cambio
-                'acc': 100   # 100% di cambio (movimento brusco)
-            }
-            
-            threshold = rapid_change_thresholds.get(sensor_type, 50)
-            if change_rate > threshold:
-                anomalies.append({
-                    'type': 'rapid_change',
-                    'message': f"Cambio rapido rilevato ({change_rate:.1f}%)",
-                    'severity': 'low' if change_rate < threshold * 2 else 'medium',
-                    'change_rate': change_rate
-                })
-        
-        # 4. Pattern anomalo (trend sostenuto)
-        if len(window) >= 5:
-            recent_values = list(window)[-5:]
-            trend = self.detect_trend(recent_values)
-            
-            if trend:
-                anomalies.append({
-                    'type': 'trend',
-                    'message': f"Trend {trend} sostenuto",
-                    'severity': 'low',
-                    'trend': trend
-                })
-        
-        # Restituisci l'anomalia più grave se presente
-        if anomalies:
-            # Ordina per severità
-            severity_order = {'high': 3, 'medium': 2, 'low': 1}
-            anomalies.sort(key=lambda x: severity_order.get(x['severity'], 0), reverse=True)
-            
-            return {
-                'timestamp': datetime.now(),
-                'value': current_value,
-                'anomalies': anomalies,
-                'window_mean': float(np.mean(window)),
-                'window_std': float(np.std(window))
-            }
-        
-        return None
-    
-    def detect_trend(self, values):
-        """Rileva trend crescente o decrescente"""
-        if len(values) < 3:
-            return None
-        
-        differences = [values[i+1] - values[i] for i in range(len(values)-1)]
-        
-        # Tutti positivi = trend crescente
-        if all(d > 0 for d in differences):
-            return "crescente"
-        # Tutti negativi = trend decrescente
-        elif all(d < 0 for d in differences):
-            return "decrescente"
-        
-        return None
-    
-    def get_statistics(self, user_id, sensor_type):
-        """Ottiene statistiche per un sensore specifico"""
-        key = f"{user_id}_{sensor_type}"
-        
-        if key not in self.data_windows or len(self.data_windows[key]) == 0:
-            return None
-        
-        window = self.data_windows[key]
-        return {
-            'mean': float(np.mean(window)),
-            'std': float(np.std(window)),
-            'min': float(np.min(window)),
-            'max': float(np.max(window)),
-            'median': float(np.median(window)),
-            'count': len(window)
-        }
\ No newline at end of file
+# AnomalyDetector è stato spostato in server/anomaly_detector.py, dove gira nel percorso di ingestione
+# Le email di anomalia dal server passano da server/alerts.py: riepiloghi per paziente e sensore,
+# cooldown dei duplicati e una connessione SMTP persistente in un thread separato
+# I report giornalieri dal server: `flask daily-report` (server/reports.py); reports.report_data()
+# restituisce il formato di report_data atteso da send_daily_report
@@ -0,0 +1,321 @@
+"""Invio asincrono delle anomalie per email, a riepiloghi per paziente e sensore.
+
+submit() mette in coda le anomalie e ritorna subito: l'ingestione non aspetta
+mai la posta. Un thread le raccoglie per (utente, sensore): la prima anomalia di
+una chiave apre una finestra di digest_seconds, allo scadere della quale parte
+un'unica email di riepilogo con tutte le anomalie arrivate nel frattempo. Dopo
+un invio, per cooldown_seconds le anomalie della stessa chiave con tipo e
+severità già notificati vengono soppresse (contate e citate nel riepilogo
+successivo della chiave, anche se le finestre intermedie contenevano solo
+soppresse e non hanno inviato nulla); una severità più alta passa comunque.
+
+Le email viaggiano su una connessione SMTP persistente (STARTTLS e login una
+volta sola), controllata con NOOP dopo un periodo di inattività e riaperta se il
+server l'ha chiusa. Come la coda di ingestione, il thread parte alla prima
+submit() e lo stato è per processo.
+"""
+import ssl
+import html
+import time
+import logging
+import smtplib
+import threading
+from collections import deque
+from datetime import datetime
+from email.message import EmailMessage
+
+from anomaly_detector import SEVERITY_ORDER
+
+logger = logging.getLogger(__name__)
+
+SENSOR_NAMES = {
+    "wrist_acc": "Accelerometro",
+    "wrist_activity": "Attività",
+    "wrist_bvp": "Volume Polso Sanguigno",
+    "wrist_eda": "Attività Elettrodermica",
+    "wrist_hr": "Frequenza Cardiaca",
+    "wrist_ibi": "Inter-Beat Interval",
+    "wrist_skin_temperature": "Temperatura Cutanea",
+    "wrist_hrv_rmssd": "HRV (RMSSD)",
+    "wrist_hrv_sdnn": "HRV (SDNN)",
+    "wrist_hrv_pnn50": "HRV (pNN50)",
+    "wrist_bvp_hr": "Frequenza Cardiaca da BVP",
+    "wrist_eda_tonic": "EDA Tonica",
+    "wrist_eda_phasic": "EDA Fasica",
+    "wrist_eda_scr": "Risposte Elettrodermiche",
+}
+
+# Anomalie elencate una per una in un riepilogo; le altre solo nei conteggi
+DIGEST_MAX_LINES = 20
+
+
+class SMTPConnection:
+    """Connessione SMTP riusata tra un invio e l'altro, riaperta quando cade."""
+
+    def __init__(self, host, port=587, username=None, password=None, starttls=True, timeout=10,
+                 keepalive_seconds=60):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.keepalive_seconds = keepalive_seconds
+        self._smtp = None
+        self._last_used = None
+        self.connections = 0
+
+    def _open(self):
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                smtp.starttls(context=ssl.create_default_context())
+            if self.username:
+                smtp.login(self.username, self.password)
+        except Exception:
+            smtp.close()
+            raise
+        self._smtp = smtp
+        self.connections += 1
+
+    def close(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                self._smtp.close()
+            self._smtp = None
+
+    def _alive(self):
+        if self._smtp is None:
+            return False
+        if time.monotonic() - self._last_used < self.keepalive_seconds:
+            return True
+        try:
+            return self._smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def send(self, message):
+        """Invia il messaggio; se la connessione è caduta la riapre e riprova una volta."""
+        for attempt in (0, 1):
+            if not self._alive():
+                self.close()
+                self._open()
+            try:
+                self._smtp.send_message(message)
+                self._last_used = time.monotonic()
+                return
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPSenderRefused, OSError):
+                # SMTPSenderRefused con codice 421: il server chiude la sessione
+                self._smtp = None
+                if attempt:
+                    raise
+
+
+class AlertDispatcher:
+    """Coda limitata di anomalie con un thread che invia riepiloghi per (utente, sensore)."""
+
+    def __init__(self, connection, sender, recipients, user_label=str, digest_seconds=60,
+                 cooldown_seconds=900, max_pending=10000, subject_prefix="⚠️ Anomalie"):
+        self.connection = connection
+        self.sender = sender
+        self.recipients = list(recipients)
+        self.user_label = user_label
+        self.digest_seconds = digest_seconds
+        self.cooldown_seconds = cooldown_seconds
+        self.max_pending = max_pending
+        self.subject_prefix = subject_prefix
+        self._incoming = deque()
+        self._digests = {}       # (user_id, sensor_type) -> [scadenza, anomalie, soppresse]
+        self._notified = {}      # (user_id, sensor_type, tipo) -> (fine cooldown, severità)
+        self._carried = {}       # (user_id, sensor_type) -> soppresse in finestre senza email
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+        self._sending = False
+
+        self.submitted = 0
+        self.dropped = 0
+        self.suppressed = 0
+        self.sent = 0
+        self.failed = 0
+
+    def submit(self, anomalies):
+        """Mette in coda le anomalie (dizionari come quelli salvati in Anomaly); non blocca mai."""
+        if not anomalies:
+            return
+        with self._cond:
+            if self._closed:
+                return
+            room = self.max_pending - len(self._incoming)
+            accepted = anomalies[:max(room, 0)]
+            self.dropped += len(anomalies) - len(accepted)
+            self.submitted += len(accepted)
+            if not accepted:
+                return
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="alert-dispatcher", daemon=True)
+                self._thread.start()
+            self._incoming.extend(accepted)
+            self._cond.notify()
+
+    def _collect(self, now):
+        """Sposta le anomalie in arrivo nei riepiloghi aperti, applicando il cooldown."""
+        while self._incoming:
+            anomaly = self._incoming.popleft()
+            key = (anomaly["user_id"], anomaly["sensor_type"])
+            digest = self._digests.get(key)
+            if digest is None:
+                digest = self._digests[key] = [now + self.digest_seconds, [], self._carried.pop(key, 0)]
+            notified = self._notified.get(key + (anomaly["anomaly_type"],))
+            if (notified is not None and now < notified[0]
+                    and SEVERITY_ORDER[anomaly["severity"]] <= SEVERITY_ORDER[notified[1]]):
+                digest[2] += 1
+                self.suppressed += 1
+            else:
+                digest[1].append(anomaly)
+
+    def _due(self, now, flush=False):
+        """Riepiloghi scaduti (tutti con flush), tolti da quelli aperti."""
+        due = []
+        for key, (deadline, anomalies, suppressed) in list(self._digests.items()):
+            if flush or deadline <= now:
+                del self._digests[key]
+                if anomalies:
+                    due.append((key, anomalies, suppressed))
+                elif suppressed:
+                    # Con soli duplicati soppressi non parte nessuna email: il conteggio
+                    # passa al prossimo riepilogo della stessa chiave
+                    self._carried[key] = suppressed
+        return due
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._collect(now)
+                due = self._due(now, flush=self._closed)
+                if due:
+                    self._sending = True
+                    return due
+                if self._closed:
+                    return None
+                timeout = min((d[0] for d in self._digests.values()), default=None)
+                self._cond.wait(None if timeout is None else max(timeout - now, 0))
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                self.connection.close()
+                return
+            for key, anomalies, suppressed in batch:
+                try:
+                    self.connection.send(self.build_message(key, anomalies, suppressed))
+                except Exception:
+                    logger.exception("Invio del riepilogo anomalie %s fallito", key)
+                    with self._cond:
+                        self.failed += 1
+                    continue
+                now = time.monotonic()
+                with self._cond:
+                    self.sent += 1
+                    for anomaly in anomalies:
+                        notified_key = key + (anomaly["anomaly_type"],)
+                        previous = self._notified.get(notified_key)
+                        severity = anomaly["severity"]
+                        if previous is not None and now < previous[0] and \
+                                SEVERITY_ORDER[previous[1]] > SEVERITY_ORDER[severity]:
+                            severity = previous[1]
+                        self._notified[notified_key] = (now + self.cooldown_seconds, severity)
+            with self._cond:
+                self._sending = False
+                # Cooldown scaduti: non servono più
+                now = time.monotonic()
+                for notified_key in [k for k, v in self._notified.items() if v[0] <= now]:
+                    del self._notified[notified_key]
+                self._cond.notify_all()
+
+    def build_message(self, key, anomalies, suppressed=0):
+        """Email di riepilogo (testo e HTML) delle anomalie di un paziente su un sensore."""
+        user_id, sensor_type = key
+        user = self.user_label(user_id)
+        sensor = SENSOR_NAMES.get(sensor_type, sensor_type)
+        anomalies = sorted(anomalies, key=lambda a: a["timestamp"])
+        worst = max(anomalies, key=lambda a: SEVERITY_ORDER[a["severity"]])["severity"]
+        counts = {}
+        for anomaly in anomalies:
+            kind = (anomaly["anomaly_type"], anomaly["severity"])
+            counts[kind] = counts.get(kind, 0) + 1
+
+        lines = [f"{a['timestamp']:%d/%m/%Y %H:%M:%S}  {a['severity']:<8} {a['value']:.2f}  {a['message']}"
+                 for a in anomalies[:DIGEST_MAX_LINES]]
+        if len(anomalies) > DIGEST_MAX_LINES:
+            lines.append(f"... e altre {len(anomalies) - DIGEST_MAX_LINES}")
+        summary = [f"{n} x {kind} ({severity})" for (kind, severity), n in sorted(counts.items())]
+        if suppressed:
+            summary.append(f"{suppressed} ripetute, già notificate e non elencate")
+
+        text_body = (f"ANOMALIE RILEVATE - {user}\n\nSensore: {sensor}\n"
+                     f"Periodo: {anomalies[0]['timestamp']:%d/%m/%Y %H:%M:%S} - "
+                     f"{anomalies[-1]['timestamp']:%d/%m/%Y %H:%M:%S}\n\n"
+                     + "\n".join(summary) + "\n\n" + "\n".join(lines)
+                     + "\n\nSi consiglia di verificare lo stato del paziente.\n")
+        rows = "".join(f"<tr><td>{a['timestamp']:%d/%m/%Y %H:%M:%S}</td><td>{a['severity']}</td>"
+                       f"<td>{a['value']:.2f}</td><td>{html.escape(a['message'])}</td></tr>"
+                       for a in anomalies[:DIGEST_MAX_LINES])
+        html_body = (f"<html><body style=\"font-family: Arial, sans-serif;\">"
+                     f"<h2 style=\"color: #721c24;\">⚠️ Anomalie rilevate - {html.escape(user)}</h2>"
+                     f"<p><strong>Sensore:</strong> {html.escape(sensor)}</p>"
+                     f"<ul>{''.join(f'<li>{html.escape(line)}</li>' for line in summary)}</ul>"
+                     f"<table border=\"1\" cellpadding=\"4\">{rows}</table>"
+                     f"<p>Si consiglia di verificare lo stato del paziente e contattarlo se necessario.</p>"
+                     f"</body></html>")
+
+        message = EmailMessage()
+        message["From"] = self.sender
+        message["To"] = ", ".join(self.recipients)
+        message["Subject"] = f"{self.subject_prefix} {worst} - {user}, {sensor} ({len(anomalies)})"
+        message["Date"] = datetime.now().astimezone()
+        message.set_content(text_body)
+        message.add_alternative(html_body, subtype="html")
+        return message
+
+    def flush(self, timeout=None):
+        """Invia subito i riepiloghi aperti e attende la fine degli invii; False se scade il timeout."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            now = time.monotonic()
+            self._collect(now)
+            for digest in self._digests.values():
+                digest[0] = now
+            self._cond.notify_all()
+            while self._incoming or self._sending or any(d[1] for d in self._digests.values()):
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def close(self, timeout=30):
+        """Invia i riepiloghi aperti e ferma il thread (es. allo spegnimento)."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def metrics(self):
+        with self._cond:
+            return {
+                "pending": len(self._incoming) + sum(len(d[1]) for d in self._digests.values()),
+                "open_digests": len(self._digests),
+                "submitted": self.submitted,
+                "dropped": self.dropped,
+                "suppressed": self.suppressed,
+                "sent": self.sent,
+                "failed": self.failed,
+                "connections": self.connection.connections,
+            }
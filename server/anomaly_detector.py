@@ -0,0 +1,445 @@
+"""Rilevamento anomalie in streaming, usato dal server su ogni lettura ricevuta.
+
+Ogni stream (utente, sensore) mantiene media e somma dei quadrati degli scarti
+della finestra aggiornate in modo incrementale (Welford su finestra scorrevole),
+quindi add_value costa O(1) indipendentemente dalla dimensione della finestra.
+"""
+import math
+import numpy as np
+from collections import deque
+from datetime import datetime
+
+SEVERITY_ORDER = {'high': 3, 'medium': 2, 'low': 1}
+
+# Nomi dei sensori inviati dal client -> chiavi usate per soglie e cambi rapidi
+SENSOR_ALIASES = {
+    'wrist_acc': 'acc',
+    'wrist_bvp': 'bvp',
+    'wrist_eda': 'eda',
+    'wrist_hr': 'hr',
+    'wrist_ibi': 'ibi',
+    'wrist_skin_temperature': 'skin_temp'
+}
+
+# Soglie di cambio rapido per sensore (% rispetto al valore precedente); None = controllo
+# disattivato, per i segnali centrati sullo zero dove una variazione percentuale non ha senso
+RAPID_CHANGE_THRESHOLDS = {
+    'hr': 30,    # 30% di cambio
+    'temp': 5,   # 5% di cambio
+    'skin_temp': 5,
+    'eda': 50,   # 50% di cambio
+    'bvp': None,  # oscilla attorno a 0: ogni passaggio per lo zero sarebbe un "cambio rapido"
+    'ibi': 25,   # 25% di cambio
+    'acc': 100   # 100% di cambio (movimento brusco)
+}
+DEFAULT_RAPID_CHANGE_THRESHOLD = 50
+
+# Lunghezza del trend sostenuto (valori consecutivi tutti crescenti o decrescenti)
+TREND_LENGTH = 5
+
+# Ogni quanti aggiornamenti ricalcolare media e varianza da zero (stabilità numerica)
+RECOMPUTE_EVERY = 1000
+
+# Tolleranza relativa sui confronti dello z-score e sulla deviazione standard nulla:
+# con dati quantizzati i pareggi esatti (es. z = 3) sono frequenti, e così streaming e
+# valutazione vettoriale decidono allo stesso modo nonostante l'arrotondamento diverso
+Z_TOLERANCE = 1e-9
+
+# Margine relativo entro cui add_value e score_series ricalcolano esattamente le
+# statistiche di finestra (z vicino a una soglia, finestra quasi costante)
+BORDERLINE_TOLERANCE = 1e-6
+
+
+def effective_std(std, mean):
+    """Deviazione standard, azzerata se è solo rumore di arrotondamento (finestra costante)."""
+    return std if std > Z_TOLERANCE * (abs(mean) + Z_TOLERANCE) else 0.0
+
+
+class StreamState:
+    """Finestra di uno stream utente/sensore con statistiche incrementali."""
+    __slots__ = ('window', 'mean', 'm2', 'rising', 'falling', 'updates', 'limits', 'rapid_threshold')
+
+    def __init__(self, window_size, limits, rapid_threshold):
+        self.window = deque(maxlen=window_size)
+        self.mean = 0.0
+        self.m2 = 0.0          # somma dei quadrati degli scarti dalla media
+        self.rising = 0        # differenze consecutive > 0 in coda alla finestra
+        self.falling = 0       # differenze consecutive < 0 in coda alla finestra
+        self.updates = 0
+        self.limits = limits
+        self.rapid_threshold = rapid_threshold
+
+    def push(self, value):
+        window = self.window
+        n = len(window)
+        if n:
+            diff = value - window[-1]
+            self.rising = self.rising + 1 if diff > 0 else 0
+            self.falling = self.falling + 1 if diff < 0 else 0
+
+        if n < window.maxlen:
+            # Welford: aggiunta di un campione
+            n += 1
+            delta = value - self.mean
+            self.mean += delta / n
+            self.m2 += delta * (value - self.mean)
+        else:
+            # Welford su finestra scorrevole: il nuovo valore sostituisce il più vecchio
+            old = window[0]
+            old_mean = self.mean
+            self.mean += (value - old) / n
+            self.m2 += (value - old) * (value - self.mean + old - old_mean)
+        window.append(value)
+
+        self.updates += 1
+        if self.updates >= RECOMPUTE_EVERY:
+            self.recompute()
+
+    def recompute(self):
+        n = len(self.window)
+        self.mean = math.fsum(self.window) / n if n else 0.0
+        self.m2 = math.fsum((v - self.mean) ** 2 for v in self.window)
+        self.updates = 0
+
+    def exact_stats(self):
+        """Media e deviazione standard ricalcolate sulla finestra, come le calcola score_series."""
+        window = np.fromiter(self.window, np.float64, len(self.window))
+        mean = window.mean()
+        return mean, effective_std(window.std(), mean)
+
+    @property
+    def std(self):
+        n = len(self.window)
+        std = math.sqrt(self.m2 / n) if n and self.m2 > 0 else 0.0
+        return effective_std(std, self.mean)
+
+
+class AnomalyDetector:
+    def __init__(self, window_size=20, z_threshold=3):
+        """
+        Inizializza il rilevatore di anomalie
+
+        Args:
+            window_size: Dimensione della finestra per la media mobile
+            z_threshold: Soglia Z-score per rilevare anomalie
+        """
+        self.window_size = window_size
+        self.z_threshold = z_threshold
+        self.streams = {}  # (user_id, sensor_type) -> StreamState
+
+        # Soglie specifiche per sensore (valori normali)
+        self.sensor_thresholds = {
+            'hr': {'min': 40, 'max': 180},      # Frequenza cardiaca
+            'temp': {'min': 35, 'max': 39},     # Temperatura corporea
+            'skin_temp': {'min': 25, 'max': 37},  # Temperatura cutanea al polso (di norma 31-34 °C)
+            'eda': {'min': 0.01, 'max': 20},    # Attività elettrodermica
+            'bvp': {'min': -100, 'max': 100},   # Blood volume pulse
+            'ibi': {'min': 300, 'max': 2000},   # Inter-beat interval (ms)
+            'acc': {'min': 0, 'max': 5}         # Accelerazione (g)
+        }
+
+    def _new_stream(self, sensor_type):
+        base = SENSOR_ALIASES.get(sensor_type, sensor_type)
+        return StreamState(
+            self.window_size,
+            self.sensor_thresholds.get(base),
+            RAPID_CHANGE_THRESHOLDS.get(base, DEFAULT_RAPID_CHANGE_THRESHOLD)
+        )
+
+    def add_value(self, user_id, sensor_type, value):
+        """Aggiunge un valore e controlla se è un'anomalia"""
+
+        key = (user_id, sensor_type)
+        state = self.streams.get(key)
+        if state is None:
+            state = self.streams[key] = self._new_stream(sensor_type)
+
+        state.push(value)
+
+        # Controlla anomalie solo se abbiamo abbastanza dati
+        if len(state.window) >= self.window_size // 2:
+            return self.detect_anomaly(state, value)
+
+        return None
+
+    def detect_anomaly(self, state, current_value):
+        """
+        Rileva anomalie usando multiple tecniche (tutte O(1) sullo stato dello stream)
+
+        Returns:
+            dict con informazioni sull'anomalia o None
+        """
+
+        anomalies = []
+        window = state.window
+        n = len(window)
+
+        # 1. Controllo soglie assolute
+        thresholds = state.limits
+        if thresholds is not None:
+            if current_value < thresholds['min'] or current_value > thresholds['max']:
+                anomalies.append({
+                    'type': 'absolute_threshold',
+                    'message': f"Valore fuori range normale ({thresholds['min']}-{thresholds['max']})",
+                    'severity': 'high'
+                })
+
+        # 2. Z-score (deviazione dalla media)
+        if n >= 3:
+            mean = state.mean
+            std = state.std
+            # Con una finestra quasi costante (scarti piccoli rispetto alla media) le
+            # statistiche incrementali perdono cifre: vicino alle soglie si ricalcolano
+            if std <= BORDERLINE_TOLERANCE * abs(mean) or self._z_borderline(current_value, mean, std):
+                mean, std = state.exact_stats()
+
+            if std > 0:
+                z_score = abs((current_value - mean) / std)
+                if z_score > self.z_threshold * (1 + Z_TOLERANCE):
+                    anomalies.append({
+                        'type': 'statistical',
+                        'message': f"Deviazione significativa dalla media (Z-score: {z_score:.2f})",
+                        'severity': 'medium' if z_score < 4 * (1 - Z_TOLERANCE) else 'high',
+                        'z_score': z_score,
+                        'mean': mean,
+                        'std': std
+                    })
+
+        # 3. Cambio rapido (confronto con valore precedente)
+        if n >= 2 and state.rapid_threshold is not None:
+            prev_value = window[-2]
+            change_rate = abs((current_value - prev_value) / prev_value * 100) if prev_value != 0 else 0
+
+            threshold = state.rapid_threshold
+            if change_rate > threshold:
+                anomalies.append({
+                    'type': 'rapid_change',
+                    'message': f"Cambio rapido rilevato ({change_rate:.1f}%)",
+                    'severity': 'low' if change_rate < threshold * 2 else 'medium',
+                    'change_rate': change_rate
+                })
+
+        # 4. Pattern anomalo (trend sostenuto sugli ultimi TREND_LENGTH valori)
+        if n >= TREND_LENGTH:
+            trend = None
+            if state.rising >= TREND_LENGTH - 1:
+                trend = "crescente"
+            elif state.falling >= TREND_LENGTH - 1:
+                trend = "decrescente"
+
+            if trend:
+                anomalies.append({
+                    'type': 'trend',
+                    'message': f"Trend {trend} sostenuto",
+                    'severity': 'low',
+                    'trend': trend
+                })
+
+        # Restituisci l'anomalia più grave se presente
+        if anomalies:
+            # Ordina per severità
+            anomalies.sort(key=lambda x: SEVERITY_ORDER.get(x['severity'], 0), reverse=True)
+
+            return {
+                'timestamp': datetime.now(),
+                'value': current_value,
+                'anomalies': anomalies,
+                'window_mean': float(state.mean),
+                'window_std': float(state.std)
+            }
+
+        return None
+
+    def _z_borderline(self, value, mean, std):
+        if std <= 0:
+            return False
+        z = abs((value - mean) / std)
+        return (abs(z - self.z_threshold) <= BORDERLINE_TOLERANCE * self.z_threshold
+                or abs(z - 4) <= BORDERLINE_TOLERANCE * 4)
+
+    def score_series(self, values, sensor_type):
+        """
+        Valuta un'intera registrazione di un sensore in modo vettoriale
+
+        Produce, campione per campione, lo stesso esito di add_value chiamato in
+        sequenza su uno stream nuovo (finestre crescenti all'inizio, poi scorrevoli).
+
+        Args:
+            values: array NumPy, lista o pandas Series dei valori in ordine di tempo
+            sensor_type: tipo di sensore (es. 'wrist_bvp' o 'bvp')
+
+        Returns:
+            dict di array lunghi quanto values: 'is_anomaly', 'type' e 'severity'
+            (anomalia più grave, None se assente), una maschera per ogni tecnica,
+            'z_score', 'change_rate', 'window_mean' e 'window_std'
+        """
+        x = np.asarray(values, dtype=np.float64)
+        size = len(x)
+        base = SENSOR_ALIASES.get(sensor_type, sensor_type)
+        w = self.window_size
+        idx = np.arange(size)
+        n = np.minimum(idx + 1, w)
+        checked = n >= w // 2
+
+        # Media e deviazione standard della finestra (che include il campione corrente)
+        # con somme cumulative su valori centrati, per limitare la cancellazione numerica
+        offset = x.mean() if size else 0.0
+        c = x - offset
+        csum = np.concatenate(([0.0], np.cumsum(c)))
+        csq = np.concatenate(([0.0], np.cumsum(c * c)))
+        lo = np.maximum(idx + 1 - w, 0)
+        mean_c = (csum[idx + 1] - csum[lo]) / n
+        var = (csq[idx + 1] - csq[lo]) / n - mean_c * mean_c
+        mean = mean_c + offset
+        std = np.sqrt(np.maximum(var, 0.0))
+
+        # Le somme cumulative accumulano errore lungo la registrazione: dove l'esito
+        # dipende dall'arrotondamento (z vicino a una soglia, finestra quasi costante)
+        # media e deviazione standard si ricalcolano esattamente sulla finestra
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = np.abs((x - mean) / std)
+        scale = np.abs(mean) + (x.std() if size else 0.0)
+        borderline = checked & (n >= 3) & (
+            (std <= BORDERLINE_TOLERANCE * scale)
+            | (np.abs(z - self.z_threshold) <= BORDERLINE_TOLERANCE * self.z_threshold)
+            | (np.abs(z - 4) <= BORDERLINE_TOLERANCE * 4)
+        )
+        for i in np.flatnonzero(borderline):
+            window = x[lo[i]:i + 1]
+            mean[i] = window.mean()
+            std[i] = window.std()
+
+        std[std <= Z_TOLERANCE * (np.abs(mean) + Z_TOLERANCE)] = 0.0
+
+        # 1. Soglie assolute
+        absolute = np.zeros(size, dtype=bool)
+        thresholds = self.sensor_thresholds.get(base)
+        if thresholds is not None:
+            absolute = (x < thresholds['min']) | (x > thresholds['max'])
+
+        # 2. Z-score
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = np.where(std > 0, np.abs((x - mean) / std), np.nan)
+        statistical = (n >= 3) & (std > 0) & (z > self.z_threshold * (1 + Z_TOLERANCE))
+
+        # 3. Cambio rapido
+        prev = np.concatenate(([np.nan], x[:-1]))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            change = np.where(prev != 0, np.abs((x - prev) / prev * 100), 0.0)
+        change[0] = 0.0
+        rapid_threshold = RAPID_CHANGE_THRESHOLDS.get(base, DEFAULT_RAPID_CHANGE_THRESHOLD)
+        if rapid_threshold is None:
+            rapid = np.zeros(size, dtype=bool)
+        else:
+            rapid = (n >= 2) & (change > rapid_threshold)
+
+        # 4. Trend: le ultime TREND_LENGTH - 1 differenze tutte dello stesso segno
+        trend = np.zeros(size, dtype=bool)
+        steps = TREND_LENGTH - 1
+        if size > steps:
+            d = np.diff(x)
+            kernel = np.ones(steps, dtype=np.int64)
+            up = np.convolve((d > 0).astype(np.int64), kernel, mode='valid') == steps
+            down = np.convolve((d < 0).astype(np.int64), kernel, mode='valid') == steps
+            trend[steps:] = up | down
+        trend &= n >= TREND_LENGTH
+
+        masks = {
+            'absolute_threshold': absolute & checked,
+            'statistical': statistical & checked,
+            'rapid_change': rapid & checked,
+            'trend': trend & checked,
+        }
+
+        # Severità di ogni tecnica, nell'ordine in cui add_value le riporta
+        codes = np.zeros((4, size), dtype=np.int8)
+        codes[0][masks['absolute_threshold']] = SEVERITY_ORDER['high']
+        codes[1][masks['statistical']] = np.where(z[masks['statistical']] < 4 * (1 - Z_TOLERANCE),
+                                                  SEVERITY_ORDER['medium'], SEVERITY_ORDER['high'])
+        if rapid_threshold is not None:
+            codes[2][masks['rapid_change']] = np.where(change[masks['rapid_change']] < rapid_threshold * 2,
+                                                       SEVERITY_ORDER['low'], SEVERITY_ORDER['medium'])
+        codes[3][masks['trend']] = SEVERITY_ORDER['low']
+
+        top_code = codes.max(axis=0)
+        top_check = np.argmax(codes == top_code, axis=0)  # a parità di severità vince la prima tecnica
+        is_anomaly = top_code > 0
+
+        type_names = np.array(['absolute_threshold', 'statistical', 'rapid_change', 'trend'], dtype=object)
+        severity_names = np.array([None, 'low', 'medium', 'high'], dtype=object)
+        types = np.where(is_anomaly, type_names[top_check], None)
+
+        return {
+            'is_anomaly': is_anomaly,
+            'type': types,
+            'severity': severity_names[top_code],
+            **masks,
+            'z_score': z,
+            'change_rate': change,
+            'window_mean': mean,
+            'window_std': std
+        }
+
+    def streaming_mismatches(self, values, sensor_type):
+        """Indici dei campioni in cui score_series e add_value in sequenza danno esiti diversi
+
+        Confronta tipo e severità dell'anomalia più grave di ogni campione, con due
+        rilevatori nuovi della stessa finestra e soglia z: lista vuota se coincidono.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        scores = AnomalyDetector(self.window_size, self.z_threshold).score_series(values, sensor_type)
+        streaming = AnomalyDetector(self.window_size, self.z_threshold)
+        mismatches = []
+        for i, value in enumerate(values.tolist()):
+            result = streaming.add_value(None, sensor_type, value)
+            top = (result['anomalies'][0]['type'], result['anomalies'][0]['severity']) if result else (None, None)
+            if top != (scores['type'][i], scores['severity'][i]):
+                mismatches.append(i)
+        return mismatches
+
+    def series_message(self, scores, values, sensor_type, i):
+        """Messaggio dell'anomalia più grave del campione i, come lo scriverebbe add_value"""
+        kind = scores['type'][i]
+        if kind == 'absolute_threshold':
+            thresholds = self.sensor_thresholds[SENSOR_ALIASES.get(sensor_type, sensor_type)]
+            return f"Valore fuori range normale ({thresholds['min']}-{thresholds['max']})"
+        if kind == 'statistical':
+            return f"Deviazione significativa dalla media (Z-score: {scores['z_score'][i]:.2f})"
+        if kind == 'rapid_change':
+            return f"Cambio rapido rilevato ({scores['change_rate'][i]:.1f}%)"
+        if kind == 'trend':
+            return f"Trend {'crescente' if values[i] > values[i - 1] else 'decrescente'} sostenuto"
+        return None
+
+    def detect_trend(self, values):
+        """Rileva trend crescente o decrescente"""
+        if len(values) < 3:
+            return None
+
+        differences = [values[i+1] - values[i] for i in range(len(values)-1)]
+
+        # Tutti positivi = trend crescente
+        if all(d > 0 for d in differences):
+            return "crescente"
+        # Tutti negativi = trend decrescente
+        elif all(d < 0 for d in differences):
+            return "decrescente"
+
+        return None
+
+    def get_statistics(self, user_id, sensor_type):
+        """Ottiene statistiche per un sensore specifico"""
+        state = self.streams.get((user_id, sensor_type))
+
+        if state is None or len(state.window) == 0:
+            return None
+
+        window = state.window
+        return {
+            'mean': float(state.mean),
+            'std': float(state.std),
+            'min': float(np.min(window)),
+            'max': float(np.max(window)),
+            'median': float(np.median(window)),
+            'count': len(window)
+        }
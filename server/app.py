@@ -1,24 +1,192 @@
 import os
 import json
-from datetime import datetime, timedelta
-from flask import Flask, render_template, request, redirect, url_for, flash
+import time
+import hashlib
+import math
+import zlib
+import atexit
+import signal
+import collections
+import multiprocessing
+import threading
+import click
+from datetime import datetime, timedelta, timezone
+from flask import Flask, Response, g, render_template, request, redirect, url_for, flash, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func, inspect, select, text, union_all
+import numpy as np
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
+from werkzeug.http import http_date
 from werkzeug.security import generate_password_hash, check_password_hash
 
+import alerts
+import archive
+import blocks
+import cache
+import dataset_import
+import db_config
+import downsample
+import features
+import history
+import live
+import metrics
+import motion
+import partitions
+import reports
+import rollups
+import shards
+from ingest_queue import WriteBehindQueue
+from anomaly_detector import AnomalyDetector, SENSOR_ALIASES, SEVERITY_ORDER
+
 # ================== CONFIGURAZIONE ==================
 app = Flask(__name__)
 app.secret_key = "supersecretkey"
 
-# Database SQLite
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///health_monitoring.db"
+# Database da DATABASE_URL (PostgreSQL in docker-compose), altrimenti SQLite locale
+app.config["SQLALCHEMY_DATABASE_URI"] = db_config.database_url()
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = db_config.engine_options(app.config["SQLALCHEMY_DATABASE_URI"])
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# Rilevamento anomalie in linea sulle letture ricevute
+app.config["ANOMALY_DETECTION"] = True
+# Severità minima delle anomalie salvate ("low" genera una riga quasi per ogni campione BVP)
+app.config["ANOMALY_MIN_SEVERITY"] = "medium"
+# Ingestione asincrona: le letture validate vanno in coda e le API rispondono 202
+app.config["INGEST_ASYNC"] = os.environ.get("INGEST_ASYNC") == "1"
+# Letture massime in coda; oltre si risponde INGEST_QUEUE_FULL_STATUS (429 o 503)
+app.config["INGEST_QUEUE_MAX_ROWS"] = 50000
+app.config["INGEST_QUEUE_FULL_STATUS"] = 503
+# Group commit: si scrive al raggiungimento di INGEST_GROUP_ROWS letture o dopo
+# INGEST_GROUP_MAX_LATENCY_MS dalla prima lettura in attesa
+app.config["INGEST_GROUP_ROWS"] = 2000
+app.config["INGEST_GROUP_MAX_LATENCY_MS"] = 200
+# Shard di ingestione (vedi shards.py): indirizzi "host:porta" o socket Unix dei processi di
+# `flask ingest-workers`, es. INGEST_SHARDS=127.0.0.1:7101,127.0.0.1:7102; le route inoltrano
+# le letture allo shard del paziente e rispondono 202. L'authkey protegge il canale (pickle):
+# con INGEST_SHARDS è obbligatoria, propria degli shard e non di esempio (vedi shards.check_authkey)
+app.config["INGEST_SHARDS"] = [a.strip() for a in os.environ.get("INGEST_SHARDS", "").split(",") if a.strip()]
+app.config["INGEST_SHARD_AUTHKEY"] = os.environ.get("INGEST_SHARD_AUTHKEY", "").encode()
+if app.config["INGEST_SHARDS"]:
+    try:
+        shards.check_authkey(app.config["INGEST_SHARD_AUTHKEY"])
+    except ValueError as e:
+        raise RuntimeError(f"INGEST_SHARDS is set but {e}") from None
+    app.config["INGEST_ASYNC"] = True
+# Feature per finestra (HRV, frequenza da BVP, EDA) calcolate in ingestione: lo stato delle
+# finestre aperte è per processo, quindi servono tutte le letture di un paziente nello stesso
+# processo. Attive negli shard di ingestione e nel server di sviluppo; con più worker senza
+# shard restano spente (le feature dei dati importati vengono da import-dataset), a meno di
+# ONLINE_FEATURES=1 per un deployment con un solo processo di ingestione
+app.config["ONLINE_FEATURES"] = os.environ.get("ONLINE_FEATURES") == "1"
+# Partizionamento temporale dei dati grezzi: None (tabella unica), "day" o "week"
+app.config["SENSOR_DATA_PARTITIONS"] = os.environ.get("SENSOR_DATA_PARTITIONS") or None
+# Giorni di dati grezzi conservati da `flask maintain` (None = nessuna retention)
+app.config["RAW_RETENTION_DAYS"] = int(os.environ["RAW_RETENTION_DAYS"]) if os.environ.get("RAW_RETENTION_DAYS") else None
+# Sensori ad alta frequenza salvati a blocchi binari invece che riga per riga (vedi blocks.py),
+# es. BLOCK_SENSORS=wrist_bvp,wrist_acc; vuoto = tutti in sensor_data
+app.config["BLOCK_SENSORS"] = [s.strip() for s in os.environ.get("BLOCK_SENSORS", "").split(",") if s.strip()]
+# Dashboard live (SSE) aperte per processo: ognuna tiene occupato un thread del worker per
+# tutta la durata, quindi il server va avviato con worker a thread (gunicorn -k gthread
+# --threads N, vedi docker-compose.yml) e il limite deve lasciare thread liberi alle altre richieste
+app.config["LIVE_MAX_STREAMS"] = int(os.environ.get("LIVE_MAX_STREAMS", 16))
+# Profiler a campionamento per singola richiesta (?profile=1), solo se abilitato
+app.config["PROFILER_ENABLED"] = os.environ.get("PROFILER_ENABLED") == "1"
+app.config["PROFILER_INTERVAL_MS"] = 5
+# Email di riepilogo delle anomalie (vedi alerts.py), attive solo con SMTP_HOST e ALERT_RECIPIENTS;
+# mittente e password come in client/email-anomaly-utils.py
+app.config["SMTP_HOST"] = os.environ.get("SMTP_HOST")
+app.config["SMTP_PORT"] = int(os.environ.get("SMTP_PORT", 587))
+app.config["SMTP_STARTTLS"] = os.environ.get("SMTP_STARTTLS", "1") == "1"
+app.config["ALERT_SENDER"] = os.environ.get("EMAIL_SENDER", "monitoraggio@localhost")
+app.config["ALERT_SMTP_PASSWORD"] = os.environ.get("EMAIL_PASSWORD")
+app.config["ALERT_RECIPIENTS"] = [r.strip() for r in os.environ.get("ALERT_RECIPIENTS", "").split(",") if r.strip()]
+app.config["ALERT_MIN_SEVERITY"] = "high"
+# Anomalie di un paziente su un sensore raccolte in un'unica email per questa finestra
+app.config["ALERT_DIGEST_SECONDS"] = 60
+# Anomalie dello stesso tipo già notificate non si ripetono per questo intervallo
+app.config["ALERT_COOLDOWN_SECONDS"] = 900
+# Giorni ricontrollati da `flask daily-report` per letture arrivate in ritardo
+app.config["REPORT_LOOKBACK_DAYS"] = 7
 db = SQLAlchemy(app)
 
+# Metriche del processo, esposte su /metrics (vedi metrics.py)
+metrics_registry = metrics.Registry()
+request_seconds = metrics_registry.histogram(
+    "http_request_duration_seconds", "Durata delle richieste per route", ("method", "endpoint", "status"))
+request_queries = metrics_registry.histogram(
+    "http_request_db_queries", "Query SQL per richiesta", ("endpoint",), metrics.COUNT_BUCKETS)
+request_db_seconds = metrics_registry.histogram(
+    "http_request_db_seconds", "Tempo SQL per richiesta", ("endpoint",))
+db_queries = metrics_registry.counter("db_queries_total", "Query SQL eseguite", ("operation",))
+db_query_seconds = metrics_registry.histogram(
+    "db_query_duration_seconds", "Durata delle query SQL", ("operation",))
+ingest_rows = metrics_registry.counter("ingest_rows_total", "Letture salvate", ("sensor_type",))
+# sensor_type arriva dai client: come etichetta solo i sensori noti, gli altri sono "other"
+# (altrimenti ogni nome inventato creerebbe una serie di metriche in più)
+METRIC_SENSOR_TYPES = frozenset(SENSOR_ALIASES) | frozenset(SENSOR_ALIASES.values()) | {
+    motion.ACTIVITY_SENSOR, *features.FEATURE_SENSORS}
+HTTP_METHODS = frozenset(("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"))
+ingest_seconds = metrics_registry.histogram(
+    "ingest_batch_duration_seconds", "Durata di store_readings per gruppo di letture")
+detector_samples = metrics_registry.counter("anomaly_detector_samples_total", "Letture valutate in linea")
+detector_seconds = metrics_registry.counter("anomaly_detector_seconds_total", "Tempo del rilevamento in linea")
+detector_sample_seconds = metrics_registry.histogram(
+    "anomaly_detector_seconds_per_sample", "Tempo medio per lettura di ogni gruppo", buckets=metrics.SAMPLE_BUCKETS)
+
+with app.app_context():
+    # WAL, busy timeout e mmap su ogni connessione SQLite
+    db_config.apply_sqlite_pragmas(db.engine)
+    metrics.instrument_engine(db.engine, db_queries, db_query_seconds)
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = "login"
 
+# Stato delle finestre per utente/sensore (per processo)
+anomaly_detector = AnomalyDetector()
+# Epoche di attività ancora aperte per utente (per processo, vedi motion.py)
+activity_counter = motion.ActivityCounter()
+# Finestre aperte delle feature di IBI, BVP ed EDA per utente (per processo, vedi features.py)
+feature_extractor = features.FeatureExtractor()
+# Nuove letture e anomalie verso le dashboard aperte (Server-Sent Events)
+live_broker = live.Broker(max_subscribers=app.config["LIVE_MAX_STREAMS"])
+
+# Cache per processo (contatori su /admin/cache)
+user_id_cache = cache.register("user_ids", maxsize=10000, ttl=300)       # username -> user_id
+# Gli username inesistenti solo per pochi secondi: la creazione di un utente svuota
+# questa cache solo nel processo che la esegue, negli altri worker scade da sola
+unknown_user_cache = cache.register("unknown_usernames", maxsize=10000, ttl=5)  # username -> True
+user_cache = cache.register("users", maxsize=10000, ttl=300)             # user_id -> User staccato dalla sessione
+stats_cache = cache.register("dashboard_stats", maxsize=256, ttl=60)     # (user_id, days) -> statistiche
+chart_cache = cache.register("dashboard_charts", maxsize=256, ttl=30)    # (user_id, hours, method) -> grafici
+
+# Numero massimo di letture accettate in una singola richiesta batch
+MAX_BATCH_SIZE = 5000
+# Lunghezza massima di username e sensor_type (come le colonne String(50))
+NAME_MAX_LENGTH = 50
+# Limite al corpo decompresso delle richieste gzip
+MAX_DECOMPRESSED_BYTES = 16 * 1024 * 1024
+# Indici non più usati, rimossi da init_db sui database esistenti
+OBSOLETE_INDEXES = ["ix_sensor_data_anomaly_ts", "ix_sensor_data_anomaly_user_ts", "ix_sensor_block_user_sensor_start"]
+# Punti massimi per serie nei grafici delle dashboard
+CHART_MAX_POINTS = 500
+# Righe per pagina dell'API dello storico (default e massimo)
+HISTORY_PAGE_SIZE = 5000
+HISTORY_MAX_PAGE_SIZE = 50000
+# Punti massimi per serie in ogni evento live (un evento per richiesta di ingestione)
+LIVE_MAX_POINTS = 50
+
+EPOCH = datetime(1970, 1, 1)
+
+# Coda write-behind, creata alla prima lettura ricevuta in modalità asincrona
+_ingest_queue = None
+_ingest_queue_lock = threading.Lock()
+# Client verso gli shard di ingestione, con INGEST_SHARDS
+_shard_client = None
+_shard_client_lock = threading.Lock()
+# Invio delle email di anomalia, creato alla prima anomalia se configurato
+_alert_dispatcher = None
+_alert_dispatcher_lock = threading.Lock()
+
 # ================== MODELLI DB ==================
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -42,11 +210,703 @@ class SensorData(db.Model):
     sensor_type = db.Column(db.String(50))
     value = db.Column(db.Float)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    # Assi dei sensori a tre canali (wrist_acc, in g); value è il modulo del vettore
+    x = db.Column(db.Float)
+    y = db.Column(db.Float)
+    z = db.Column(db.Float)
+
+    __table_args__ = (
+        # Serie temporali e statistiche per utente/sensore; `value` in coda rende
+        # l'indice coprente per le aggregazioni di calculate_stats
+        db.Index("ix_sensor_data_user_sensor_ts", "user_id", "sensor_type", "timestamp", "value"),
+    )
+
+
+class SensorRollup(db.Model):
+    """Aggregati di SensorData per bucket di 1 minuto, 1 ora o 1 giorno (vedi rollups.py)."""
+    __tablename__ = "sensor_rollup"
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    sensor_type = db.Column(db.String(50), primary_key=True)
+    resolution = db.Column(db.String(8), primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+    sum = db.Column(db.Float, nullable=False)
+    sum_sq = db.Column(db.Float, nullable=False)
+    min = db.Column(db.Float, nullable=False)
+    max = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (
+        db.Index("ix_sensor_rollup_resolution_bucket", "resolution", "bucket"),
+    )
+
+
+class SensorBlock(db.Model):
+    """Blocco di letture di un sensore ad alta frequenza (vedi blocks.py)."""
+    __tablename__ = "sensor_block"
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    sensor_type = db.Column(db.String(50), nullable=False)
+    # Inizio del blocco (allineato a BLOCK_SECONDS) e ultimo campione
+    start = db.Column(db.DateTime, nullable=False)
+    end = db.Column(db.DateTime, nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+    channels = db.Column(db.Integer, nullable=False)
+    # Scarti dall'inizio in µs (int32) e valori float32, little endian
+    offsets = db.Column(db.LargeBinary, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    __table_args__ = (
+        # Unico: le scritture concorrenti di un blocco nuovo si riconoscono dal conflitto (vedi BlockStore.write)
+        db.Index("ux_sensor_block_user_sensor_start", "user_id", "sensor_type", "start", unique=True),
+    )
+
+
+class Anomaly(db.Model):
+    """Anomalia rilevata in linea da AnomalyDetector su una lettura ricevuta."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    sensor_type = db.Column(db.String(50), nullable=False)
+    value = db.Column(db.Float, nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
+    anomaly_type = db.Column(db.String(30), nullable=False)
+    severity = db.Column(db.String(10), nullable=False)
+    message = db.Column(db.String(200))
+    detected_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index("ix_anomaly_timestamp", "timestamp"),
+        db.Index("ix_anomaly_user_timestamp", "user_id", "timestamp"),
+    )
+
+
+class DailySummary(db.Model):
+    """Riepilogo giornaliero di un sensore per paziente, calcolato dai rollup (vedi reports.py)."""
+    __tablename__ = "daily_summary"
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    sensor_type = db.Column(db.String(50), primary_key=True)
+    day = db.Column(db.DateTime, primary_key=True)
+    # Risoluzione dei rollup usati: "minute", o "hour" se i minuti erano già eliminati
+    resolution = db.Column(db.String(8), nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+    mean = db.Column(db.Float, nullable=False)
+    std = db.Column(db.Float, nullable=False)
+    min = db.Column(db.Float, nullable=False)
+    max = db.Column(db.Float, nullable=False)
+    p05 = db.Column(db.Float)
+    p25 = db.Column(db.Float)
+    p50 = db.Column(db.Float)
+    p75 = db.Column(db.Float)
+    p95 = db.Column(db.Float)
+    # Minuti con letture e, se il sensore ha un range normale, sotto/dentro/sopra il range
+    minutes = db.Column(db.Integer, nullable=False)
+    minutes_below = db.Column(db.Integer)
+    minutes_in_range = db.Column(db.Integer)
+    minutes_above = db.Column(db.Integer)
+    anomalies = db.Column(db.Integer, nullable=False, default=0)
+    anomalies_high = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index("ix_daily_summary_day", "day"),
+    )
+
+
+# Scritture e letture dei dati grezzi passano dalle partizioni (vedi partitions.py)
+sensor_partitions = partitions.PartitionedTable(SensorData.__table__, app.config["SENSOR_DATA_PARTITIONS"])
+# ... tranne quelli dei sensori in BLOCK_SENSORS
+sensor_blocks = blocks.BlockStore(SensorBlock.__table__, app.config["BLOCK_SENSORS"])
+
+
+def init_db():
+    """Crea le tabelle mancanti e aggiunge gli indici ai database già esistenti."""
+    with db.engine.begin() as conn:
+        sensor_partitions.create_parent(conn)
+    db.create_all()
+    add_missing_columns()
+    # I database creati prima dell'indice unico possono avere blocchi doppi
+    merged = sensor_blocks.merge_duplicates(db.session)
+    db.session.commit()
+    if merged:
+        print(f"🔧 Riuniti {merged} blocchi duplicati in sensor_block")
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    with db.engine.begin() as conn:
+        for name in OBSOLETE_INDEXES:
+            conn.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+
+
+def add_missing_columns():
+    """Aggiunge a sensor_data (e alle sue partizioni SQLite) le colonne nuove del modello."""
+    inspector = inspect(db.engine)
+    names = [SensorData.__tablename__]
+    if db.engine.dialect.name == "sqlite":
+        names += [p.name for p in sensor_partitions.list_partitions(db.session)]
+    with db.engine.begin() as conn:
+        for name in names:
+            existing = {column["name"] for column in inspector.get_columns(name)}
+            for column in SensorData.__table__.columns:
+                if column.name not in existing:
+                    conn.exec_driver_sql(f"ALTER TABLE {name} ADD COLUMN {column.name} "
+                                         f"{column.type.compile(db.engine.dialect)}")
+
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Crea/aggiorna lo schema: flask --app app init-db"""
+    init_db()
+    print("✅ Schema e indici aggiornati")
+
+
+@app.cli.command("backfill-rollups")
+@click.option("--since", type=click.DateTime(formats=["%Y-%m-%d"]), default=None,
+              help="Ricostruisce solo dal giorno indicato (default: dal giorno dei dati grezzi più vecchi)")
+def backfill_rollups_command(since):
+    """Ricalcola i rollup dai dati grezzi: flask --app app backfill-rollups
+
+    Senza --since si parte dal giorno della lettura più vecchia ancora presente: i
+    rollup dei giorni già eliminati dalla retention (allineata al giorno) sono
+    l'unica copia di quei dati e restano com'erano.
+    """
+    if since is None:
+        since = oldest_raw_timestamp()
+        if since is None:
+            print("Nessun dato grezzo: rollup invariati")
+            return
+        since = rollups.truncate(since, "day")
+        print(f"Rollup ricostruiti dal {since:%Y-%m-%d} (dati grezzi più vecchi)")
+    written = rollups.backfill(db.session, raw_source(since), SensorRollup.__table__, since)
+    # Le serie a blocchi non sono in sensor_data: i loro rollup si ricalcolano dai blocchi
+    for user_id, sensor_type in sensor_blocks.series(db.session, since):
+        rebuild_block_rollups(user_id, sensor_type, since)
+    db.session.commit()
+    print("✅ Rollup ricostruiti: " + ", ".join(f"{res}={n}" for res, n in written.items()))
+
+
+def oldest_raw_timestamp():
+    """Istante della lettura grezza più vecchia, in sensor_data (o nelle partizioni) o nei blocchi."""
+    source = raw_source(columns=("timestamp",))
+    oldest = [db.session.execute(select(func.min(source.c.timestamp))).scalar(),
+              db.session.execute(select(func.min(SensorBlock.start))).scalar()]
+    oldest = [ts for ts in oldest if ts is not None]
+    return min(oldest) if oldest else None
+
+
+def rebuild_block_rollups(user_id, sensor_type, since=None, until=None):
+    """Ricostruisce i rollup di una serie a blocchi nei giorni [since, until), decodificando i blocchi."""
+    since = rollups.truncate(since, "day") if since is not None else None
+    until = rollups.truncate(until, "day") if until is not None else None
+    rollups.clear(db.session, SensorRollup.__table__, since, until, user_id, sensor_type)
+    timestamps, values, _ = sensor_blocks.read(db.session, user_id, sensor_type, since, until)
+    rollups.upsert(db.session, SensorRollup.__table__,
+                   rollups.aggregate_series(user_id, sensor_type, timestamps, values))
+
+
+@app.cli.command("rescore-anomalies")
+@click.option("--since", type=click.DateTime(formats=["%Y-%m-%d"]), default=None,
+              help="Ricalcola solo dal giorno indicato (default: tutto lo storico)")
+@click.option("--username", default=None, help="Solo per questo utente (default: tutti)")
+def rescore_anomalies_command(since, username):
+    """Ricalcola le anomalie salvate con le soglie attuali: flask --app app rescore-anomalies
+
+    Ogni serie (utente, sensore) viene valutata per intero con score_series; le
+    finestre ripartono da vuote all'inizio dell'intervallo.
+    """
+    detector = AnomalyDetector(anomaly_detector.window_size, anomaly_detector.z_threshold)
+
+    # Le serie si elencano dai rollup giornalieri, i valori si leggono dalle partizioni della finestra
+    series = db.session.query(SensorRollup.user_id, SensorRollup.sensor_type).filter(
+        SensorRollup.resolution == "day").distinct()
+    if username:
+        user = User.query.filter_by(username=username).first()
+        if not user:
+            raise click.ClickException(f"Utente '{username}' non trovato")
+        series = series.filter(SensorRollup.user_id == user.id)
+    if since is not None:
+        series = series.filter(SensorRollup.bucket >= since)
+
+    total = 0
+    for user_id, sensor_type in series.all():
+        readings, anomalies = rescore_series(detector, user_id, sensor_type, since)
+        db.session.commit()
+        total += anomalies
+        print(f"   utente {user_id} {sensor_type}: {readings:,} letture, {anomalies:,} anomalie")
+    print(f"✅ Anomalie ricalcolate: {total:,}")
+
+
+def rescore_series(detector, user_id, sensor_type, since=None, until=None):
+    """Sostituisce le anomalie della serie in [since, until) con quelle di score_series.
+
+    Non fa commit; restituisce (letture valutate, anomalie salvate).
+    """
+    min_severity = SEVERITY_ORDER[app.config["ANOMALY_MIN_SEVERITY"]]
+    timestamps, values = raw_series(user_id, sensor_type, since, until)
+    valid = ~np.isnan(values)
+    timestamps, values = timestamps[valid], values[valid]
+    scores = detector.score_series(values, sensor_type)
+
+    stale = Anomaly.query.filter(Anomaly.user_id == user_id, Anomaly.sensor_type == sensor_type)
+    stale = _time_window(stale, Anomaly.timestamp, since, until)
+    stale.delete(synchronize_session=False)
+
+    now = datetime.utcnow()
+    anomalies = [{
+        "user_id": user_id,
+        "sensor_type": sensor_type,
+        "value": float(values[i]),
+        "timestamp": timestamps[i].astype(datetime),
+        "anomaly_type": scores["type"][i],
+        "severity": scores["severity"][i],
+        "message": detector.series_message(scores, values, sensor_type, i)[:200],
+        "detected_at": now
+    } for i in np.flatnonzero(scores["is_anomaly"])
+        if SEVERITY_ORDER[scores["severity"][i]] >= min_severity]
+    if anomalies:
+        db.session.execute(Anomaly.__table__.insert(), anomalies)
+    return len(values), len(anomalies)
+
+
+@app.cli.command("import-dataset")
+@click.argument("folder", type=click.Path(exists=True, file_okay=False))
+@click.option("--user", "username", required=True, help="Utente a cui attribuire le letture")
+@click.option("--jobs", type=click.IntRange(min=1), default=1, help="Processi per la lettura dei CSV (uno per file)")
+@click.option("--chunk-rows", type=click.IntRange(min=1000), default=dataset_import.CHUNK_ROWS,
+              help="Righe per blocco in lettura e in scrittura")
+@click.option("--replace", is_flag=True, help="Sostituisce le letture già presenti nello stesso intervallo")
+@click.option("--anomalies/--no-anomalies", default=True, help="Calcola le anomalie delle serie importate")
+def import_dataset_command(folder, username, jobs, chunk_rows, replace, anomalies):
+    """Importa una cartella di CSV sensore: flask --app app import-dataset --user mattia ../dataset_mattia
+
+    Le letture mantengono i timestamp originali; per ogni sensore, dopo la scrittura
+    bulk vengono ricostruiti i rollup dell'utente nei giorni importati e (salvo
+    --no-anomalies) ricalcolate le anomalie dell'intervallo. Un sensore che ha già
+    letture nell'intervallo viene saltato, a meno di --replace.
+    """
+    user = User.query.filter_by(username=username).first()
+    if not user:
+        raise click.ClickException(f"Utente '{username}' non trovato")
+    problems = dataset_import.check_folder(folder)
+    if problems:
+        raise click.ClickException("; ".join(f"{path}: mancano le colonne {', '.join(missing)}"
+                                             for path, missing in problems))
+    detector = AnomalyDetector(anomaly_detector.window_size, anomaly_detector.z_threshold)
+
+    total = 0
+    start = time.perf_counter()
+    for sensor_type, timestamps, values, axes, dropped in dataset_import.read_folder(folder, jobs, chunk_rows):
+        if not len(values):
+            print(f"   {sensor_type}: nessuna lettura valida")
+            continue
+        sensor_start = time.perf_counter()
+        since, until = import_series(user.id, sensor_type, timestamps, values, axes, replace, chunk_rows)
+        if since is None:
+            continue
+        found = rescore_series(detector, user.id, sensor_type, since, until)[1] if anomalies else 0
+        if axes is not None:
+            # Attività per epoca dal modulo, come in ingestione (vedi motion.py)
+            epochs, sums, counts = motion.activity_epochs(timestamps, values)
+            import_series(user.id, motion.ACTIVITY_SENSOR, epochs, sums / counts, None, replace, chunk_rows)
+        for feature, starts, feature_values in features.extract(sensor_type, timestamps, values):
+            # Feature per finestra di IBI, BVP ed EDA (vedi features.py)
+            import_series(user.id, feature, starts, feature_values, None, replace, chunk_rows)
+        db.session.commit()
+
+        total += len(values)
+        elapsed = time.perf_counter() - sensor_start
+        note = f", {dropped:,} righe non valide scartate" if dropped else ""
+        print(f"   {sensor_type}: {len(values):,} letture in {elapsed:.1f}s "
+              f"({len(values) / elapsed:,.0f} righe/s), {found:,} anomalie{note}")
+
+    elapsed = time.perf_counter() - start
+    print(f"✅ Importate {total:,} letture per {username} in {elapsed:.1f}s ({total / max(elapsed, 1e-9):,.0f} righe/s)")
+
+
+def import_series(user_id, sensor_type, timestamps, values, axes, replace, chunk_rows):
+    """Scrive una serie ordinata con INSERT bulk e ricostruisce i suoi rollup nei giorni toccati.
+
+    Restituisce l'intervallo [since, until) scritto, oppure (None, None) se la serie
+    ha già letture nell'intervallo e replace è falso.
+    """
+    since = timestamps[0].astype("datetime64[us]").astype(datetime)
+    until = (timestamps[-1] + np.timedelta64(1, "ms")).astype("datetime64[us]").astype(datetime)
+    if sensor_blocks.handles(sensor_type):
+        return import_block_series(user_id, sensor_type, timestamps, values, axes, replace, since, until)
+
+    tables = sensor_partitions.tables(db.session, since, until)
+    existing = sum(db.session.execute(
+        _time_window(select(func.count()).select_from(table).where(
+            table.c.user_id == user_id, table.c.sensor_type == sensor_type), table.c.timestamp, since, until)
+    ).scalar() for table in tables)
+    if existing and not replace:
+        print(f"   {sensor_type}: saltato, {existing:,} letture già presenti nell'intervallo (usa --replace)")
+        return None, None
+    if existing:
+        for table in tables:
+            db.session.execute(_time_window(table.delete().where(
+                table.c.user_id == user_id, table.c.sensor_type == sensor_type), table.c.timestamp, since, until))
+
+    for offset in range(0, len(values), chunk_rows):
+        chunk = slice(offset, offset + chunk_rows)
+        chunk_ts = timestamps[chunk]
+        for period, first, last in sensor_partitions.split(chunk_ts):
+            part = slice(offset + first, offset + last)
+            dataset_import.bulk_insert(db.session, sensor_partitions.write_table(db.session, period), user_id,
+                                       sensor_type, timestamps[part], values[part],
+                                       axes[part] if axes is not None else None)
+
+    # Rollup dei giorni toccati, ricostruiti dai dati grezzi (comprese eventuali letture live)
+    rollup_until = rollups.truncate(until, "day") + timedelta(days=1)
+    rollups.backfill(db.session, raw_source(since, rollup_until), SensorRollup.__table__,
+                     since, rollup_until, user_id, sensor_type)
+    return since, until
+
+
+def import_block_series(user_id, sensor_type, timestamps, values, axes, replace, since, until):
+    """import_series per i sensori in BLOCK_SENSORS: la serie va nei blocchi e i rollup vengono dai blocchi."""
+    existing = sensor_blocks.count(db.session, user_id, sensor_type, since, until)
+    if existing and not replace:
+        print(f"   {sensor_type}: saltato, {existing:,} letture già presenti nell'intervallo (usa --replace)")
+        return None, None
+    if existing:
+        sensor_blocks.delete(db.session, user_id, sensor_type, since, until)
+    sensor_blocks.write(db.session, user_id, sensor_type, timestamps, axes if axes is not None else values)
+    rebuild_block_rollups(user_id, sensor_type, since, rollups.truncate(until, "day") + timedelta(days=1))
+    return since, until
+
+
+@app.cli.command("check-detector")
+@click.argument("folder", type=click.Path(exists=True, file_okay=False))
+@click.option("--window-size", "window_sizes", type=click.IntRange(min=2), multiple=True,
+              help="Finestre da provare (default: quella del server)")
+def check_detector_command(folder, window_sizes):
+    """Verifica che score_series coincida con add_value: flask --app app check-detector ../dataset_mattia
+
+    Ogni CSV sensore della cartella viene valutato con entrambe le implementazioni
+    (valori come in import-dataset); esce con errore al primo campione diverso.
+    """
+    failures = []
+    for window_size in window_sizes or (anomaly_detector.window_size,):
+        detector = AnomalyDetector(window_size, anomaly_detector.z_threshold)
+        for sensor_type, _, values, _, _ in dataset_import.read_folder(folder):
+            mismatches = detector.streaming_mismatches(values, sensor_type)
+            if mismatches:
+                failures.append(f"{sensor_type} (finestra {window_size}): {len(mismatches)} campioni diversi, "
+                                f"il primo è il numero {mismatches[0]}")
+                print(f"❌ {failures[-1]}")
+            else:
+                print(f"✅ {sensor_type} (finestra {window_size}): {len(values):,} campioni uguali")
+    if failures:
+        raise click.ClickException("score_series diverge da add_value: " + "; ".join(failures))
+
+
+@app.cli.command("maintain")
+@click.option("--retention-days", type=click.IntRange(min=1), default=None,
+              help="Giorni di dati grezzi da conservare (default: RAW_RETENTION_DAYS)")
+@click.option("--minute-rollup-days", type=click.IntRange(min=1), default=None,
+              help="Elimina anche i rollup al minuto più vecchi di questi giorni (ore e giorni restano)")
+@click.option("--archive", "archive_dir", type=click.Path(file_okay=False), default=None,
+              help="Esporta in Parquet in questa cartella ogni intervallo prima di eliminarlo")
+@click.option("--dry-run", is_flag=True, help="Mostra cosa verrebbe eliminato senza modificare nulla")
+def maintain_command(retention_days, minute_rollup_days, archive_dir, dry_run):
+    """Retention dei dati grezzi: flask --app app maintain --retention-days 30
+
+    Prima di eliminare un intervallo verifica che i rollup contengano tutte le sue
+    letture (e in caso contrario li ricostruisce dai dati grezzi); ogni partizione
+    viene piegata ed eliminata in una sola transazione. Con --archive i dati
+    vengono prima esportati (vedi export-archive) e un errore di esportazione
+    interrompe la manutenzione senza eliminare l'intervallo.
+    """
+    retention_days = retention_days or app.config["RAW_RETENTION_DAYS"]
+    if retention_days is None:
+        raise click.ClickException("Indica --retention-days o imposta RAW_RETENTION_DAYS")
+    if db.engine.dialect.name == "postgresql" and not dry_run:
+        # Una sola manutenzione alla volta (lock rilasciato a fine sessione)
+        if not db.session.execute(text("SELECT pg_try_advisory_lock(hashtext('flask-maintain'))")).scalar():
+            raise click.ClickException("Un'altra manutenzione è in corso")
+
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    partitions_found = sensor_partitions.list_partitions(db.session)
+    print(f"🗂️ Partizioni: {len(partitions_found)} ({app.config['SENSOR_DATA_PARTITIONS'] or 'partizionamento disattivato'})")
+    before_delete = None
+    if archive_dir:
+        usernames = dict(db.session.query(User.id, User.username).all())
+
+        def before_delete(table, start, end):
+            rows, files = archive.export(db.session, table, archive_dir, usernames, start, end)
+            print(f"   archiviate {rows:,} righe ({start:%Y-%m-%d} - {end:%Y-%m-%d}) in {files} file")
+
+    try:
+        report = sensor_partitions.apply_retention(db.session, SensorRollup.__table__, cutoff, dry_run,
+                                                   before_delete)
+    except RuntimeError as e:
+        db.session.rollback()
+        raise click.ClickException(str(e))
+    for description, rows, rebuilt in report:
+        if dry_run:
+            print(f"   da eliminare {description}: {rows:,} righe")
+        else:
+            note = " (rollup ricostruiti)" if rebuilt else ""
+            print(f"   eliminato {description}: {rows:,} righe{note}")
+    block_samples = 0
+    if sensor_blocks.sensors:
+        # I rollup dei blocchi sono scritti in ingestione: i blocchi vecchi si eliminano direttamente
+        block_cutoff = rollups.truncate(cutoff, "day")
+        if dry_run:
+            block_samples = sensor_blocks.count_before(db.session, block_cutoff)
+            if block_samples:
+                print(f"   da eliminare blocchi < {block_cutoff:%Y-%m-%d}: {block_samples:,} letture")
+        else:
+            if archive_dir:
+                rows, files = export_block_series(archive_dir, usernames, until=block_cutoff)
+                print(f"   archiviate {rows:,} letture a blocchi in {files} file")
+            block_samples = sensor_blocks.delete_before(db.session, block_cutoff)
+            db.session.commit()
+            if block_samples:
+                print(f"   eliminati blocchi < {block_cutoff:%Y-%m-%d}: {block_samples:,} letture")
+    if not report and not block_samples:
+        print(f"   Nessun dato grezzo prima del {rollups.truncate(cutoff, 'day'):%Y-%m-%d}")
+
+    if minute_rollup_days:
+        minute_cutoff = rollups.truncate(datetime.utcnow() - timedelta(days=minute_rollup_days), "day")
+        if not dry_run:
+            # I riepiloghi giornalieri si calcolano dai minuti: prima di eliminarli
+            summaries = refresh_summaries(until=minute_cutoff)
+            db.session.commit()
+            if summaries:
+                print(f"   riepiloghi giornalieri aggiornati: {summaries:,}")
+        stale = SensorRollup.query.filter(SensorRollup.resolution == "minute", SensorRollup.bucket < minute_cutoff)
+        if dry_run:
+            print(f"   rollup al minuto da eliminare: {stale.count():,}")
+        else:
+            print(f"   rollup al minuto eliminati: {stale.delete(synchronize_session=False):,}")
+            db.session.commit()
+    chart_cache.invalidate()
+    stats_cache.invalidate()
+    print("✅ Manutenzione completata" if not dry_run else "✅ Simulazione completata")
+
+
+@app.cli.command("export-archive")
+@click.argument("dest", type=click.Path(file_okay=False))
+@click.option("--since", type=click.DateTime(formats=["%Y-%m-%d"]), default=None,
+              help="Primo giorno da esportare (default: tutto lo storico)")
+@click.option("--until", type=click.DateTime(formats=["%Y-%m-%d"]), default=None,
+              help="Giorno escluso a cui fermarsi (default: fino all'ultima lettura)")
+@click.option("--username", default=None, help="Solo per questo utente (default: tutti)")
+@click.option("--chunk-rows", type=click.IntRange(min=1000), default=archive.DEFAULT_CHUNK_ROWS,
+              help="Righe lette dal database per blocco")
+def export_archive_command(dest, since, until, username, chunk_rows):
+    """Esporta le letture in Parquet: flask --app app export-archive archivio/ --since 2024-01-01
+
+    I file sono partizionati per utente, sensore e giorno (vedi archive.py) e si
+    rileggono con archive.load_series / archive.load_frame senza il database.
+    """
+    usernames = dict(db.session.query(User.id, User.username).all())
+    user_id = None
+    if username:
+        user_id = next((uid for uid, name in usernames.items() if name == username), None)
+        if user_id is None:
+            raise click.ClickException(f"Utente '{username}' non trovato")
+    start = time.perf_counter()
+    try:
+        rows, files = archive.export(db.session, raw_source(since, until, partitions.READ_COLUMNS + motion.AXES),
+                                     dest, usernames,
+                                     since, until, user_id, chunk_rows)
+        block_rows, block_files = export_block_series(dest, usernames, since, until, user_id)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    rows, files = rows + block_rows, files + block_files
+    elapsed = time.perf_counter() - start
+    print(f"✅ Esportate {rows:,} letture in {files:,} file ({elapsed:.1f}s, {rows / max(elapsed, 1e-9):,.0f} righe/s)")
+
+
+def export_block_series(dest, usernames, since=None, until=None, user_id=None):
+    """Esporta in Parquet le serie a blocchi, un giorno alla volta; restituisce (letture, file)."""
+    since, until = archive.day_window(since, until)
+    rows = files = 0
+    for series_user, sensor_type in sensor_blocks.series(db.session, since):
+        if user_id is not None and series_user != user_id:
+            continue
+        first, last = sensor_blocks.extent(db.session, series_user, sensor_type, until)
+        if first is None:
+            continue
+        day = rollups.truncate(max(first, since) if since is not None else first, "day")
+        while day <= last:
+            timestamps, values, axes = sensor_blocks.read(db.session, series_user, sensor_type,
+                                                          day, day + timedelta(days=1))
+            if len(timestamps):
+                files += archive.export_series(dest, usernames.get(series_user, series_user), sensor_type,
+                                               timestamps, values, axes)
+                rows += len(timestamps)
+            day += timedelta(days=1)
+    return rows, files
+
+
+@app.cli.command("daily-report")
+@click.option("--day", type=click.DateTime(formats=["%Y-%m-%d"]), default=None,
+              help="Giorno del report (default: ieri)")
+@click.option("--to", "recipients", multiple=True, help="Destinatari (default: ALERT_RECIPIENTS)")
+@click.option("--patients", is_flag=True, help="Invia anche a ogni paziente il proprio riepilogo")
+@click.option("--out", type=click.Path(file_okay=False), default=None,
+              help="Scrive i report in questa cartella invece di inviarli")
+@click.option("--refresh-only", is_flag=True, help="Aggiorna solo i riepiloghi giornalieri")
+def daily_report_command(day, recipients, patients, out, refresh_only):
+    """Report giornaliero: flask --app app daily-report (da cron, dopo la mezzanotte UTC)
+
+    Aggiorna i riepiloghi dei giorni cambiati (vedi reports.refresh; solo rollup,
+    mai i dati grezzi) negli ultimi REPORT_LOOKBACK_DAYS giorni, poi costruisce i
+    report dai soli riepiloghi del giorno con i template email/daily_report.*.
+    """
+    day = rollups.truncate(day or datetime.utcnow() - timedelta(days=1), "day")
+    start = time.perf_counter()
+    written = refresh_summaries(day - timedelta(days=app.config["REPORT_LOOKBACK_DAYS"]), day + timedelta(days=1))
+    db.session.commit()
+    print(f"📋 Riepiloghi aggiornati: {written:,} ({time.perf_counter() - start:.1f}s)")
+    if refresh_only:
+        return
+
+    recipients = list(recipients) or app.config["ALERT_RECIPIENTS"]
+    if not out and not app.config["SMTP_HOST"]:
+        raise click.ClickException("Indica --out o imposta SMTP_HOST")
+    users = db.session.query(User.id, User.username, User.email, User.is_admin).all()
+    report = reports.load_report(db.session, DailySummary.__table__, {u.id: u.username for u in users}, day)
+    html_template = app.jinja_env.get_template("email/daily_report.html")
+    text_template = app.jinja_env.get_template("email/daily_report.txt")
+    subject = f"📊 Report Giornaliero - {day:%d/%m/%Y}"
+
+    def render(patients_report):
+        context = {"day": day, "patients": patients_report, "sensor_names": alerts.SENSOR_NAMES}
+        return text_template.render(context), html_template.render(context)
+
+    # (nome del file, destinatari, report): il personale riceve tutti i pazienti
+    messages = []
+    if recipients:
+        messages.append(("tutti", recipients, *render(report)))
+    if patients:
+        emails = {u.username: u.email for u in users if not u.is_admin}
+        messages += [(username, [emails[username]], *render([(username, sensors)]))
+                     for username, sensors in report if emails.get(username)]
+    if not messages:
+        raise click.ClickException("Nessun destinatario: indica --to, --patients o ALERT_RECIPIENTS")
+
+    if out:
+        os.makedirs(out, exist_ok=True)
+        for name, _, text_body, html_body in messages:
+            for extension, body in (("txt", text_body), ("html", html_body)):
+                with open(os.path.join(out, f"report_{day:%Y-%m-%d}_{name}.{extension}"), "w", encoding="utf-8") as f:
+                    f.write(body)
+        print(f"✅ {len(messages)} report di {len(report)} pazienti scritti in {out} "
+              f"({time.perf_counter() - start:.1f}s)")
+        return
+
+    password = app.config["ALERT_SMTP_PASSWORD"]
+    connection = alerts.SMTPConnection(app.config["SMTP_HOST"], app.config["SMTP_PORT"],
+                                       username=app.config["ALERT_SENDER"] if password else None,
+                                       password=password, starttls=app.config["SMTP_STARTTLS"])
+    failed = 0
+    try:
+        for name, to, text_body, html_body in messages:
+            try:
+                connection.send(reports.build_message(app.config["ALERT_SENDER"], to, subject, text_body, html_body))
+            except Exception as e:
+                failed += 1
+                print(f"❌ Invio del report a {', '.join(to)} fallito: {e}")
+    finally:
+        connection.close()
+    print(f"✅ Inviati {len(messages) - failed} report di {len(report)} pazienti "
+          f"({time.perf_counter() - start:.1f}s)")
+
+
+def report_ranges():
+    """{sensor_type: (min, max)} dei range normali del rilevatore, per il tempo nel range."""
+    ranges = {}
+    for sensor_type, base in SENSOR_ALIASES.items():
+        limits = anomaly_detector.sensor_thresholds.get(base)
+        if limits:
+            ranges[sensor_type] = (limits["min"], limits["max"])
+    return ranges
+
+
+def refresh_summaries(since=None, until=None):
+    """Aggiorna i riepiloghi giornalieri cambiati in [since, until); restituisce quelli scritti."""
+    return reports.refresh(db.session, SensorRollup.__table__, Anomaly.__table__, DailySummary.__table__,
+                           since, until, report_ranges())
+
+
+@app.cli.command("ingest-workers")
+@click.option("--shard", "only", type=int, multiple=True, help="Avvia solo questi shard (default: tutti)")
+@click.option("--host", default=None,
+              help="Indirizzo di ascolto al posto dell'host di INGEST_SHARDS (es. 0.0.0.0 in un container)")
+def ingest_workers_command(only, host):
+    """Processi di ingestione per shard: INGEST_SHARDS=... flask --app app ingest-workers
+
+    Un processo per indirizzo di INGEST_SHARDS (o per ogni --shard), riavviato se
+    termina. Ognuno scrive con la propria coda write-behind le letture dei suoi
+    pazienti; SIGTERM o Ctrl+C li fermano dopo aver scritto le letture in coda.
+    """
+    addresses = app.config["INGEST_SHARDS"]
+    if not addresses:
+        raise click.ClickException("Imposta INGEST_SHARDS (es. 127.0.0.1:7101,127.0.0.1:7102)")
+    indexes = list(only) or list(range(len(addresses)))
+    if any(not 0 <= i < len(addresses) for i in indexes):
+        raise click.ClickException(f"Shard fuori intervallo: INGEST_SHARDS ne ha {len(addresses)}")
+
+    # spawn: ogni shard apre le proprie connessioni al database, senza ereditare quelle del padre
+    context = multiprocessing.get_context("spawn")
+    processes = {}
+
+    def start(index):
+        process = context.Process(target=run_ingest_shard, args=(index, host), name=f"ingest-shard-{index}")
+        process.start()
+        processes[index] = process
+
+    stopping = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stopping.set())
+    for index in indexes:
+        start(index)
+    while not stopping.wait(1):
+        for index, process in list(processes.items()):
+            if not process.is_alive():
+                print(f"⚠️ Shard {index} terminato (codice {process.exitcode}), riavvio")
+                start(index)
+    for process in processes.values():
+        process.terminate()
+    for process in processes.values():
+        process.join(60)
+    print(f"✅ Shard di ingestione fermati ({len(processes)})")
+
+
+def run_ingest_shard(index, host=None):
+    """Processo di uno shard: riceve le letture dai front-end e le scrive con la propria coda."""
+    address = shards.parse_address(app.config["INGEST_SHARDS"][index])
+    if host and isinstance(address, tuple):
+        address = (host, address[1])
+    # Tutte le letture dei pazienti dello shard passano da qui: le finestre delle feature sono complete
+    app.config["ONLINE_FEATURES"] = True
+    ingest_queue = get_ingest_queue()
+    server = shards.ShardServer(address, app.config["INGEST_SHARD_AUTHKEY"], ingest_queue.submit,
+                                ingest_queue.metrics)
+    # Eventi live verso le dashboard servite dai front-end (connessioni "watch")
+    live_broker.add_relay(server.watched, server.publish)
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: server.close())
+    print(f"🧩 Shard {index}/{len(app.config['INGEST_SHARDS'])} in ascolto su {address} (pid {os.getpid()})")
+    server.serve_forever()
+    ingest_queue.close()
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # In cache c'è una copia staccata dalla sessione: merge(load=False) la ricollega
+    # alla sessione della richiesta senza SELECT
+    user = user_cache.get(int(user_id))
+    if user is cache.MISSING:
+        user = db.session.get(User, int(user_id))
+        if user is None:
+            return None
+        db.session.expunge(user)
+        user_cache.set(user.id, user)
+    return db.session.merge(user, load=False)
 
 # ================== LOGIN ==================
 @app.route("/")
@@ -85,14 +945,15 @@ def user_dashboard():
     if current_user.is_admin:
         return redirect(url_for("admin_dashboard"))
 
-    stats_week = calculate_stats(days=7, user=current_user)
-    chart_data = prepare_chart_data(user=current_user)
+    stats_week = cached_stats(days=7, user=current_user)
+    chart_data = cached_chart_data(user=current_user)
     anomalies = get_recent_anomalies(user=current_user)
 
     return render_template(
         "user_dashboard.html",
         stats_week=stats_week,
-        chart_data=json.dumps(chart_data),
+        chart_data=chart_data,
+        usernames={current_user.id: current_user.username},
         anomalies=anomalies,
         current_user=current_user
     )
@@ -105,20 +966,267 @@ def admin_dashboard():
         flash("Accesso negato", "danger")
         return redirect(url_for("user_dashboard"))
 
-    stats_week = calculate_stats(days=7)
-    chart_data = prepare_chart_data()
+    stats_week = cached_stats(days=7)
+    chart_data = cached_chart_data()
     anomalies = get_recent_anomalies()
     users = User.query.all()
 
     return render_template(
         "admin_dashboard.html",
         stats_week=stats_week,
-        chart_data=json.dumps(chart_data),
+        chart_data=chart_data,
+        usernames={u.id: u.username for u in users},
         anomalies=anomalies,
         users=users,
         current_user=current_user
     )
 
+@app.route("/api/stream")
+@login_required
+def live_stream():
+    """Stream SSE delle nuove letture e anomalie: l'utente vede le proprie, l'admin tutte."""
+    subscriber = live_broker.subscribe(None if current_user.is_admin else current_user.id)
+    if subscriber is None:
+        # Tutti gli stream del processo occupati: il browser (EventSource) riprova da solo
+        return {"error": "Too many live streams, retry later"}, 503, {"Retry-After": "10"}
+    if app.config["INGEST_SHARDS"]:
+        # Le letture si scrivono negli shard: da lì arrivano gli eventi live
+        start_shard_watch()
+    return Response(live_broker.stream(subscriber), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route("/api/users/<int:user_id>/sensors/<sensor_type>")
+@login_required
+def sensor_history(user_id, sensor_type):
+    """Storico di una serie a pagine, in JSON o NDJSON (?format=ndjson o Accept: application/x-ndjson).
+
+    Parametri: from, to (epoch in ms o ISO 8601; to escluso), resolution
+    (raw, minute, hour, day o auto: la più fine con al massimo ?points= punti),
+    limit (righe per pagina) e cursor (next_cursor della pagina precedente).
+    La risposta è scritta mentre si legge dal database; l'ETag cambia con le
+    letture della finestra e Last-Modified è l'istante della lettura più recente
+    (o dell'ultimo bucket orario, se i dati grezzi non ci sono più): con
+    If-None-Match o, in sua assenza, If-Modified-Since risponde 304.
+    """
+    if not current_user.is_admin and current_user.id != user_id:
+        return {"error": "Forbidden"}, 403
+    try:
+        since = parse_timestamp(request.args["from"]) if "from" in request.args else None
+        until = parse_timestamp(request.args["to"]) if "to" in request.args else None
+        cursor = history.decode_cursor(request.args["cursor"]) if "cursor" in request.args else None
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    requested = request.args.get("resolution", "raw")
+    if requested not in history.RESOLUTIONS + ("auto",):
+        return {"error": f"Invalid resolution, expected one of: {', '.join(history.RESOLUTIONS + ('auto',))}"}, 400
+    limit = request.args.get("limit", HISTORY_PAGE_SIZE, type=int)
+    if not 1 <= limit <= HISTORY_MAX_PAGE_SIZE:
+        return {"error": f"limit must be between 1 and {HISTORY_MAX_PAGE_SIZE}"}, 400
+    ndjson = (request.args.get("format") == "ndjson"
+              or request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"])
+              == "application/x-ndjson")
+
+    count, total, first_bucket, last_bucket = history_version_query(user_id, sensor_type, since, until).one()
+    first, last = series_extent(user_id, sensor_type, until)
+    if last is not None and since is not None and last < since:
+        first = last = None
+    if first is None and first_bucket is not None:
+        # Dati grezzi già eliminati dalla retention: restano i rollup
+        first, last = first_bucket, last_bucket + timedelta(hours=1)
+    resolution = history.choose_resolution(requested, since, until, count or 0,
+                                           request.args.get("points", CHART_MAX_POINTS, type=int),
+                                           extent=lambda: (first, last))
+    # Cambia con ogni lettura scritta o eliminata nella finestra (i rollup orari sono nella stessa transazione)
+    etag = hashlib.sha1(repr((user_id, sensor_type, since, until, resolution, request.args.get("cursor"),
+                              limit, ndjson, count, total, last_bucket)).encode()).hexdigest()
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "private, no-cache", "Vary": "Accept, Cookie",
+               "X-Resolution": resolution}
+    modified = None
+    if last is not None:
+        # Le date HTTP hanno la precisione del secondo
+        modified = min(last, until or last).replace(microsecond=0, tzinfo=timezone.utc)
+        headers["Last-Modified"] = http_date(modified)
+    if request.if_none_match:
+        if etag in request.if_none_match:
+            return Response(status=304, headers=headers)
+    elif modified is not None and request.if_modified_since is not None and modified <= request.if_modified_since:
+        return Response(status=304, headers=headers)
+
+    if resolution != "raw":
+        rows = history.rollup_rows(db.session, SensorRollup.__table__, user_id, sensor_type, resolution,
+                                   since, until, cursor)
+    elif sensor_blocks.handles(sensor_type):
+        rows = history.block_rows(db.session, sensor_blocks, user_id, sensor_type, since, until, cursor)
+    else:
+        source = raw_source(since, until, partitions.READ_COLUMNS + ("id",))
+        rows = history.raw_rows(db.session, source, user_id, sensor_type, since, until, cursor)
+    pages = history.paginate(rows, limit)
+    if ndjson:
+        body, mimetype = history.ndjson_stream(pages), "application/x-ndjson"
+    else:
+        meta = {"user_id": user_id, "sensor_type": sensor_type, "resolution": resolution,
+                "from": since.isoformat() if since else None, "to": until.isoformat() if until else None}
+        body, mimetype = history.json_stream(meta, pages), "application/json"
+    return Response(stream_with_context(body), mimetype=mimetype, headers=headers)
+
+
+@app.route("/admin/ingest")
+@login_required
+def ingest_stats():
+    """Profondità della coda di ingestione e latenza dei commit (JSON)."""
+    if not current_user.is_admin:
+        return {"error": "Forbidden"}, 403
+    return {"async": app.config["INGEST_ASYNC"],
+            "queue": _ingest_queue.metrics() if _ingest_queue is not None else None,
+            "shards": get_shard_client().stats() if app.config["INGEST_SHARDS"] else None,
+            "alerts": _alert_dispatcher.metrics() if _alert_dispatcher is not None else None}
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Metriche del processo in formato Prometheus.
+
+    Senza login, come d'uso per lo scraping: contiene solo contatori e tempi, nessun dato dei pazienti.
+    """
+    return Response(metrics_registry.render(), mimetype=metrics.CONTENT_TYPE)
+
+
+def collect_runtime_metrics():
+    """Cache e coda di ingestione, lette al momento dell'esposizione."""
+    hits = metrics.Counter("cache_hits_total", "Hit delle cache del processo", ("cache",))
+    misses = metrics.Counter("cache_misses_total", "Miss delle cache del processo", ("cache",))
+    evictions = metrics.Counter("cache_evictions_total", "Voci espulse dalle cache", ("cache",))
+    size = metrics.Gauge("cache_entries", "Voci nelle cache", ("cache",))
+    for name, entry in cache.stats().items():
+        hits.inc(entry["hits"], cache=name)
+        misses.inc(entry["misses"], cache=name)
+        evictions.inc(entry["evictions"] + entry["expirations"], cache=name)
+        size.set(entry["size"], cache=name)
+    collected = [hits, misses, evictions, size]
+    if _ingest_queue is not None:
+        queue = _ingest_queue.metrics()
+        depth = metrics.Gauge("ingest_queue_depth", "Letture in coda")
+        depth.set(queue["depth"])
+        written = metrics.Counter("ingest_queue_written_total", "Letture scritte dalla coda")
+        written.inc(queue["written"])
+        rejected = metrics.Counter("ingest_queue_rejected_total", "Letture rifiutate a coda piena")
+        rejected.inc(queue["rejected"])
+        failed = metrics.Counter("ingest_queue_failed_total", "Letture perse per errori di scrittura")
+        failed.inc(queue["failed"])
+        collected += [depth, written, rejected, failed]
+    if app.config["INGEST_SHARDS"]:
+        shard_up = metrics.Gauge("ingest_shard_up", "Shard di ingestione raggiungibili", ("shard",))
+        shard_depth = metrics.Gauge("ingest_shard_queue_depth", "Letture in coda negli shard", ("shard",))
+        shard_written = metrics.Counter("ingest_shard_written_total", "Letture scritte dagli shard", ("shard",))
+        shard_rejected = metrics.Counter("ingest_shard_rejected_total", "Letture rifiutate a coda piena", ("shard",))
+        for shard, state in enumerate(get_shard_client().stats()):
+            shard_up.set(int(state is not None), shard=shard)
+            if state is not None:
+                shard_depth.set(state["depth"], shard=shard)
+                shard_written.inc(state["written"], shard=shard)
+                shard_rejected.inc(state["rejected"], shard=shard)
+        collected += [shard_up, shard_depth, shard_written, shard_rejected]
+    if _alert_dispatcher is not None:
+        state = _alert_dispatcher.metrics()
+        alert_counts = metrics.Counter("alerts_total", "Anomalie passate al dispatcher email", ("outcome",))
+        for outcome in ("submitted", "dropped", "suppressed"):
+            alert_counts.inc(state[outcome], outcome=outcome)
+        emails = metrics.Counter("alert_emails_total", "Email di riepilogo", ("outcome",))
+        emails.inc(state["sent"], outcome="sent")
+        emails.inc(state["failed"], outcome="failed")
+        connections = metrics.Counter("alert_smtp_connections_total", "Connessioni SMTP aperte")
+        connections.inc(state["connections"])
+        pending = metrics.Gauge("alerts_pending", "Anomalie in attesa di riepilogo")
+        pending.set(state["pending"])
+        collected += [alert_counts, emails, connections, pending]
+    return collected
+
+
+metrics_registry.add_collector(collect_runtime_metrics)
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    metrics.start_request()
+    if app.config["PROFILER_ENABLED"] and request.args.get("profile") == "1":
+        g.profiler = metrics.SamplingProfiler(interval=app.config["PROFILER_INTERVAL_MS"] / 1000).start()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Latenza e query SQL per route; con ?profile=1 la risposta diventa il profilo della richiesta."""
+    elapsed = time.perf_counter() - g.request_start
+    queries, db_seconds = metrics.finish_request()
+    # Le route inesistenti non creano una serie per ogni percorso
+    endpoint = request.endpoint or "unmatched"
+    method = request.method if request.method in HTTP_METHODS else "OTHER"
+    request_seconds.observe(elapsed, method=method, endpoint=endpoint, status=response.status_code)
+    request_queries.observe(queries, endpoint=endpoint)
+    request_db_seconds.observe(db_seconds, endpoint=endpoint)
+    response.headers["Server-Timing"] = (f'db;dur={db_seconds * 1000:.1f};desc="{queries} query", '
+                                         f"app;dur={elapsed * 1000:.1f}")
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        report = profiler.stop().report()
+        return Response(f"# {request.method} {request.full_path} -> {response.status_code}, "
+                        f"{queries} query SQL in {db_seconds * 1000:.1f} ms\n" + report,
+                        mimetype="text/plain")
+    return response
+
+
+@app.teardown_request
+def stop_request_metrics(exc):
+    # Richieste terminate da un'eccezione: after_request non viene chiamato
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.stop()
+    metrics.finish_request()
+
+
+@app.route("/admin/cache")
+@login_required
+def cache_stats():
+    """Hit, miss, espulsioni e invalidazioni delle cache del processo (JSON)."""
+    if not current_user.is_admin:
+        return {"error": "Forbidden"}, 403
+    return cache.stats()
+
+
+def chart_window_args():
+    """Finestra e metodo dei grafici dai parametri ?hours=&method= della dashboard."""
+    args = {}
+    hours = request.args.get("hours", type=float)
+    if hours:
+        args["since"] = datetime.utcnow() - timedelta(hours=hours)
+    method = request.args.get("method")
+    if method in downsample.METHODS:
+        args["method"] = method
+    return args
+
+
+def cached_stats(days, user=None):
+    """calculate_stats con cache per utente e finestra, aggiornata dalle nuove letture."""
+    key = (user.id if user else None, days)
+    entry = stats_cache.get(key)
+    if entry is cache.MISSING:
+        since = datetime.utcnow() - timedelta(days=days)
+        usernames = stats_usernames(user)
+        entry = {"since": since, "usernames": usernames, "stats": calculate_stats(days, user, usernames)}
+        stats_cache.set(key, entry)
+    return entry["stats"]
+
+
+def cached_chart_data(user=None):
+    """prepare_chart_data con cache per utente, ?hours= e ?method=; invalidata dalle nuove letture."""
+    key = (user.id if user else None, request.args.get("hours", type=float), request.args.get("method"))
+    chart_data = chart_cache.get(key)
+    if chart_data is cache.MISSING:
+        chart_data = prepare_chart_data(user=user, **chart_window_args())
+        chart_cache.set(key, chart_data)
+    return chart_data
+
 # ================== CREAZIONE UTENTI ==================
 @app.route("/admin/create_user", methods=["GET", "POST"])
 @login_required
@@ -150,6 +1258,10 @@ def create_user():
             new_user.set_password(password)
             db.session.add(new_user)
             db.session.commit()
+            # Lo username poteva essere in cache come inesistente; le dashboard admin elencano gli utenti
+            unknown_user_cache.pop(username)
+            stats_cache.invalidate(lambda key: key[0] is None)
+            chart_cache.invalidate(lambda key: key[0] is None)
             flash(f"Utente '{username}' creato con successo!", "success")
             return redirect(url_for("admin_dashboard"))
         except Exception as e:
@@ -166,52 +1278,525 @@ def receive_data():
     if not data:
         return {"error": "No data provided"}, 400
 
-    username = data.get("username")
-    sensor_type = data.get("sensor_type")
-    value = data.get("value")
+    try:
+        # Il timestamp è quello di arrivo, come sempre per le letture singole
+        username, sensor_type, value, _, axes = parse_reading({**data, "timestamp": None}
+                                                             if isinstance(data, dict) else data)
+    except ValueError as e:
+        return {"error": str(e)}, 400
 
-    if not username or not sensor_type or value is None:
-        return {"error": "Invalid data"}, 400
-
-    user = User.query.filter_by(username=username).first()
-    if not user:
+    user_id = resolve_user_ids({username}).get(username)
+    if user_id is None:
         return {"error": f"User '{username}' not found"}, 404
 
-    sensor_entry = SensorData(user_id=user.id, sensor_type=sensor_type, value=float(value))
-    db.session.add(sensor_entry)
-    db.session.commit()
+    rows = [reading_row(user_id, sensor_type, value, datetime.utcnow(), axes)]
+    if app.config["INGEST_ASYNC"]:
+        if not enqueue_readings(rows):
+            return queue_full_response()
+        return {"status": "queued"}, 202
+    store_readings(rows)
 
     return {"status": "success"}, 200
 
+
+@app.route("/api/data/batch", methods=["POST"])
+def receive_data_batch():
+    """Riceve un array di letture (anche di più utenti/sensori) e le salva con un solo commit.
+
+    Il corpo può essere una lista di letture, {"readings": [...]} oppure il formato
+    colonnare {"series": [{"username", "sensor_type", "timestamps", "values"}, ...]},
+    eventualmente compresso con Content-Encoding: gzip. Le letture a tre assi hanno
+    "value": [x, y, z], oppure nel formato colonnare "axes": {"x": [...], "y": [...], "z": [...]}
+    al posto di "values".
+    """
+    data = load_json_body()
+    if isinstance(data, dict):
+        if "series" in data:
+            try:
+                data = expand_series(data["series"])
+            except ValueError as e:
+                return {"error": str(e)}, 400
+        else:
+            data = data.get("readings")
+    if not data or not isinstance(data, list):
+        return {"error": "No data provided"}, 400
+    if len(data) > MAX_BATCH_SIZE:
+        return {"error": f"Batch too large (max {MAX_BATCH_SIZE} readings)"}, 413
+
+    # 1. Validazione in un solo passaggio
+    results = [None] * len(data)
+    parsed = []
+    for index, item in enumerate(data):
+        try:
+            parsed.append((index, parse_reading(item)))
+        except ValueError as e:
+            results[index] = {"index": index, "status": "rejected", "error": str(e)}
+
+    # 2. Risoluzione degli username con una sola query
+    user_ids = resolve_user_ids({reading[0] for _, reading in parsed})
+
+    # 3. Inserimento bulk e commit unico
+    rows = []
+    for index, (username, sensor_type, value, timestamp, axes) in parsed:
+        user_id = user_ids.get(username)
+        if user_id is None:
+            results[index] = {"index": index, "status": "rejected", "error": f"User '{username}' not found"}
+            continue
+        rows.append(reading_row(user_id, sensor_type, value, timestamp, axes))
+        results[index] = {"index": index, "status": "accepted"}
+
+    status = 200
+    if rows and app.config["INGEST_ASYNC"]:
+        if not enqueue_readings(rows):
+            return queue_full_response()
+        status = 202
+    elif rows:
+        store_readings(rows)
+
+    return {
+        "status": "queued" if status == 202 else "success",
+        "accepted": len(rows),
+        "rejected": len(data) - len(rows),
+        "results": results
+    }, status
+
+
+def get_ingest_queue():
+    """Coda write-behind del processo, configurata da INGEST_* alla prima chiamata."""
+    global _ingest_queue
+    with _ingest_queue_lock:
+        if _ingest_queue is None:
+            _ingest_queue = WriteBehindQueue(
+                write_readings,
+                max_rows=app.config["INGEST_QUEUE_MAX_ROWS"],
+                group_rows=app.config["INGEST_GROUP_ROWS"],
+                max_latency=app.config["INGEST_GROUP_MAX_LATENCY_MS"] / 1000
+            )
+            # Allo spegnimento (Ctrl+C, SIGTERM di gunicorn) si scrivono le letture in coda
+            atexit.register(_ingest_queue.close)
+    return _ingest_queue
+
+
+def get_shard_client():
+    """Client del processo verso gli shard di INGEST_SHARDS."""
+    global _shard_client
+    with _shard_client_lock:
+        if _shard_client is None:
+            _shard_client = shards.ShardClient(app.config["INGEST_SHARDS"], app.config["INGEST_SHARD_AUTHKEY"])
+    return _shard_client
+
+
+def start_shard_watch():
+    """Alla prima dashboard live del processo, riceve dagli shard gli eventi delle letture scritte."""
+    client = get_shard_client()
+    with _shard_client_lock:
+        if not client._watchers:
+            client.watch(live_broker.deliver)
+
+
+def enqueue_readings(rows):
+    """Accoda le letture nel processo o, con INGEST_SHARDS, negli shard dei pazienti; False se rifiutate."""
+    if not app.config["INGEST_SHARDS"]:
+        return get_ingest_queue().submit(rows)
+    try:
+        return get_shard_client().submit(rows)
+    except shards.ShardUnavailable as e:
+        app.logger.warning("Shard di ingestione non disponibile: %s", e)
+        return False
+
+
+def get_alert_dispatcher():
+    """Dispatcher email del processo, None se SMTP_HOST o ALERT_RECIPIENTS mancano."""
+    global _alert_dispatcher
+    if not app.config["SMTP_HOST"] or not app.config["ALERT_RECIPIENTS"]:
+        return None
+    with _alert_dispatcher_lock:
+        if _alert_dispatcher is None:
+            password = app.config["ALERT_SMTP_PASSWORD"]
+            connection = alerts.SMTPConnection(
+                app.config["SMTP_HOST"], app.config["SMTP_PORT"],
+                username=app.config["ALERT_SENDER"] if password else None, password=password,
+                starttls=app.config["SMTP_STARTTLS"])
+            _alert_dispatcher = alerts.AlertDispatcher(
+                connection, app.config["ALERT_SENDER"], app.config["ALERT_RECIPIENTS"],
+                user_label=alert_user_label,
+                digest_seconds=app.config["ALERT_DIGEST_SECONDS"],
+                cooldown_seconds=app.config["ALERT_COOLDOWN_SECONDS"])
+            # Allo spegnimento si inviano i riepiloghi aperti
+            atexit.register(_alert_dispatcher.close)
+    return _alert_dispatcher
+
+
+def alert_user_label(user_id):
+    """Nome del paziente nelle email (chiamata dal thread del dispatcher)."""
+    with app.app_context():
+        user = db.session.get(User, user_id)
+        return user.username if user else f"utente {user_id}"
+
+
+def send_alerts(anomalies):
+    """Passa al dispatcher email le anomalie abbastanza gravi; non attende l'invio."""
+    dispatcher = get_alert_dispatcher()
+    if dispatcher is None or not anomalies:
+        return
+    min_severity = SEVERITY_ORDER[app.config["ALERT_MIN_SEVERITY"]]
+    dispatcher.submit([a for a in anomalies if SEVERITY_ORDER[a["severity"]] >= min_severity])
+
+
+def write_readings(rows):
+    """Writer della coda: un gruppo di letture, un commit (fuori dal contesto della richiesta)."""
+    with app.app_context():
+        store_readings(rows)
+
+
+def queue_full_response():
+    return ({"error": "Ingest queue full, retry later"}, app.config["INGEST_QUEUE_FULL_STATUS"],
+            {"Retry-After": "1"})
+
+
+def store_readings(rows):
+    """Inserisce le letture, aggiorna i rollup e salva le anomalie nella stessa transazione.
+
+    Le letture a tre assi ricevono qui il modulo come valore; le epoche di attività
+    e, con ONLINE_FEATURES, le finestre di feature (HRV, frequenza da BVP, EDA)
+    chiuse dal batch vengono salvate insieme alle letture. Dopo il commit le anomalie
+    gravi vanno al dispatcher email, che le invia in un altro thread (vedi alerts.py).
+    """
+    start = time.perf_counter()
+    derived = motion.derive(rows, activity_counter)
+    if app.config["ONLINE_FEATURES"]:
+        derived += features.derive(rows, feature_extractor)
+    stored = rows + derived
+    if sensor_blocks.sensors:
+        sensor_partitions.insert(db.session, [r for r in stored if not sensor_blocks.handles(r["sensor_type"])])
+        sensor_blocks.write_rows(db.session, [r for r in stored if sensor_blocks.handles(r["sensor_type"])])
+    else:
+        sensor_partitions.insert(db.session, stored)
+    rollups.upsert(db.session, SensorRollup.__table__, rollups.aggregate(stored))
+    anomalies = []
+    if app.config["ANOMALY_DETECTION"]:
+        detect_start = time.perf_counter()
+        anomalies = detect_anomalies(rows)
+        detect_elapsed = time.perf_counter() - detect_start
+        detector_samples.inc(len(rows))
+        detector_seconds.inc(detect_elapsed)
+        detector_sample_seconds.observe(detect_elapsed / len(rows))
+        if anomalies:
+            db.session.execute(Anomaly.__table__.insert(), anomalies)
+    db.session.commit()
+    ingest_seconds.observe(time.perf_counter() - start)
+    for sensor_type, n in collections.Counter(
+            row["sensor_type"] if row["sensor_type"] in METRIC_SENSOR_TYPES else "other" for row in stored).items():
+        ingest_rows.inc(n, sensor_type=sensor_type)
+    refresh_dashboard_caches(stored)
+    publish_live(stored, anomalies)
+    send_alerts(anomalies)
+
+
+def refresh_dashboard_caches(rows):
+    """Aggiorna le statistiche in cache con le nuove letture e invalida i grafici degli utenti coinvolti."""
+    totals = {}
+    for row in rows:
+        key = (row["user_id"], row["sensor_type"])
+        agg = totals.get(key)
+        value = row["value"]
+        if agg is None:
+            totals[key] = [row["timestamp"], 1, value, value, value]
+        else:
+            agg[0] = min(agg[0], row["timestamp"])
+            agg[1] += 1
+            agg[2] += value
+            agg[3] = min(agg[3], value)
+            agg[4] = max(agg[4], value)
+    user_ids = {user_id for user_id, _ in totals}
+
+    def merge(key, entry):
+        stats = {username: dict(sensors) for username, sensors in entry["stats"].items()}
+        for (user_id, sensor_type), (first, count, total, vmin, vmax) in totals.items():
+            if key[0] not in (None, user_id):
+                continue
+            if first < entry["since"]:
+                # Letture fuori finestra: meglio ricalcolare che indovinare
+                return cache.MISSING
+            username = entry["usernames"].get(user_id)
+            if username is None:
+                return cache.MISSING
+            old = stats[username].get(sensor_type)
+            if old is None:
+                stats[username][sensor_type] = {"mean": total / count, "min": vmin, "max": vmax, "count": count}
+            else:
+                n = old["count"] + count
+                stats[username][sensor_type] = {
+                    "mean": (old["mean"] * old["count"] + total) / n,
+                    "min": min(old["min"], vmin),
+                    "max": max(old["max"], vmax),
+                    "count": n
+                }
+        return {**entry, "stats": stats}
+
+    stats_cache.update(lambda key: key[0] is None or key[0] in user_ids, merge)
+    chart_cache.invalidate(lambda key: key[0] is None or key[0] in user_ids)
+
+
+def publish_live(rows, anomalies):
+    """Invia alle dashboard in ascolto le nuove letture (ridotte) e le anomalie salvate."""
+    watched = live_broker.watched_users()
+    if not watched:
+        return
+
+    series = {}
+    for row in rows:
+        if None in watched or row["user_id"] in watched:
+            series.setdefault((row["user_id"], row["sensor_type"]), []).append((row["timestamp"], row["value"]))
+    for (user_id, sensor_type), points in series.items():
+        points.sort(key=lambda p: p[0])
+        x = np.fromiter(((t - EPOCH).total_seconds() for t, _ in points), np.float64, len(points))
+        y = np.fromiter((v for _, v in points), np.float64, len(points))
+        picked = downsample.downsample(x, y, LIVE_MAX_POINTS)
+        live_broker.publish(user_id, "readings", {
+            "user_id": user_id,
+            "sensor_type": sensor_type,
+            "timestamps": [points[i][0].isoformat(timespec="milliseconds") for i in picked],
+            "values": y[picked].tolist()
+        })
+
+    for anomaly in anomalies:
+        live_broker.publish(anomaly["user_id"], "anomaly", {
+            "user_id": anomaly["user_id"],
+            "sensor_type": anomaly["sensor_type"],
+            "value": anomaly["value"],
+            "timestamp": anomaly["timestamp"].isoformat(timespec="milliseconds"),
+            "anomaly_type": anomaly["anomaly_type"],
+            "severity": anomaly["severity"],
+            "message": anomaly["message"]
+        })
+
+
+def detect_anomalies(rows):
+    """Passa le letture al rilevatore in ordine di tempo; restituisce le anomalie da salvare."""
+    min_severity = SEVERITY_ORDER[app.config["ANOMALY_MIN_SEVERITY"]]
+    anomalies = []
+    for row in sorted(rows, key=lambda r: r["timestamp"]):
+        result = anomaly_detector.add_value(row["user_id"], row["sensor_type"], row["value"])
+        if not result:
+            continue
+        top = result["anomalies"][0]
+        if SEVERITY_ORDER[top["severity"]] < min_severity:
+            continue
+        anomalies.append({
+            "user_id": row["user_id"],
+            "sensor_type": row["sensor_type"],
+            "value": row["value"],
+            "timestamp": row["timestamp"],
+            "anomaly_type": top["type"],
+            "severity": top["severity"],
+            "message": top["message"][:200],
+            "detected_at": datetime.utcnow()
+        })
+    return anomalies
+
+
+def load_json_body():
+    """Legge il corpo JSON della richiesta, decomprimendolo se inviato in gzip."""
+    raw = request.get_data()
+    if request.headers.get("Content-Encoding", "").lower() == "gzip":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            raw = decompressor.decompress(raw, MAX_DECOMPRESSED_BYTES)
+        except zlib.error:
+            return None
+        if decompressor.unconsumed_tail:
+            return None
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return None
+
+
+def expand_series(series):
+    """Espande il formato colonnare in una lista di letture singole."""
+    if not isinstance(series, list):
+        raise ValueError("Invalid series")
+    readings = []
+    for s in series:
+        if not isinstance(s, dict):
+            raise ValueError("Invalid series")
+        timestamps = s.get("timestamps")
+        values = s.get("values")
+        if "axes" in s:
+            values = expand_axes(s["axes"])
+        if not isinstance(values, list) or not isinstance(timestamps, list) or len(timestamps) != len(values):
+            raise ValueError("Invalid series: 'timestamps' and 'values' must be lists of the same length")
+        username = s.get("username")
+        sensor_type = s.get("sensor_type")
+        readings.extend(
+            {"username": username, "sensor_type": sensor_type, "value": v, "timestamp": t}
+            for t, v in zip(timestamps, values)
+        )
+        if len(readings) > MAX_BATCH_SIZE:
+            break
+    return readings
+
+
+def expand_axes(axes):
+    """{"x": [...], "y": [...], "z": [...]} -> [[x, y, z], ...]"""
+    if not isinstance(axes, dict) or not all(isinstance(axes.get(axis), list) for axis in motion.AXES):
+        raise ValueError("Invalid series: 'axes' must have lists 'x', 'y' and 'z'")
+    x, y, z = (axes[axis] for axis in motion.AXES)
+    if not len(x) == len(y) == len(z):
+        raise ValueError("Invalid series: 'axes' lists must have the same length")
+    return [list(v) for v in zip(x, y, z)]
+
+
+def parse_value(raw, sensor_type):
+    """Valore scalare oppure [x, y, z] (solo per motion.ACC_SENSOR); restituisce (valore, assi o None).
+
+    Per le letture a tre assi il valore è None: il modulo si calcola in store_readings.
+    """
+    if isinstance(raw, (list, tuple)):
+        if sensor_type != motion.ACC_SENSOR or len(raw) != len(motion.AXES):
+            raise ValueError("Invalid value")
+        axes = tuple(parse_scalar(v) for v in raw)
+        return None, axes
+    return parse_scalar(raw), None
+
+
+def parse_scalar(raw):
+    """Valore numerico finito; ValueError per tipi non numerici, NaN, infiniti e interi fuori dai float."""
+    if isinstance(raw, (bool, list, tuple, dict)):
+        raise ValueError("Invalid value")
+    try:
+        value = float(raw)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError("Invalid value")
+    if not math.isfinite(value):
+        raise ValueError("Invalid value")
+    return value
+
+
+def parse_name(raw, field):
+    """Username o sensor_type: stringa non vuota entro NAME_MAX_LENGTH caratteri."""
+    if not isinstance(raw, str) or not raw or len(raw) > NAME_MAX_LENGTH:
+        raise ValueError(f"Invalid {field}")
+    return raw
+
+
+def reading_row(user_id, sensor_type, value, timestamp, axes=None):
+    row = {"user_id": user_id, "sensor_type": sensor_type, "value": value, "timestamp": timestamp}
+    if axes is not None:
+        row["x"], row["y"], row["z"] = axes
+    return row
+
+
+def parse_timestamp(raw):
+    """Converte il timestamp del dispositivo (epoch in ms oppure ISO 8601) in datetime UTC."""
+    if raw is None:
+        return datetime.utcnow()
+    if isinstance(raw, bool):
+        raise ValueError("Invalid timestamp")
+    if isinstance(raw, (int, float)):
+        try:
+            return datetime.utcfromtimestamp(raw / 1000.0)
+        except (ValueError, OverflowError, OSError):
+            # NaN, infiniti e istanti fuori dall'intervallo di datetime
+            raise ValueError("Invalid timestamp")
+    try:
+        ts = datetime.fromisoformat(str(raw))
+    except ValueError:
+        raise ValueError("Invalid timestamp")
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def parse_reading(item):
+    """Valida una lettura e restituisce (username, sensor_type, value, timestamp, assi).
+
+    Solleva ValueError con il motivo dello scarto.
+    """
+    if not isinstance(item, dict):
+        raise ValueError("Invalid data")
+
+    if item.get("username") is None or item.get("sensor_type") is None or item.get("value") is None:
+        raise ValueError("Invalid data")
+    username = parse_name(item["username"], "username")
+    sensor_type = parse_name(item["sensor_type"], "sensor_type")
+    value, axes = parse_value(item["value"], sensor_type)
+    return username, sensor_type, value, parse_timestamp(item.get("timestamp")), axes
+
+
+def resolve_user_ids(usernames):
+    """Restituisce {username: user_id} per gli username esistenti.
+
+    Gli username non in cache si risolvono con una sola query; quelli inesistenti
+    restano in unknown_user_cache per pochi secondi, così un utente appena creato
+    viene riconosciuto presto anche dagli altri worker.
+    """
+    user_ids = {}
+    unknown = []
+    for username in usernames:
+        user_id = user_id_cache.get(username)
+        if user_id is not cache.MISSING:
+            user_ids[username] = user_id
+        elif unknown_user_cache.get(username) is cache.MISSING:
+            unknown.append(username)
+    if unknown:
+        found = dict(db.session.query(User.username, User.id).filter(User.username.in_(unknown)).all())
+        for username in unknown:
+            if username in found:
+                user_id_cache.set(username, found[username])
+            else:
+                unknown_user_cache.set(username, True)
+        user_ids.update(found)
+    return user_ids
+
 # ================== FUNZIONI DI SUPPORTO ==================
-def calculate_stats(days=7, user=None):
-    stats = {}
+def stats_usernames(user=None):
+    """{user_id: username} degli utenti inclusi nelle statistiche."""
+    if user:
+        return {user.id: user.username}
+    return dict(db.session.query(User.id, User.username).all())
+
+
+def calculate_stats(days=7, user=None, usernames=None):
+    """Media, minimo, massimo e conteggio per utente e sensore negli ultimi `days` giorni.
+
+    Un'unica query aggregata (GROUP BY user_id, sensor_type); per finestre lunghe
+    legge il rollup più grossolano adatto (vedi rollups.choose_resolution), con la
+    finestra allineata all'inizio del primo bucket.
+    """
     since = datetime.utcnow() - timedelta(days=days)
 
-    if user:
-        users = [user]
+    if usernames is None:
+        usernames = stats_usernames(user)
+    stats = {username: {} for username in usernames.values()}
+
+    user_id = user.id if user else None
+    resolution = rollups.choose_resolution(days * 86400)
+    if resolution:
+        query = rollup_stats_query(resolution, rollups.truncate(since, resolution), user_id)
     else:
-        users = User.query.all()
+        query = stats_query(since, user_id)
 
-    for u in users:
-        stats[u.username] = {}
-        sensor_types = db.session.query(SensorData.sensor_type).filter(
-            SensorData.user_id == u.id, SensorData.timestamp >= since
-        ).distinct()
-        for stype_tuple in sensor_types:
-            stype = stype_tuple[0]
-            values = [d.value for d in SensorData.query.filter_by(user_id=u.id, sensor_type=stype).all()]
-            if values:
-                stats[u.username][stype] = {
-                    "mean": sum(values) / len(values),
-                    "min": min(values),
-                    "max": max(values),
-                    "count": len(values)
-                }
+    for user_id, stype, mean, vmin, vmax, count in query:
+        if user_id in usernames and count:
+            stats[usernames[user_id]][stype] = {
+                "mean": float(mean),
+                "min": vmin,
+                "max": vmax,
+                "count": count
+            }
     return stats
 
 
-def prepare_chart_data(user=None):
+def prepare_chart_data(user=None, since=None, until=None, max_points=CHART_MAX_POINTS, method="lttb"):
+    """Serie dei grafici per utente e sensore, ridotte a max_points punti ciascuna.
+
+    L'ampiezza dei bucket dipende dall'intervallo richiesto (since/until, di default
+    l'estensione dei dati); method è "lttb" oppure "minmax" (min e max per bucket).
+    Quando il bucket del grafico è almeno un minuto si parte dal min/max dei rollup
+    invece che dalle letture grezze.
+    """
     chart_data = {}
     if user:
         users = [user]
@@ -220,33 +1805,185 @@ def prepare_chart_data(user=None):
 
     for u in users:
         chart_data[u.username] = {}
-        sensor_types = db.session.query(SensorData.sensor_type).filter_by(user_id=u.id).distinct()
-        for stype_tuple in sensor_types:
+        for stype_tuple in sensor_types_query(u.id, since, until):
             stype = stype_tuple[0]
-            entries = SensorData.query.filter_by(user_id=u.id, sensor_type=stype).order_by(SensorData.timestamp).all()
+            if since is not None:
+                range_seconds = ((until or datetime.utcnow()) - since).total_seconds()
+            else:
+                first, last = series_extent(u.id, stype, until)
+                if first is None:
+                    continue
+                range_seconds = (last - first).total_seconds()
+
+            width = downsample.choose_bucket_seconds(range_seconds, max_points // 2)
+            resolution = rollups.choose_resolution(range_seconds, max_width=width)
+            if resolution:
+                start = rollups.truncate(since, resolution) if since is not None else None
+                buckets = rollup_chart_query(u.id, stype, resolution, start, until).all()
+                # Due punti per bucket (minimo e massimo) per non perdere i picchi
+                times = np.array([b[0] for b in buckets for _ in (0, 1)], dtype="datetime64[us]")
+                values = np.fromiter((v for b in buckets for v in (b[1], b[2])), np.float64, 2 * len(buckets))
+            else:
+                times, values = raw_series(u.id, stype, since, until)
+            if not len(times):
+                continue
+
+            x = (times - np.datetime64(EPOCH, "us")).astype(np.float64) / 1e6
+            picked = downsample.downsample(x, values, max_points, method, range_seconds)
             chart_data[u.username][stype] = {
-                "timestamps": [e.timestamp.strftime("%H:%M:%S") for e in entries],
-                "values": [e.value for e in entries]
+                "timestamps": np.datetime_as_string(times[picked], unit="ms").tolist(),
+                "values": values[picked].tolist()
             }
     return chart_data
 
 
 def get_recent_anomalies(limit=10, user=None):
-    if user:
-        anomalies = SensorData.query.filter(
-            SensorData.user_id == user.id,
-            SensorData.value > 100
-        ).order_by(SensorData.timestamp.desc()).limit(limit).all()
-    else:
-        anomalies = SensorData.query.filter(
-            SensorData.value > 100
-        ).order_by(SensorData.timestamp.desc()).limit(limit).all()
-    return anomalies
+    return recent_anomalies_query(limit, user.id if user else None).all()
+
+
+# Query delle dashboard, separate per poterne controllare il piano con check_db.py
+def raw_source(since=None, until=None, columns=partitions.READ_COLUMNS):
+    """Dati grezzi della finestra: sensor_data o la UNION ALL delle sole partizioni toccate."""
+    return sensor_partitions.source(db.session, since, until, columns)
+
+
+def raw_series(user_id, sensor_type, since=None, until=None):
+    """Letture di una serie come (timestamps datetime64[us], values float64), dai blocchi o da sensor_data."""
+    if sensor_blocks.handles(sensor_type):
+        return sensor_blocks.read(db.session, user_id, sensor_type, since, until)[:2]
+    rows = chart_query(user_id, sensor_type, since, until).all()
+    times = np.array([r[0] for r in rows], dtype="datetime64[us]")
+    # None (valori mancanti) -> NaN
+    values = np.array([r[1] for r in rows], dtype=np.float64)
+    return times, values
+
+
+def series_extent(user_id, sensor_type, until=None):
+    """(primo, ultimo) timestamp di una serie, dai blocchi o da sensor_data."""
+    if sensor_blocks.handles(sensor_type):
+        return sensor_blocks.extent(db.session, user_id, sensor_type, until)
+    return series_extent_query(user_id, sensor_type, until).one()
+
+
+def block_query(user_id, sensor_type, since=None, until=None):
+    return sensor_blocks.range_query(user_id, sensor_type, since, until)
+
+
+def stats_query(since, user_id=None):
+    raw = raw_source(since).c
+    query = db.session.query(
+        raw.user_id,
+        raw.sensor_type,
+        func.avg(raw.value),
+        func.min(raw.value),
+        func.max(raw.value),
+        func.count(raw.value)
+    ).filter(raw.timestamp >= since)
+    if user_id is not None:
+        query = query.filter(raw.user_id == user_id)
+    return query.group_by(raw.user_id, raw.sensor_type)
+
+
+def rollup_stats_query(resolution, since, user_id=None):
+    query = db.session.query(
+        SensorRollup.user_id,
+        SensorRollup.sensor_type,
+        func.sum(SensorRollup.sum) / func.sum(SensorRollup.count),
+        func.min(SensorRollup.min),
+        func.max(SensorRollup.max),
+        func.sum(SensorRollup.count)
+    ).filter(SensorRollup.resolution == resolution, SensorRollup.bucket >= since)
+    if user_id is not None:
+        query = query.filter(SensorRollup.user_id == user_id)
+    return query.group_by(SensorRollup.user_id, SensorRollup.sensor_type)
+
+
+def rollup_chart_query(user_id, sensor_type, resolution, since=None, until=None):
+    query = db.session.query(SensorRollup.bucket, SensorRollup.min, SensorRollup.max).filter(
+        SensorRollup.user_id == user_id,
+        SensorRollup.sensor_type == sensor_type,
+        SensorRollup.resolution == resolution
+    )
+    if since is not None:
+        query = query.filter(SensorRollup.bucket >= since)
+    if until is not None:
+        query = query.filter(SensorRollup.bucket < until)
+    return query.order_by(SensorRollup.bucket)
+
+
+def history_version_query(user_id, sensor_type, since=None, until=None):
+    # Letture, somma, primo e ultimo bucket orario della finestra: ETag e Last-Modified dell'API dello storico
+    query = db.session.query(func.sum(SensorRollup.count), func.sum(SensorRollup.sum),
+                             func.min(SensorRollup.bucket), func.max(SensorRollup.bucket)).filter(
+        SensorRollup.user_id == user_id, SensorRollup.sensor_type == sensor_type, SensorRollup.resolution == "hour"
+    )
+    if since is not None:
+        query = query.filter(SensorRollup.bucket >= rollups.truncate(since, "hour"))
+    if until is not None:
+        query = query.filter(SensorRollup.bucket < until)
+    return query
+
+
+def series_extent_query(user_id, sensor_type, until=None):
+    # Minimo e massimo per tabella (ognuno risolto sull'indice), poi combinati
+    legs = []
+    for table in sensor_partitions.tables(db.session, None, until):
+        leg = select(func.min(table.c.timestamp).label("first"), func.max(table.c.timestamp).label("last")).where(
+            table.c.user_id == user_id, table.c.sensor_type == sensor_type
+        )
+        if until is not None:
+            leg = leg.where(table.c.timestamp < until)
+        legs.append(leg)
+    if len(legs) == 1:
+        table = sensor_partitions.base
+        query = db.session.query(func.min(table.c.timestamp), func.max(table.c.timestamp)).filter(
+            table.c.user_id == user_id, table.c.sensor_type == sensor_type
+        )
+        return _time_window(query, table.c.timestamp, until=until)
+    extents = union_all(*legs).subquery()
+    return db.session.query(func.min(extents.c.first), func.max(extents.c.last))
+
+
+def _time_window(query, column, since=None, until=None):
+    if since is not None:
+        query = query.filter(column >= since)
+    if until is not None:
+        query = query.filter(column < until)
+    return query
+
+
+def sensor_types_query(user_id, since=None, until=None):
+    # I rollup giornalieri bastano per sapere quali sensori hanno dati nella finestra
+    query = db.session.query(SensorRollup.sensor_type).filter(
+        SensorRollup.user_id == user_id, SensorRollup.resolution == "day"
+    )
+    if since is not None:
+        query = query.filter(SensorRollup.bucket >= rollups.truncate(since, "day"))
+    if until is not None:
+        query = query.filter(SensorRollup.bucket < until)
+    return query.distinct()
+
+
+def chart_query(user_id, sensor_type, since=None, until=None):
+    raw = raw_source(since, until).c
+    query = db.session.query(raw.timestamp, raw.value).filter(
+        raw.user_id == user_id, raw.sensor_type == sensor_type
+    )
+    return _time_window(query, raw.timestamp, since, until).order_by(raw.timestamp)
+
+
+def recent_anomalies_query(limit=10, user_id=None):
+    query = Anomaly.query
+    if user_id is not None:
+        query = query.filter(Anomaly.user_id == user_id)
+    return query.order_by(Anomaly.timestamp.desc()).limit(limit)
 
 # ================== RUN SERVER ==================
 if __name__ == "__main__":
+    # Un solo processo riceve tutte le letture
+    app.config["ONLINE_FEATURES"] = True
     with app.app_context():
-        db.create_all()
+        init_db()
         if not User.query.filter_by(username="admin").first():
             admin_user = User(username="admin", email="admin@example.com", is_admin=True)
             admin_user.set_password("admin123")
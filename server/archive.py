@@ -0,0 +1,297 @@
+"""Archivio colonnare (Parquet) della storia dei sensori.
+
+export() legge le letture dal database a blocchi di chunk_rows righe (memoria
+limitata al blocco) e le scrive in file Parquet partizionati come
+
+    <dest>/user=<username>/sensor=<tipo>/date=<AAAA-MM-GG>/part-0.parquet
+
+con le colonne timestamp, value e x/y/z (assi dei sensori a tre canali, null per
+gli altri); utente, sensore e giorno sono nel percorso, leggibile come
+partizionamento "hive" da pyarrow, pandas, DuckDB, Spark.
+Le finestre sono allineate al giorno: ogni file contiene un giorno intero e una
+nuova esportazione dello stesso giorno lo sostituisce.
+
+load_series() e load_frame() rileggono l'archivio senza passare dal database:
+i valori tornano come array NumPy pronti per score_series o come DataFrame
+pandas. I Parquet sono compressi (zstd) per la conservazione e vanno
+decompressi in memoria; con mmap=True i loader leggono invece una cache per
+l'analisi, un file Arrow IPC non compresso accanto a ogni Parquet
+(part-0.arrow, creato da build_cache() quando manca o è più vecchio del
+Parquet), mappato in memoria: le colonne sono viste sulle pagine del file,
+senza decompressione né copie (una sola copia per unire più giorni).
+
+Richiede pyarrow (in requirements.txt), importato solo quando serve.
+"""
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import select
+
+import motion
+import rollups
+
+DEFAULT_CHUNK_ROWS = 100_000
+PART_NAME = "part-0.parquet"
+# Cache non compressa e mappabile di ogni Parquet, per l'analisi (vedi build_cache)
+CACHE_NAME = "part-0.arrow"
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.fs
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("L'archivio Parquet richiede pyarrow: pip install pyarrow") from None
+    return pyarrow
+
+
+def day_window(since=None, until=None):
+    """Allinea la finestra ai giorni interi: since all'inizio del giorno, until alla mezzanotte successiva."""
+    if since is not None:
+        since = rollups.truncate(since, "day")
+    if until is not None and until != rollups.truncate(until, "day"):
+        until = rollups.truncate(until, "day") + timedelta(days=1)
+    return since, until
+
+
+def partition_path(root, username, sensor_type, day):
+    return os.path.join(root, f"user={username}", f"sensor={sensor_type}", f"date={day:%Y-%m-%d}")
+
+
+class _PartWriter:
+    """Scrive un file Parquet alla volta; il file appare col nome finale solo a scrittura completata."""
+
+    def __init__(self, pa, schema):
+        self.pa = pa
+        self.schema = schema
+        self.writer = None
+        self.path = None
+        self.files = 0
+
+    def open(self, directory):
+        self.close()
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, PART_NAME)
+        # La cache del giorno riesportato non vale più
+        if os.path.exists(os.path.join(directory, CACHE_NAME)):
+            os.remove(os.path.join(directory, CACHE_NAME))
+        self.writer = self.pa.parquet.ParquetWriter(self.path + ".tmp", self.schema, compression="zstd")
+
+    def write(self, columns):
+        rows = len(columns["timestamp"])
+        # NaN (valori mancanti, assi dei sensori a un canale) -> null
+        arrays = [self.pa.array(columns[field.name], type=field.type, from_pandas=True)
+                  if field.name in columns else self.pa.nulls(rows, field.type)
+                  for field in self.schema]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(self.path + ".tmp", self.path)
+            self.files += 1
+            self.writer = None
+
+
+def _file_schema(pa):
+    return pa.schema([("timestamp", pa.timestamp("us")), ("value", pa.float64())]
+                     + [(axis, pa.float64()) for axis in motion.AXES])
+
+
+def export(session, source, dest, usernames, since=None, until=None, user_id=None,
+           chunk_rows=DEFAULT_CHUNK_ROWS):
+    """Esporta le letture di source (tabella o selezionabile come sensor_data) in dest.
+
+    usernames è la mappa user_id -> username usata nei percorsi; user_id limita
+    l'esportazione a un utente. Le righe arrivano ordinate per (utente, sensore,
+    timestamp), quindi c'è un solo file aperto alla volta. Restituisce (righe, file).
+    """
+    pa = _pyarrow()
+    since, until = day_window(since, until)
+    # Gli assi solo se la sorgente li ha (es. sensor_data, non la UNION ALL di lettura)
+    axes = [axis for axis in motion.AXES if axis in source.c]
+    query = select(source.c.user_id, source.c.sensor_type, source.c.timestamp, source.c.value,
+                   *(source.c[axis] for axis in axes))
+    if user_id is not None:
+        query = query.where(source.c.user_id == user_id)
+    if since is not None:
+        query = query.where(source.c.timestamp >= since)
+    if until is not None:
+        query = query.where(source.c.timestamp < until)
+    query = query.order_by(source.c.user_id, source.c.sensor_type, source.c.timestamp)
+
+    writer = _PartWriter(pa, _file_schema(pa))
+    current = None
+    rows = 0
+    # yield_per: cursore lato server su PostgreSQL, fetchmany su SQLite
+    result = session.execute(query, execution_options={"yield_per": chunk_rows})
+    try:
+        for chunk in result.partitions():
+            user_ids, sensor_types, timestamps, *values = (np.array(column) for column in zip(*chunk))
+            timestamps = timestamps.astype("datetime64[us]")
+            values = [column.astype(float) for column in values]  # None -> NaN
+            days = timestamps.astype("datetime64[D]")
+            # Confini dei tratti contigui con lo stesso (utente, sensore, giorno)
+            changed = ((user_ids[1:] != user_ids[:-1]) | (sensor_types[1:] != sensor_types[:-1])
+                       | (days[1:] != days[:-1]))
+            starts = [0] + (np.flatnonzero(changed) + 1).tolist()
+            for begin, end in zip(starts, starts[1:] + [len(chunk)]):
+                key = (int(user_ids[begin]), str(sensor_types[begin]), days[begin])
+                if key != current:
+                    day = key[2].astype(datetime)
+                    writer.open(partition_path(dest, usernames.get(key[0], key[0]), key[1], day))
+                    current = key
+                columns = {"timestamp": timestamps[begin:end]}
+                columns.update((name, column[begin:end]) for name, column in zip(["value", *axes], values))
+                writer.write(columns)
+            rows += len(chunk)
+    finally:
+        writer.close()
+        result.close()
+    return rows, writer.files
+
+
+def export_series(dest, username, sensor_type, timestamps, values, axes=None):
+    """Esporta una serie già in memoria (es. decodificata dai blocchi, vedi blocks.py), un file per giorno.
+
+    timestamps è ordinato; axes, se presente, è l'array (n, 3) degli assi.
+    Restituisce i file scritti.
+    """
+    pa = _pyarrow()
+    writer = _PartWriter(pa, _file_schema(pa))
+    days = timestamps.astype("datetime64[D]")
+    bounds = np.flatnonzero(np.r_[True, days[1:] != days[:-1], True])
+    try:
+        for begin, end in zip(bounds[:-1], bounds[1:]):
+            writer.open(partition_path(dest, username, sensor_type, days[begin].astype(datetime)))
+            columns = {"timestamp": timestamps[begin:end], "value": values[begin:end]}
+            if axes is not None:
+                columns.update(zip(motion.AXES, axes[begin:end].T))
+            writer.write(columns)
+    finally:
+        writer.close()
+    return writer.files
+
+
+def files(root, username=None, sensor_type=None, since=None, until=None, name=PART_NAME):
+    """File dell'archivio (Parquet, o la cache con name=CACHE_NAME) per utente, sensore e giorni
+    [since, until), scelti dai soli nomi delle cartelle."""
+    first = f"date={since:%Y-%m-%d}" if since is not None else None
+    last = f"date={until:%Y-%m-%d}" if until is not None else None
+    found = []
+    for user_dir in _subdirs(root, "user", username):
+        for sensor_dir in _subdirs(user_dir, "sensor", sensor_type):
+            for day_dir in _subdirs(sensor_dir, "date"):
+                day = os.path.basename(day_dir)
+                if (first is None or day >= first) and (last is None or day <= last):
+                    path = os.path.join(day_dir, name)
+                    if os.path.exists(path):
+                        found.append(path)
+    return sorted(found)
+
+
+def _subdirs(parent, key, value=None):
+    if value is not None:
+        path = os.path.join(parent, f"{key}={value}")
+        return [path] if os.path.isdir(path) else []
+    if not os.path.isdir(parent):
+        return []
+    return [entry.path for entry in os.scandir(parent) if entry.is_dir() and entry.name.startswith(key + "=")]
+
+
+def build_cache(root, username=None, sensor_type=None, since=None, until=None):
+    """Scrive la cache Arrow IPC non compressa dei Parquet selezionati che non l'hanno o l'hanno vecchia.
+
+    Restituisce i file scritti.
+    """
+    pa = _pyarrow()
+    written = 0
+    for path in files(root, username, sensor_type, since, until):
+        cache = os.path.join(os.path.dirname(path), CACHE_NAME)
+        if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+            continue
+        table = pa.parquet.read_table(path, schema=_file_schema(pa))
+        with pa.OSFile(cache + ".tmp", "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(cache + ".tmp", cache)
+        written += 1
+    return written
+
+
+def dataset(root, username=None, sensor_type=None, since=None, until=None, mmap=False):
+    """Dataset pyarrow dei file selezionati, con user/sensor/date dai percorsi.
+
+    Con mmap=True legge la cache Arrow IPC (aggiornata prima con build_cache) mappata in memoria.
+    """
+    pa = _pyarrow()
+    path_schema = pa.schema([("user", pa.string()), ("sensor", pa.string()), ("date", pa.string())])
+    # Schema esplicito: vale anche quando nessun file corrisponde
+    schema = pa.unify_schemas([_file_schema(pa), path_schema])
+    if mmap:
+        build_cache(root, username, sensor_type, since, until)
+        return pa.dataset.dataset(files(root, username, sensor_type, since, until, CACHE_NAME), schema=schema,
+                                  format="ipc", partitioning=pa.dataset.partitioning(path_schema, flavor="hive"),
+                                  partition_base_dir=root, filesystem=pa.fs.LocalFileSystem(use_mmap=True))
+    return pa.dataset.dataset(files(root, username, sensor_type, since, until), schema=schema, format="parquet",
+                              partitioning=pa.dataset.partitioning(path_schema, flavor="hive"),
+                              partition_base_dir=root)
+
+
+def _read(pa, root, username, sensor_type, since, until, mmap, columns):
+    """Tabella delle colonne indicate dai file della finestra.
+
+    Con una finestra di giorni interi bastano i file scelti per nome: senza filtro
+    le colonne lette dalla cache mappata restano viste sul file.
+    """
+    if all(ts is None or ts == rollups.truncate(ts, "day") for ts in (since, until)):
+        last_day = until - timedelta(days=1) if until is not None else None
+        return dataset(root, username, sensor_type, since, last_day, mmap).to_table(columns=columns)
+    return dataset(root, username, sensor_type, since, until, mmap).to_table(
+        columns=columns, filter=_time_filter(pa, since, until))
+
+
+def _time_filter(pa, since=None, until=None):
+    field = pa.dataset.field("timestamp")
+    expression = None
+    if since is not None:
+        expression = field >= pa.scalar(since, pa.timestamp("us"))
+    if until is not None:
+        condition = field < pa.scalar(until, pa.timestamp("us"))
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def load_series(root, username, sensor_type, since=None, until=None, mmap=False):
+    """Una serie dall'archivio come (timestamps datetime64[us], values float64), in ordine di tempo.
+
+    I valori mancanti diventano NaN. Con mmap=True legge la cache mappata in memoria: per
+    un solo giorno senza valori mancanti gli array sono viste sul file, senza copie.
+    """
+    pa = _pyarrow()
+    table = _read(pa, root, username, sensor_type, since, until, mmap, ["timestamp", "value"])
+    # Ogni file è già ordinato; i giorni possono arrivare in ordine qualsiasi
+    if table.num_rows and not _is_sorted(table.column("timestamp")):
+        table = table.sort_by("timestamp")
+    timestamps = table.column("timestamp").to_numpy()
+    values = table.column("value").to_numpy()
+    return timestamps, np.asarray(values, dtype=float)
+
+
+def _is_sorted(column):
+    # Ordinare costa una copia: si evita quando i giorni sono già in sequenza
+    firsts = [chunk[0].value for chunk in column.chunks if len(chunk)]
+    return firsts == sorted(firsts)
+
+
+def load_frame(root, username=None, sensor_type=None, since=None, until=None, axes=False, mmap=False):
+    """L'archivio (o una sua parte) come DataFrame pandas con user, sensor, timestamp, value
+    (e x, y, z con axes=True); con mmap=True dalla cache mappata in memoria."""
+    pa = _pyarrow()
+    columns = ["user", "sensor", "timestamp", "value"] + (list(motion.AXES) if axes else [])
+    table = _read(pa, root, username, sensor_type, since, until, mmap, columns)
+    return table.to_pandas().sort_values(["user", "sensor", "timestamp"], ignore_index=True)
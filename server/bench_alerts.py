@@ -0,0 +1,160 @@
+"""Benchmark del dispatcher email (alerts.py) contro un server SMTP finto locale.
+
+Simula un sensore BVP rumoroso: molte anomalie al minuto per alcuni pazienti.
+Misura il tempo di submit() visto dall'ingestione, le email e le connessioni
+SMTP effettive, e le confronta con l'invio di una email per anomalia aprendo
+ogni volta una connessione (come EmailNotifier.send_email). Il server finto
+aggiunge --latency-ms a ogni risposta, per simulare rete e handshake, e con
+--drop-every chiude la connessione ogni N messaggi per provare la riconnessione.
+
+    python bench_alerts.py --alerts 2000 --patients 5
+    python bench_alerts.py --latency-ms 50 --drop-every 3
+"""
+import time
+import random
+import smtplib
+import argparse
+import threading
+import socketserver
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+
+import alerts
+
+
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    """Quanto basta di SMTP per smtplib: EHLO, MAIL, RCPT, DATA, NOOP, RSET, QUIT."""
+
+    def reply(self, line):
+        time.sleep(self.server.latency)
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply("220 stub ESMTP")
+        delivered = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors="replace").strip().upper()
+            if command.startswith(("EHLO", "HELO")):
+                self.reply("250 stub")
+            elif command == "DATA":
+                self.reply("354 fine con <CRLF>.<CRLF>")
+                while self.rfile.readline() not in (b".\r\n", b".\n", b""):
+                    pass
+                with self.server.lock:
+                    self.server.messages += 1
+                delivered += 1
+                self.reply("250 OK")
+                if self.server.drop_every and delivered % self.server.drop_every == 0:
+                    return
+            elif command == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class StubSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0, drop_every=0):
+        super().__init__(("127.0.0.1", 0), StubSMTPHandler)
+        self.latency = latency
+        self.drop_every = drop_every
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = 0
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+def make_alerts(n, patients, seconds):
+    """Anomalie BVP sintetiche, distribuite su `seconds` secondi, con pochi tipi ripetuti."""
+    rng = random.Random(0)
+    start = datetime.utcnow()
+    return [{
+        "user_id": rng.randrange(patients),
+        "sensor_type": "wrist_bvp",
+        "value": rng.uniform(-300, 300),
+        "timestamp": start + timedelta(seconds=seconds * i / n),
+        "anomaly_type": rng.choice(["absolute_threshold", "statistical", "rapid_change"]),
+        "severity": rng.choice(["medium", "medium", "high"]),
+        "message": "Valore fuori soglia"
+    } for i in range(n)]
+
+
+def naive_send(server, anomaly):
+    """Una connessione e una email per anomalia, come EmailNotifier.send_email."""
+    message = EmailMessage()
+    message["From"] = "monitoraggio@localhost"
+    message["To"] = "medico@localhost"
+    message["Subject"] = f"Anomalia - {anomaly['user_id']}"
+    message.set_content(anomaly["message"])
+    with smtplib.SMTP("127.0.0.1", server.port) as smtp:
+        smtp.send_message(message)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--alerts", type=int, default=2000, help="anomalie generate")
+    parser.add_argument("--patients", type=int, default=5, help="pazienti")
+    parser.add_argument("--batches", type=int, default=100, help="gruppi di submit (batch di ingestione)")
+    parser.add_argument("--digest-seconds", type=float, default=1.0, help="finestra dei riepiloghi")
+    parser.add_argument("--cooldown-seconds", type=float, default=60.0, help="cooldown dei duplicati")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="ritardo del server finto per risposta")
+    parser.add_argument("--drop-every", type=int, default=0, help="il server chiude dopo N messaggi (0 = mai)")
+    parser.add_argument("--naive", type=int, default=20, help="anomalie inviate anche una per connessione")
+    args = parser.parse_args()
+
+    server = StubSMTPServer(args.latency_ms / 1000, args.drop_every).start()
+    connection = alerts.SMTPConnection("127.0.0.1", server.port, starttls=False)
+    dispatcher = alerts.AlertDispatcher(connection, "monitoraggio@localhost", ["medico@localhost"],
+                                        user_label=lambda user_id: f"patient{user_id}",
+                                        digest_seconds=args.digest_seconds,
+                                        cooldown_seconds=args.cooldown_seconds)
+    anomalies = make_alerts(args.alerts, args.patients, seconds=3 * args.digest_seconds)
+    size = max(1, len(anomalies) // args.batches)
+    batches = [anomalies[i:i + size] for i in range(0, len(anomalies), size)]
+
+    submit_times = []
+    start = time.perf_counter()
+    interval = 3 * args.digest_seconds / len(batches)
+    for batch in batches:
+        t0 = time.perf_counter()
+        dispatcher.submit(batch)
+        submit_times.append(time.perf_counter() - t0)
+        time.sleep(interval)
+    dispatcher.close()
+    elapsed = time.perf_counter() - start
+    state = dispatcher.metrics()
+    submit_ms = sorted(t * 1000 for t in submit_times)
+    print(f"📨 {args.alerts:,} anomalie, {args.patients} pazienti, in {len(batches)} batch ({elapsed:.1f}s)")
+    print(f"   submit(): mediana {submit_ms[len(submit_ms) // 2]:.3f} ms, max {submit_ms[-1]:.3f} ms per batch")
+    print(f"   email inviate: {state['sent']} (fallite {state['failed']}), soppresse {state['suppressed']:,}, "
+          f"connessioni SMTP {state['connections']}; il server ne ha viste {server.connections} "
+          f"con {server.messages} messaggi")
+
+    if args.naive:
+        before = server.connections
+        t0 = time.perf_counter()
+        for anomaly in anomalies[:args.naive]:
+            naive_send(server, anomaly)
+        per_alert = (time.perf_counter() - t0) / args.naive
+        print(f"   una email per anomalia con nuova connessione: {per_alert * 1000:.0f} ms ciascuna "
+              f"({server.connections - before} connessioni per {args.naive} anomalie), "
+              f"{per_alert * args.alerts:.0f}s stimati per tutte, nel thread di ingestione")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Benchmark dell'archivio Parquet: esportazione a blocchi e rilettura di una serie
+dall'archivio, confrontata con la lettura dal database, anche dalla cache Arrow
+non compressa mappata in memoria (mmap=True: creazione della cache e letture).
+
+Il database viene popolato come in bench_stats.py (solo se vuoto).
+
+    python bench_archive.py --rows 2000000
+    python bench_archive.py --database-url sqlite:////tmp/bench_stats.db --chunk-rows 50000
+"""
+import os
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+
+import numpy as np
+
+import archive
+from bench_stats import seed
+from anomaly_detector import AnomalyDetector
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def dir_size_mb(root):
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(root) for f in files) / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=2_000_000, help="righe di SensorData da generare")
+    parser.add_argument("--users", type=int, default=20, help="numero di pazienti")
+    parser.add_argument("--days", type=int, default=30, help="giorni di storico generati")
+    parser.add_argument("--chunk-rows", type=int, default=archive.DEFAULT_CHUNK_ROWS, help="righe per blocco")
+    parser.add_argument("--database-url", default=None, help="database di prova (default: SQLite temporaneo)")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="bench_archive_")
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+
+    from app import app, db, User, SensorData, SensorRollup, init_db, raw_source, chart_query
+
+    with app.app_context():
+        init_db()
+        if db.session.query(SensorData.id).limit(1).first() is None:
+            seed(db, User, SensorData, SensorRollup, args.rows, args.users, args.days)
+        total = db.session.query(SensorData.id).count()
+        db_size = os.path.getsize(db.engine.url.database) / 2**20 if db.engine.dialect.name == "sqlite" else None
+        print(f"📊 Database: {os.environ['DATABASE_URL']} ({total:,} righe)")
+
+        dest = os.path.join(tmpdir, "archive")
+        usernames = dict(db.session.query(User.id, User.username).all())
+        rss_before = peak_rss_mb()
+        start = time.perf_counter()
+        rows, files = archive.export(db.session, raw_source(), dest, usernames, chunk_rows=args.chunk_rows)
+        elapsed = time.perf_counter() - start
+        print(f"   esportazione: {rows:,} righe in {files:,} file, {elapsed:.1f}s ({rows / elapsed:,.0f} righe/s)")
+        print(f"   picco di memoria: {rss_before:.0f} MB prima, {peak_rss_mb():.0f} MB dopo "
+              f"(blocchi da {args.chunk_rows:,} righe)")
+        size = f"{db_size:.0f} MB il database, " if db_size is not None else ""
+        print(f"   dimensione: {size}{dir_size_mb(dest):.0f} MB l'archivio")
+
+        user = User.query.filter_by(username="patient0").first()
+        sensor = "wrist_hr"
+        start = time.perf_counter()
+        rows = chart_query(user.id, sensor).all()
+        db_values = np.array([v for _, v in rows], dtype=float)
+        db_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    timestamps, values = archive.load_series(dest, user.username, sensor)
+    archive_elapsed = time.perf_counter() - start
+    same = len(values) == len(db_values) and np.allclose(values, db_values)
+    print(f"   serie {user.username}/{sensor}: database {db_elapsed * 1000:.0f} ms, "
+          f"archivio {archive_elapsed * 1000:.0f} ms ({len(values):,} valori, uguali: {same})")
+
+    start = time.perf_counter()
+    cached = archive.build_cache(dest)
+    cache_elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    _, mapped = archive.load_series(dest, user.username, sensor, mmap=True)
+    mapped_elapsed = time.perf_counter() - start
+    cache_mb = sum(os.path.getsize(path) for path in archive.files(dest, name=archive.CACHE_NAME)) / 2**20
+    print(f"   cache mappabile: {cached:,} file in {cache_elapsed:.1f}s ({cache_mb:.0f} MB), "
+          f"serie {mapped_elapsed * 1000:.0f} ms (uguali: {np.array_equal(mapped, values, equal_nan=True)})")
+
+    start = time.perf_counter()
+    scores = AnomalyDetector().score_series(values, sensor)
+    print(f"   score_series sull'archivio: {(time.perf_counter() - start) * 1000:.0f} ms, "
+          f"{int(scores['is_anomaly'].sum()):,} anomalie")
+
+    start = time.perf_counter()
+    frame = archive.load_frame(dest)
+    summary = frame.groupby(["user", "sensor"])["value"].agg(["count", "mean", "min", "max"])
+    print(f"   load_frame + statistiche per serie: {(time.perf_counter() - start) * 1000:.0f} ms "
+          f"({len(frame):,} righe, {len(summary)} serie)")
+    start = time.perf_counter()
+    mapped_frame = archive.load_frame(dest, mmap=True)
+    print(f"   load_frame dalla cache mappata: {(time.perf_counter() - start) * 1000:.0f} ms "
+          f"({len(mapped_frame):,} righe)")
+
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
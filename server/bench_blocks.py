@@ -0,0 +1,110 @@
+"""Benchmark dei blocchi binari (blocks.py) contro le righe di sensor_data per una
+serie BVP a 64 Hz: spazio occupato e tempi di lettura per intervallo.
+
+La stessa serie sintetica viene scritta sia in sensor_data (INSERT bulk, come
+import-dataset) sia in sensor_block; le letture usano chart_query e BlockStore.read.
+
+    python bench_blocks.py --hours 6
+    python bench_blocks.py --hours 24 --rate 32
+"""
+import os
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+import numpy as np
+
+SENSOR = "wrist_bvp"
+
+
+def table_sizes_mb(path):
+    """Spazio per tabella e indice (dbstat), None se SQLite non lo supporta."""
+    try:
+        with sqlite3.connect(path) as conn:
+            return {name: size / 2**20 for name, size in
+                    conn.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name")}
+    except sqlite3.OperationalError:
+        return None
+
+
+def timed(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hours", type=float, default=6, help="ore di segnale generate")
+    parser.add_argument("--rate", type=int, default=64, help="campioni al secondo")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="bench_blocks_")
+    path = os.path.join(tmpdir, "bench.db")
+    os.environ["DATABASE_URL"] = f"sqlite:///{path}"
+    os.environ["BLOCK_SENSORS"] = SENSOR
+
+    from app import app, db, User, SensorData, init_db, chart_query, sensor_blocks
+    import dataset_import
+
+    n = int(args.hours * 3600 * args.rate)
+    start = datetime(2024, 1, 1)
+    # Timestamp al millisecondo con il jitter tipico del dispositivo (15/16 ms a 64 Hz)
+    offsets_ms = np.round(np.arange(n) * 1000 / args.rate).astype(np.int64)
+    timestamps = np.datetime64(start, "ms") + offsets_ms.astype("timedelta64[ms]")
+    rng = np.random.default_rng(0)
+    values = np.round(np.sin(np.arange(n) / args.rate * 2 * np.pi * 1.2) * 50 + rng.normal(0, 5, n), 2)
+
+    with app.app_context():
+        init_db()
+        user = User(username="bench", email="bench@example.com")
+        user.set_password("bench")
+        db.session.add(user)
+        db.session.commit()
+
+        t0 = time.perf_counter()
+        dataset_import.bulk_insert(db.session, SensorData.__table__, user.id, SENSOR, timestamps, values)
+        db.session.commit()
+        rows_elapsed = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        sensor_blocks.write(db.session, user.id, SENSOR, timestamps, values)
+        db.session.commit()
+        blocks_elapsed = time.perf_counter() - t0
+        print(f"📊 {n:,} campioni a {args.rate} Hz ({args.hours:g} ore)")
+        print(f"   scrittura: righe {n / rows_elapsed:,.0f} campioni/s, blocchi {n / blocks_elapsed:,.0f} campioni/s")
+
+        sizes = table_sizes_mb(path)
+        if sizes:
+            rows_mb = sizes.get("sensor_data", 0) + sizes.get("ix_sensor_data_user_sensor_ts", 0)
+            blocks_mb = sizes.get("sensor_block", 0) + sizes.get("ix_sensor_block_user_sensor_start", 0)
+            print(f"   spazio (tabella + indice): righe {rows_mb:.1f} MB, blocchi {blocks_mb:.1f} MB "
+                  f"({rows_mb / max(blocks_mb, 1e-9):.1f}x)")
+
+        for label, window in (("1 minuto", timedelta(minutes=1)), ("1 ora", timedelta(hours=1)),
+                              ("tutto", timedelta(hours=args.hours))):
+            since = start + timedelta(hours=args.hours / 2) - window / 2
+            until = since + window
+
+            def read_rows():
+                rows = chart_query(user.id, SENSOR, since, until).all()
+                return np.array([r[1] for r in rows], dtype=np.float64)
+
+            db_values, rows_ms = timed(read_rows)
+            (_, block_values, _), blocks_ms = timed(
+                lambda: sensor_blocks.read(db.session, user.id, SENSOR, since, until))
+            same = len(db_values) == len(block_values) and np.allclose(db_values, block_values, atol=1e-4)
+            print(f"   lettura {label}: righe {rows_ms:.1f} ms, blocchi {blocks_ms:.1f} ms "
+                  f"({rows_ms / max(blocks_ms, 1e-9):.0f}x, {len(block_values):,} valori, uguali: {same})")
+
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Micro-benchmark di AnomalyDetector.add_value (campioni/s) contro l'implementazione
+precedente basata su np.mean/np.std della deque, e di score_series (valutazione
+vettoriale dell'intera serie), con verifica che i risultati coincidano.
+
+    python bench_detector.py                       # dati sintetici
+    python bench_detector.py --csv ../dataset_mattia/wrist_bvp.csv --sensor wrist_bvp
+"""
+import time
+import argparse
+from collections import deque
+
+import numpy as np
+
+from anomaly_detector import AnomalyDetector, SENSOR_ALIASES, SEVERITY_ORDER
+
+
+class LegacyAnomalyDetector:
+    """Implementazione precedente: O(finestra) e conversioni NumPy a ogni campione."""
+
+    def __init__(self, window_size=20, z_threshold=3):
+        self.window_size = window_size
+        self.z_threshold = z_threshold
+        self.data_windows = {}
+        self.sensor_thresholds = AnomalyDetector().sensor_thresholds
+
+    def add_value(self, user_id, sensor_type, value):
+        key = f"{user_id}_{sensor_type}"
+        if key not in self.data_windows:
+            self.data_windows[key] = deque(maxlen=self.window_size)
+        window = self.data_windows[key]
+        window.append(value)
+        if len(window) >= self.window_size // 2:
+            return self.detect_anomaly(sensor_type, value, window)
+        return None
+
+    def detect_anomaly(self, sensor_type, current_value, window):
+        anomalies = []
+        sensor_type = SENSOR_ALIASES.get(sensor_type, sensor_type)
+        if sensor_type in self.sensor_thresholds:
+            thresholds = self.sensor_thresholds[sensor_type]
+            if current_value < thresholds['min'] or current_value > thresholds['max']:
+                anomalies.append({'type': 'absolute_threshold', 'severity': 'high'})
+        if len(window) >= 3:
+            mean = np.mean(window)
+            std = np.std(window)
+            if std > 0:
+                z_score = abs((current_value - mean) / std)
+                if z_score > self.z_threshold:
+                    anomalies.append({'type': 'statistical', 'severity': 'medium' if z_score < 4 else 'high'})
+        if len(window) >= 2:
+            prev_value = window[-2]
+            change_rate = abs((current_value - prev_value) / prev_value * 100) if prev_value != 0 else 0
+            rapid_change_thresholds = {'hr': 30, 'temp': 5, 'skin_temp': 5, 'eda': 50, 'bvp': None, 'ibi': 25,
+                                       'acc': 100}
+            threshold = rapid_change_thresholds.get(sensor_type, 50)
+            if threshold is not None and change_rate > threshold:
+                anomalies.append({'type': 'rapid_change',
+                                  'severity': 'low' if change_rate < threshold * 2 else 'medium'})
+        if len(window) >= 5:
+            recent_values = list(window)[-5:]
+            differences = [recent_values[i + 1] - recent_values[i] for i in range(4)]
+            if all(d > 0 for d in differences) or all(d < 0 for d in differences):
+                anomalies.append({'type': 'trend', 'severity': 'low'})
+        if anomalies:
+            anomalies.sort(key=lambda x: SEVERITY_ORDER.get(x['severity'], 0), reverse=True)
+            return {'anomalies': anomalies, 'window_mean': float(np.mean(window)),
+                    'window_std': float(np.std(window))}
+        return None
+
+
+def summarize(result):
+    if result is None:
+        return None
+    return tuple((a['type'], a['severity']) for a in result['anomalies'])
+
+
+def run(detector, values, sensor):
+    add = detector.add_value
+    start = time.perf_counter()
+    results = [add(1, sensor, v) for v in values]
+    return time.perf_counter() - start, results
+
+
+def summarize_top(result):
+    """Solo l'anomalia più grave, l'unico esito che score_series restituisce per campione."""
+    if result is None:
+        return (None, None)
+    top = result['anomalies'][0]
+    return (top['type'], top['severity'])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples", type=int, default=200000, help="campioni sintetici")
+    parser.add_argument("--csv", default=None, help="CSV Empatica da usare al posto dei dati sintetici")
+    parser.add_argument("--sensor", default="wrist_bvp", help="tipo di sensore")
+    parser.add_argument("--window-sizes", type=int, nargs="+", default=[20, 200, 2000])
+    args = parser.parse_args()
+
+    if args.csv:
+        import pandas as pd
+        df = pd.read_csv(args.csv)
+        values = df[df.columns[1]].astype(float).tolist()
+    else:
+        rng = np.random.default_rng(0)
+        t = np.arange(args.samples) / 64.0
+        values = (40 * np.sin(2 * np.pi * 1.2 * t) + rng.normal(0, 5, args.samples)).tolist()
+
+    print(f"📊 {len(values):,} campioni, sensore {args.sensor}")
+    for window_size in args.window_sizes:
+        legacy_time, legacy_results = run(LegacyAnomalyDetector(window_size), values, args.sensor)
+        new_time, new_results = run(AnomalyDetector(window_size), values, args.sensor)
+        mismatches = sum(summarize(a) != summarize(b) for a, b in zip(legacy_results, new_results))
+        print(f"   finestra {window_size:>5}: precedente {len(values) / legacy_time:>10,.0f} campioni/s, "
+              f"incrementale {len(values) / new_time:>10,.0f} campioni/s "
+              f"(x{legacy_time / new_time:.1f}), differenze: {mismatches}")
+
+        start = time.perf_counter()
+        scores = AnomalyDetector(window_size).score_series(values, args.sensor)
+        batch_time = time.perf_counter() - start
+        batch_mismatches = sum(summarize_top(r) != (t, s)
+                               for r, t, s in zip(new_results, scores['type'], scores['severity']))
+        print(f"   {'':>15}score_series {len(values) / batch_time:>10,.0f} campioni/s "
+              f"(x{new_time / batch_time:.1f} sull'incrementale), differenze: {batch_mismatches}")
+        # Le due implementazioni devono restare equivalenti (vedi anche flask check-detector)
+        assert batch_mismatches == 0, f"score_series diverge da add_value in {batch_mismatches} campioni"
+
+
+if __name__ == "__main__":
+    main()
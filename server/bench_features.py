@@ -0,0 +1,82 @@
+"""Benchmark delle feature di IBI, BVP ed EDA (features.py) su segnali sintetici.
+
+Genera --minutes minuti di BVP a 64 Hz, EDA a 4 Hz e IBI per paziente e misura:
+l'estrazione vettoriale sull'intera serie (come in import-dataset) e
+FeatureExtractor con un batch al secondo per ogni paziente (come in ingestione).
+Controlla anche che la frequenza ricavata dal BVP sia quella usata per generarlo.
+
+    python bench_features.py --patients 20 --minutes 60
+"""
+import time
+import argparse
+
+import numpy as np
+
+import features
+
+START = np.datetime64("2024-01-01T00:00:00", "us")
+
+
+def synthetic(minutes, heart_rate, rng):
+    """Serie sintetiche {sensore: (timestamps datetime64[us], valori)} con frequenza cardiaca fissa."""
+    seconds = minutes * 60
+    t_bvp = np.arange(seconds * features.BVP_HZ) / features.BVP_HZ
+    bvp = 40 * np.sin(2 * np.pi * heart_rate / 60 * t_bvp) + 10 * np.sin(2 * np.pi * 0.1 * t_bvp)
+    bvp += rng.normal(0, 3, len(t_bvp))
+    t_eda = np.arange(seconds * features.EDA_HZ) / features.EDA_HZ
+    eda = 2 + 0.3 * np.sin(2 * np.pi * t_eda / 600) + rng.normal(0, 0.002, len(t_eda))
+    for onset in rng.uniform(0, seconds, minutes * 3):
+        # Risposte elettrodermiche: salita rapida, discesa lenta
+        after = np.maximum(t_eda - onset, 0)
+        eda += 0.1 * (1 - np.exp(-after / 1.5)) * np.exp(-after / 8)
+    ibi = rng.normal(60000 / heart_rate, 40, int(seconds * heart_rate / 60))
+    t_ibi = np.cumsum(ibi) / 1000
+
+    def stamps(seconds_array):
+        return START + (seconds_array * 1e6).astype("timedelta64[us]")
+    return {"wrist_bvp": (stamps(t_bvp), bvp), "wrist_eda": (stamps(t_eda), eda), "wrist_ibi": (stamps(t_ibi), ibi)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patients", type=int, default=20, help="pazienti")
+    parser.add_argument("--minutes", type=int, default=60, help="minuti di segnale per paziente")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    rates = rng.uniform(55, 110, args.patients)
+    patients = [synthetic(args.minutes, rate, rng) for rate in rates]
+    samples = sum(len(values) for series in patients for _, values in series.values())
+    print(f"📊 {args.patients} pazienti x {args.minutes} minuti: {samples:,} campioni IBI, BVP ed EDA")
+
+    t0 = time.perf_counter()
+    errors, scr = [], []
+    for rate, series in zip(rates, patients):
+        for sensor_type, (timestamps, values) in series.items():
+            for feature, _, feature_values in features.extract(sensor_type, timestamps, values):
+                if feature == features.BVP_HR:
+                    errors.append(np.abs(feature_values - rate).mean())
+                elif feature == features.EDA_SCR:
+                    scr.append(feature_values.mean())
+    elapsed = time.perf_counter() - t0
+    print(f"   serie intere: {samples / elapsed:,.0f} campioni/s ({elapsed:.2f}s); "
+          f"errore medio HR da BVP {np.mean(errors):.2f} bpm, {np.mean(scr):.1f} SCR al minuto (generate 3)")
+
+    extractor = features.FeatureExtractor()
+    rows = 0
+    t0 = time.perf_counter()
+    for second in range(args.minutes * 60):
+        low, high = START + np.timedelta64(second, "s"), START + np.timedelta64(second + 1, "s")
+        for user_id, series in enumerate(patients):
+            for sensor_type, (timestamps, values) in series.items():
+                i, j = np.searchsorted(timestamps, [low, high])
+                if i < j:
+                    rows += len(extractor.add(user_id, sensor_type, timestamps[i:j], values[i:j]))
+    elapsed = time.perf_counter() - t0
+    batches = args.minutes * 60 * args.patients
+    print(f"   in ingestione: {batches:,} batch da un secondo in {elapsed:.2f}s "
+          f"({elapsed / batches * 1e6:.0f} µs per batch e paziente), {rows:,} righe di feature")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Benchmark dell'API dello storico (/api/users/<id>/sensors/<tipo>, history.py).
+
+Scrive --rows letture HR di un paziente (una al secondo) e --rows campioni BVP
+nei blocchi binari, poi percorre tutta la serie a pagine di --limit righe con il
+client di test di Flask, in JSON e in NDJSON: tempo della prima pagina, di
+quella più profonda e totale, e picco di memoria Python (tracemalloc) durante
+una pagina, che non deve crescere con la profondità né con l'ampiezza della
+finestra.
+
+    python bench_history.py --rows 500000 --limit 5000
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=500000, help="letture per sensore")
+    parser.add_argument("--limit", type=int, default=5000, help="righe per pagina")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="bench_history_")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+    os.environ["BLOCK_SENSORS"] = "wrist_bvp"
+    from app import app, db, User, init_db, store_readings
+
+    app.config["ANOMALY_DETECTION"] = False
+    start = datetime(2024, 1, 1)
+    rng = np.random.default_rng(0)
+    with app.app_context():
+        init_db()
+        user = User(username="history", email="history@example.com", is_admin=False)
+        user.set_password("-")
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+        t0 = time.perf_counter()
+        for k in range(0, args.rows, 50000):
+            n = min(50000, args.rows - k)
+            hr = rng.normal(70, 5, n)
+            bvp = rng.normal(0, 20, n)
+            store_readings(
+                [{"user_id": user_id, "sensor_type": "wrist_hr", "value": float(v),
+                  "timestamp": start + timedelta(seconds=k + i)} for i, v in enumerate(hr)]
+                + [{"user_id": user_id, "sensor_type": "wrist_bvp", "value": float(v),
+                    "timestamp": start + timedelta(microseconds=15625 * (k + i))} for i, v in enumerate(bvp)])
+        print(f"📊 {args.rows:,} letture HR e {args.rows:,} campioni BVP ({time.perf_counter() - t0:.1f}s per scriverli), "
+              f"pagine di {args.limit:,}")
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["_user_id"] = str(user_id)
+    for sensor_type in ("wrist_hr", "wrist_bvp"):
+        for fmt in ("json", "ndjson"):
+            cursor, pages, rows, times, peaks = None, 0, 0, [], []
+            t0 = time.perf_counter()
+            while True:
+                query = {"limit": args.limit, "format": fmt}
+                if cursor:
+                    query["cursor"] = cursor
+                tracemalloc.start()
+                p0 = time.perf_counter()
+                response = client.get(f"/api/users/{user_id}/sensors/{sensor_type}", query_string=query)
+                body = response.get_data()
+                times.append(time.perf_counter() - p0)
+                peaks.append(tracemalloc.get_traced_memory()[1] - len(body))
+                tracemalloc.stop()
+                pages += 1
+                if fmt == "json":
+                    payload = response.get_json()
+                    rows += len(payload["data"])
+                    cursor = payload["next_cursor"]
+                else:
+                    lines = body.splitlines()
+                    rows += len(lines) - 1
+                    cursor = app.json.loads(lines[-1])["next_cursor"]
+                if not cursor:
+                    break
+            total = time.perf_counter() - t0
+            print(f"   {sensor_type} {fmt}: {rows:,} righe in {pages} pagine, {total:.1f}s "
+                  f"({rows / total:,.0f} righe/s); prima pagina {times[0] * 1000:.0f} ms, "
+                  f"ultima {times[-2 if pages > 1 else -1] * 1000:.0f} ms, "
+                  f"picco di memoria oltre il corpo {max(peaks) / 1024:.0f} KB")
+
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Benchmark di ingestione: /api/data (una lettura per richiesta) contro /api/data/batch,
+in modalità sincrona e con la coda write-behind (INGEST_ASYNC).
+
+Usa un database SQLite temporaneo (o quello indicato da --database-url) e il
+test client di Flask, quindi misura il costo lato server senza la rete.
+
+    python bench_ingest.py --rows 2000 --batch-size 500
+"""
+import os
+import time
+import random
+import argparse
+import tempfile
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=2000, help="letture da inviare per ciascun percorso")
+    parser.add_argument("--single-rows", type=int, default=None,
+                        help="letture per il percorso singolo (default: --rows)")
+    parser.add_argument("--batch-size", type=int, default=500, help="letture per richiesta batch")
+    parser.add_argument("--database-url", default=None, help="database di prova (default: SQLite temporaneo)")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="bench_ingest_")
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+
+    # Import dopo aver impostato DATABASE_URL
+    from app import app, db, User, SensorData, get_ingest_queue
+
+    with app.app_context():
+        db.create_all()
+        if not User.query.filter_by(username="bench").first():
+            user = User(username="bench", email="bench@example.com")
+            user.set_password("bench")
+            db.session.add(user)
+            db.session.commit()
+
+    client = app.test_client()
+    base_ts = int(time.time() * 1000)
+    readings = [
+        {"username": "bench", "sensor_type": "wrist_bvp", "value": random.uniform(-50, 50), "timestamp": base_ts + i * 15}
+        for i in range(args.rows)
+    ]
+
+    # Percorso singolo
+    start = time.perf_counter()
+    single_rows = args.single_rows or args.rows
+    for reading in readings[:single_rows]:
+        r = client.post("/api/data", json=reading)
+        assert r.status_code == 200, r.get_data(as_text=True)
+    single_elapsed = time.perf_counter() - start
+
+    # Percorso batch, con e senza rilevamento anomalie in linea
+    def run_batches(detection):
+        app.config["ANOMALY_DETECTION"] = detection
+        elapsed = []
+        for i in range(0, len(readings), args.batch_size):
+            start = time.perf_counter()
+            r = client.post("/api/data/batch", json=readings[i:i + args.batch_size])
+            elapsed.append(time.perf_counter() - start)
+            assert r.status_code == 200 and r.get_json()["rejected"] == 0, r.get_data(as_text=True)
+        return elapsed
+
+    plain = run_batches(detection=False)
+    detected = run_batches(detection=True)
+
+    # Percorso singolo con coda write-behind: risposta 202 e group commit in background
+    app.config["INGEST_ASYNC"] = True
+    start = time.perf_counter()
+    for reading in readings[:single_rows]:
+        r = client.post("/api/data", json=reading)
+        assert r.status_code == 202, r.get_data(as_text=True)
+    async_response_elapsed = time.perf_counter() - start
+    get_ingest_queue().flush()
+    async_elapsed = time.perf_counter() - start
+    queue_metrics = get_ingest_queue().metrics()
+    app.config["INGEST_ASYNC"] = False
+    with app.app_context():
+        # Solo le letture inviate, senza le righe derivate (feature di BVP in ingestione)
+        stored = SensorData.query.filter_by(sensor_type="wrist_bvp").count()
+    assert stored == single_rows * 2 + args.rows * 2, stored
+
+    single_rate = single_rows / single_elapsed
+    batch_rate = args.rows / sum(plain)
+    detect_rate = args.rows / sum(detected)
+    print(f"📊 Database: {os.environ['DATABASE_URL']}")
+    print(f"   /api/data        : {single_rows} righe in {single_elapsed:.2f}s -> {single_rate:,.0f} righe/s")
+    print(f"   /api/data/batch  : {args.rows} righe in {sum(plain):.2f}s -> {batch_rate:,.0f} righe/s "
+          f"(batch da {args.batch_size}, senza rilevamento anomalie)")
+    print(f"   + anomalie       : {args.rows} righe in {sum(detected):.2f}s -> {detect_rate:,.0f} righe/s "
+          f"({(sum(detected) - sum(plain)) / args.rows * 1e6:.1f} µs/lettura per il rilevamento)")
+    print(f"   Speedup batch    : x{batch_rate / single_rate:.1f}")
+    print(f"   /api/data (coda) : {single_rows} righe, risposte in {async_response_elapsed:.2f}s, "
+          f"scritte in {async_elapsed:.2f}s -> {single_rows / async_elapsed:,.0f} righe/s "
+          f"({queue_metrics['commits']} commit, {queue_metrics['rows_per_commit']} righe/commit, "
+          f"commit medio {queue_metrics['commit_ms_avg']} ms)")
+
+    # Costo per lettura limitato: il throughput non cala man mano che le finestre si riempiono
+    quarter = max(1, len(detected) // 4)
+    rates = [args.batch_size * len(part) / sum(part)
+             for part in (detected[i:i + quarter] for i in range(0, len(detected), quarter))]
+    print("   Throughput per blocco di batch (con anomalie): " + ", ".join(f"{r:,.0f}" for r in rates) + " righe/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Benchmark del report giornaliero (reports.py) su rollup sintetici.
+
+Scrive direttamente i rollup al minuto e giornalieri di --patients pazienti con
+sei sensori per due giorni, poi misura: il primo calcolo dei riepiloghi, un
+aggiornamento senza cambiamenti, uno dopo letture tardive sull'1% delle serie e
+la costruzione dei report (lettura dei riepiloghi e rendering con i template)
+per il personale e per ogni paziente.
+
+    python bench_reports.py --patients 200
+    python bench_reports.py --patients 1000 --minutes 240
+"""
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+import numpy as np
+
+SENSORS = {  # media e deviazione standard per minuto
+    "wrist_hr": (70, 12),
+    "wrist_eda": (2, 1.5),
+    "wrist_skin_temperature": (33, 1),
+    "wrist_bvp": (0, 20),
+    "wrist_acc": (1, 0.3),
+    "wrist_ibi": (850, 120),
+}
+
+
+def rollup_rows(user_id, sensor_type, day, minutes, rng):
+    """Bucket al minuto e giornaliero di una serie sintetica."""
+    mean, std = SENSORS[sensor_type]
+    counts = rng.integers(30, 64, minutes)
+    means = rng.normal(mean, std, minutes)
+    sums = means * counts
+    sums_sq = (means ** 2 + (std / 4) ** 2) * counts
+    rows = [{"user_id": user_id, "sensor_type": sensor_type, "resolution": "minute",
+             "bucket": day + timedelta(minutes=m), "count": int(c), "sum": float(s), "sum_sq": float(q),
+             "min": float(v - std / 2), "max": float(v + std / 2)}
+            for m, c, s, q, v in zip(range(minutes), counts, sums, sums_sq, means)]
+    rows.append({"user_id": user_id, "sensor_type": sensor_type, "resolution": "day", "bucket": day,
+                 "count": int(counts.sum()), "sum": float(sums.sum()), "sum_sq": float(sums_sq.sum()),
+                 "min": float(means.min() - std / 2), "max": float(means.max() + std / 2)})
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patients", type=int, default=200, help="pazienti")
+    parser.add_argument("--minutes", type=int, default=1440, help="minuti con letture per giorno e sensore")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="bench_reports_")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+
+    from app import app, db, User, SensorRollup, DailySummary, init_db, refresh_summaries
+    import alerts
+    import reports
+
+    day = datetime(2024, 1, 2)
+    rng = np.random.default_rng(0)
+    with app.app_context():
+        init_db()
+        db.session.execute(User.__table__.insert(), [
+            {"username": f"patient{i}", "email": f"patient{i}@example.com", "password_hash": "-", "is_admin": False}
+            for i in range(args.patients)])
+        user_ids = [uid for (uid,) in db.session.query(User.id)]
+        t0 = time.perf_counter()
+        for user_id in user_ids:
+            for d in (day - timedelta(days=1), day):
+                db.session.execute(SensorRollup.__table__.insert(), [
+                    row for sensor_type in SENSORS for row in rollup_rows(user_id, sensor_type, d, args.minutes, rng)])
+        db.session.commit()
+        buckets = len(user_ids) * len(SENSORS) * 2 * args.minutes
+        print(f"📊 {args.patients} pazienti x {len(SENSORS)} sensori x 2 giorni: {buckets:,} rollup al minuto "
+              f"({time.perf_counter() - t0:.1f}s per scriverli)")
+
+        def timed_refresh(label):
+            t0 = time.perf_counter()
+            written = refresh_summaries(day - timedelta(days=7), day + timedelta(days=1))
+            db.session.commit()
+            print(f"   {label}: {written:,} riepiloghi in {time.perf_counter() - t0:.2f}s")
+
+        timed_refresh("primo calcolo")
+        timed_refresh("nessun cambiamento")
+        # Letture arrivate in ritardo sull'1% delle serie del giorno
+        late = random.Random(0).sample([(u, s) for u in user_ids for s in SENSORS],
+                                       max(1, len(user_ids) * len(SENSORS) // 100))
+        for user_id, sensor_type in late:
+            db.session.query(SensorRollup).filter_by(user_id=user_id, sensor_type=sensor_type,
+                                                     resolution="day", bucket=day).update(
+                {SensorRollup.count: SensorRollup.count + 1})
+        db.session.commit()
+        timed_refresh(f"letture tardive su {len(late)} serie")
+
+        t0 = time.perf_counter()
+        usernames = dict(db.session.query(User.id, User.username).all())
+        report = reports.load_report(db.session, DailySummary.__table__, usernames, day)
+        loaded = time.perf_counter() - t0
+        html_template = app.jinja_env.get_template("email/daily_report.html")
+        text_template = app.jinja_env.get_template("email/daily_report.txt")
+
+        def render(patients):
+            context = {"day": day, "patients": patients, "sensor_names": alerts.SENSOR_NAMES}
+            return text_template.render(context), html_template.render(context)
+
+        t0 = time.perf_counter()
+        _, staff_html = render(report)
+        staff = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        for patient in report:
+            render([patient])
+        per_patient = time.perf_counter() - t0
+        print(f"   report: riepiloghi letti in {loaded * 1000:.0f} ms, personale ({len(staff_html) / 1024:.0f} KB) "
+              f"in {staff * 1000:.0f} ms, {len(report)} report per paziente in {per_patient * 1000:.0f} ms")
+
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
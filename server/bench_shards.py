@@ -0,0 +1,118 @@
+"""Benchmark degli shard di ingestione (shards.py): letture al secondo con 1 e con N shard.
+
+Avvia `flask ingest-workers` su un database di prova e simula i worker gunicorn
+con --senders processi che inviano batch di letture di pazienti a caso tramite
+ShardClient (senza HTTP: si misura il percorso di scrittura). Il tempo si ferma
+quando gli shard hanno scritto tutte le letture; alla fine controlla che
+nel database ci siano tutte le letture inviate.
+
+    python bench_shards.py --shards 4 --patients 40 --rows 200000
+    python bench_shards.py --database-url postgresql://... --shards 8
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from datetime import datetime, timedelta
+
+BASE_PORT = 7300
+AUTHKEY = b"bench-shards-local-only"
+
+
+def make_batch(user_ids, batch_size, start, offset, rng):
+    """Letture HR di pazienti a caso, con un picco ogni 500 letture per paziente."""
+    rows = []
+    for i in range(batch_size):
+        user_id = rng.choice(user_ids)
+        n = offset + i
+        rows.append({"user_id": user_id, "sensor_type": "wrist_hr",
+                     "value": 250.0 if n % 500 == 499 else rng.gauss(70, 3),
+                     "timestamp": start + timedelta(milliseconds=n * 10)})
+    return rows
+
+
+def send(addresses, user_ids, batches, batch_size, seed):
+    import shards
+    client = shards.ShardClient(addresses, AUTHKEY)
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    for b in range(batches):
+        rows = make_batch(user_ids, batch_size, start, (seed * batches + b) * batch_size, rng)
+        while not client.submit(rows):
+            time.sleep(0.05)
+
+
+def run(args, shards_count, database_url, user_ids):
+    import shards
+    addresses = [f"127.0.0.1:{BASE_PORT + i}" for i in range(shards_count)]
+    env = dict(os.environ, DATABASE_URL=database_url, INGEST_SHARDS=",".join(addresses),
+               INGEST_SHARD_AUTHKEY=AUTHKEY.decode(), FLASK_APP="app")
+    workers = subprocess.Popen([sys.executable, "-m", "flask", "ingest-workers"], env=env,
+                               cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL)
+    client = shards.ShardClient(addresses, AUTHKEY)
+    try:
+        while None in client.stats():
+            time.sleep(0.2)
+        before = sum(s["written"] for s in client.stats())
+        batches = args.rows // args.batch_size // args.senders
+        total = batches * args.batch_size * args.senders
+        t0 = time.perf_counter()
+        senders = [multiprocessing.Process(target=send, args=(addresses, user_ids, batches, args.batch_size, i))
+                   for i in range(args.senders)]
+        for p in senders:
+            p.start()
+        for p in senders:
+            p.join()
+        sent = time.perf_counter() - t0
+        while sum(s["written"] + s["failed"] for s in client.stats()) - before < total:
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - t0
+        stats = client.stats()
+        commits = sum(s["commits"] for s in stats)
+        print(f"   {shards_count} shard: {total / elapsed:,.0f} letture/s ({total:,} in {elapsed:.1f}s, "
+              f"inviate in {sent:.1f}s, {commits} commit, fallite {sum(s['failed'] for s in stats)})")
+    finally:
+        workers.terminate()
+        workers.wait(60)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", type=int, default=4, help="shard da confrontare con uno solo")
+    parser.add_argument("--senders", type=int, default=4, help="processi front-end simulati")
+    parser.add_argument("--patients", type=int, default=40, help="pazienti")
+    parser.add_argument("--rows", type=int, default=200000, help="letture per prova")
+    parser.add_argument("--batch-size", type=int, default=500, help="letture per batch inviato")
+    parser.add_argument("--database-url", default=None, help="database di prova (default: SQLite temporaneo)")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="bench_shards_")
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+    from app import app, db, User, SensorData, Anomaly, init_db
+
+    with app.app_context():
+        init_db()
+        db.session.execute(User.__table__.insert(), [
+            {"username": f"shard{i}", "email": f"shard{i}@example.com", "password_hash": "-", "is_admin": False}
+            for i in range(args.patients)])
+        db.session.commit()
+        user_ids = [uid for (uid,) in db.session.query(User.id).filter(User.username.like("shard%"))]
+        dialect = db.engine.dialect.name
+
+    print(f"📊 {args.rows:,} letture HR di {args.patients} pazienti da {args.senders} processi, "
+          f"batch di {args.batch_size} ({dialect})")
+    expected = sum(run(args, count, os.environ["DATABASE_URL"], user_ids) for count in sorted({1, args.shards}))
+
+    with app.app_context():
+        readings = db.session.query(db.func.count(SensorData.id)).scalar()
+        anomalies = db.session.query(db.func.count(Anomaly.id)).scalar()
+    print(f"   scritte {readings:,} letture su {expected:,} inviate, {anomalies:,} anomalie")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Benchmark di calculate_stats su un database popolato (default 10 milioni di righe).
+
+Il database viene creato e popolato solo se vuoto, quindi si può riusare tra più
+esecuzioni passando lo stesso --database-url.
+
+    python bench_stats.py --database-url sqlite:////tmp/bench_stats.db --rows 10000000
+    python bench_stats.py --database-url sqlite:////tmp/bench_stats.db --legacy
+"""
+import os
+import time
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import rollups
+
+SENSORS = ["wrist_acc", "wrist_bvp", "wrist_eda", "wrist_hr", "wrist_ibi", "wrist_skin_temperature"]
+
+
+def seed(db, User, SensorData, SensorRollup, rows, users, days, chunk=200000):
+    """Crea `users` utenti e inserisce `rows` letture distribuite negli ultimi `days` giorni."""
+    user_ids = []
+    for i in range(users):
+        u = User(username=f"patient{i}", email=f"patient{i}@example.com")
+        u.set_password("bench")
+        db.session.add(u)
+        db.session.flush()
+        user_ids.append(u.id)
+    db.session.commit()
+
+    rng = np.random.default_rng(42)
+    now = datetime.utcnow()
+    span = days * 86400
+    inserted = 0
+    start = time.perf_counter()
+    while inserted < rows:
+        n = min(chunk, rows - inserted)
+        uids = rng.choice(user_ids, n)
+        stypes = rng.integers(0, len(SENSORS), n)
+        values = rng.normal(70, 15, n)
+        offsets = rng.uniform(0, span, n)
+        db.session.execute(SensorData.__table__.insert(), [
+            {"user_id": int(u), "sensor_type": SENSORS[s], "value": float(v),
+             "timestamp": now - timedelta(seconds=float(o))}
+            for u, s, v, o in zip(uids, stypes, values, offsets)
+        ])
+        db.session.commit()
+        inserted += n
+        print(f"   ... {inserted:,}/{rows:,} righe", end="\r")
+    print(f"\n🌱 Popolamento completato in {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    rollups.backfill(db.session, SensorData.__table__, SensorRollup.__table__)
+    db.session.commit()
+    print(f"🧮 Rollup calcolati in {time.perf_counter() - start:.1f}s")
+
+
+def calculate_stats_legacy(db, User, SensorData, days=7):
+    """Implementazione precedente (N+1 query, aggregazione in Python), per confronto."""
+    stats = {}
+    since = datetime.utcnow() - timedelta(days=days)
+    for u in User.query.all():
+        stats[u.username] = {}
+        sensor_types = db.session.query(SensorData.sensor_type).filter(
+            SensorData.user_id == u.id, SensorData.timestamp >= since
+        ).distinct()
+        for (stype,) in sensor_types:
+            values = [d.value for d in SensorData.query.filter_by(user_id=u.id, sensor_type=stype).all()]
+            if values:
+                stats[u.username][stype] = {"mean": sum(values) / len(values), "min": min(values),
+                                            "max": max(values), "count": len(values)}
+    return stats
+
+
+def timed(label, fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    print(f"   {label:<40} {best * 1000:10.1f} ms (migliore di {repeat})")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10_000_000, help="righe di SensorData da generare")
+    parser.add_argument("--users", type=int, default=20, help="numero di pazienti")
+    parser.add_argument("--days", type=int, default=30, help="giorni di storico generati")
+    parser.add_argument("--repeat", type=int, default=3, help="ripetizioni per misura")
+    parser.add_argument("--legacy", action="store_true", help="misura anche l'implementazione precedente (lenta)")
+    parser.add_argument("--database-url", default=None, help="database di prova (default: SQLite temporaneo)")
+    args = parser.parse_args()
+
+    os.environ["DATABASE_URL"] = args.database_url or \
+        f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='bench_stats_'), 'bench.db')}"
+
+    from app import app, db, User, SensorData, SensorRollup, calculate_stats, init_db, stats_query
+
+    with app.app_context():
+        init_db()
+        existing = db.session.query(SensorData.id).limit(1).first()
+        if existing is None:
+            seed(db, User, SensorData, SensorRollup, args.rows, args.users, args.days)
+        total = db.session.query(SensorData.id).count()
+        one_user = User.query.first()
+        print(f"📊 Database: {os.environ['DATABASE_URL']} ({total:,} righe)")
+
+        since = datetime.utcnow() - timedelta(days=7)
+        timed("query grezza 7 giorni admin", lambda: stats_query(since).all(), args.repeat)
+        timed("query grezza 7 giorni utente", lambda: stats_query(since, one_user.id).all(), args.repeat)
+        timed("calculate_stats(days=7) admin", lambda: calculate_stats(days=7), args.repeat)
+        timed("calculate_stats(days=7, user=...)", lambda: calculate_stats(days=7, user=one_user), args.repeat)
+        timed("calculate_stats(days=30) admin", lambda: calculate_stats(days=30), args.repeat)
+        if args.legacy:
+            timed("legacy calculate_stats(days=7) admin",
+                  lambda: calculate_stats_legacy(db, User, SensorData, days=7), 1)
+
+
+if __name__ == "__main__":
+    main()
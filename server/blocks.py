@@ -0,0 +1,300 @@
+"""Archiviazione a blocchi binari per i sensori ad alta frequenza (BVP, ACC).
+
+Invece di una riga di sensor_data per campione, le letture di un sensore vengono
+raccolte in blocchi di BLOCK_SECONDS secondi allineati all'epoca: una riga per
+blocco con l'inizio del blocco, il numero di campioni, gli scarti dei timestamp
+dall'inizio (int32 in microsecondi) e i valori float32, uno o tre canali (per i
+sensori a tre assi si salvano gli assi e il modulo si ricalcola in lettura).
+Sono circa 8 byte per campione (16 con tre assi) contro le decine di una riga
+indicizzata.
+
+Una lettura per intervallo legge solo i blocchi che lo intersecano (indice unico
+su utente, sensore, inizio) e li decodifica con np.frombuffer, senza copie né
+oggetti Python per campione. I rollup e il rilevamento anomalie restano quelli
+delle letture: i blocchi sostituiscono solo i dati grezzi.
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import select, delete, update, func
+from sqlalchemy.dialects import postgresql, sqlite
+
+import motion
+
+BLOCK_SECONDS = 10
+# Nuove scritture di un blocco inserito in concorrenza da un'altra transazione
+WRITE_RETRIES = 3
+# Blocchi per INSERT (limite di parametri di SQLite)
+INSERT_CHUNK = 1000
+
+_OFFSET_DTYPE = np.dtype("<i4")
+_VALUE_DTYPE = np.dtype("<f4")
+
+
+def encode(offsets, data):
+    """Blob degli scarti (µs, int32) e dei valori (float32, n o n x canali)."""
+    return (np.ascontiguousarray(offsets, dtype=_OFFSET_DTYPE).tobytes(),
+            np.ascontiguousarray(data, dtype=_VALUE_DTYPE).tobytes())
+
+
+def decode(start, offsets_blob, data_blob, channels):
+    """Timestamps datetime64[us] e valori float32 (n o n x canali) di un blocco, senza copiare i blob."""
+    offsets = np.frombuffer(offsets_blob, dtype=_OFFSET_DTYPE)
+    data = np.frombuffer(data_blob, dtype=_VALUE_DTYPE)
+    if channels > 1:
+        data = data.reshape(-1, channels)
+    return np.datetime64(start, "us") + offsets.astype("timedelta64[us]"), data
+
+
+def _channels(data):
+    return data.shape[1] if data.ndim == 2 else 1
+
+
+def merge(timestamps, data, other_timestamps, other_data):
+    """Unisce due serie di un blocco in ordine di tempo.
+
+    Se una sola delle due ha tre canali si tiene il modulo, come in BlockStore.read.
+    """
+    if _channels(data) != _channels(other_data):
+        data, other_data = [motion.magnitude(*d.astype(np.float64).T) if _channels(d) == 3 else d
+                             for d in (data, other_data)]
+    timestamps = np.concatenate([timestamps, other_timestamps])
+    data = np.concatenate([data, other_data])
+    order = np.argsort(timestamps, kind="stable")
+    return timestamps[order], data[order]
+
+
+class BlockStore:
+    """Blocchi di un insieme di sensori nella tabella sensor_block."""
+
+    def __init__(self, table, sensors=(), block_seconds=BLOCK_SECONDS):
+        self.table = table
+        self.sensors = frozenset(sensors)
+        self.block = np.timedelta64(block_seconds, "s").astype("timedelta64[us]")
+        self.block_seconds = block_seconds
+
+    def handles(self, sensor_type):
+        return sensor_type in self.sensors
+
+    def _slot(self, ts):
+        """Inizio del blocco che contiene ts (datetime)."""
+        return np.datetime64(ts, "us") - (np.datetime64(ts, "us") - np.datetime64(0, "us")) % self.block
+
+    # ---------- scritture ----------
+    def write_rows(self, session, rows):
+        """Scrive le letture (dizionari come in store_readings) dei sensori gestiti, per serie."""
+        series = {}
+        for row in rows:
+            series.setdefault((row["user_id"], row["sensor_type"]), []).append(row)
+        for (user_id, sensor_type), items in series.items():
+            n = len(items)
+            timestamps = np.array([r["timestamp"] for r in items], dtype="datetime64[us]")
+            if items[0].get("x") is not None and all(r.get("x") is not None for r in items):
+                data = np.array([(r["x"], r["y"], r["z"]) for r in items], dtype=np.float64)
+            else:
+                data = np.fromiter((r["value"] for r in items), np.float64, n)
+            self.write(session, user_id, sensor_type, timestamps, data)
+
+    def write(self, session, user_id, sensor_type, timestamps, data, retries=WRITE_RETRIES):
+        """Scrive una serie (timestamps datetime64, dati n o n x 3) nei blocchi, unendola a quelli esistenti.
+
+        I blocchi già presenti vengono letti con SELECT ... FOR UPDATE, così due
+        scritture concorrenti sulla stessa coda della serie si accodano invece di
+        perdere l'una i campioni dell'altra. Un blocco nuovo inserito nel frattempo
+        da un'altra transazione viola l'indice unico (utente, sensore, inizio):
+        l'inserimento lo salta e quei campioni vengono riuniti al blocco esistente.
+        """
+        if not len(timestamps):
+            return
+        order = np.argsort(timestamps, kind="stable")
+        timestamps = timestamps.astype("datetime64[us]")[order]
+        data = np.asarray(data)[order]
+        channels = data.shape[1] if data.ndim == 2 else 1
+
+        slots = timestamps - (timestamps - np.datetime64(0, "us")) % self.block
+        bounds = np.flatnonzero(np.r_[True, slots[1:] != slots[:-1], True])
+        starts = [slots[i].astype(datetime) for i in bounds[:-1]]
+
+        # Blocchi già presenti per gli stessi intervalli (tipicamente solo il primo del batch)
+        t = self.table
+        existing = {row.start: row for row in session.execute(
+            select(t.c.id, t.c.start, t.c.count, t.c.channels, t.c.offsets, t.c.data).where(
+                t.c.user_id == user_id, t.c.sensor_type == sensor_type,
+                t.c.start >= starts[0], t.c.start <= starts[-1], t.c.start.in_(starts)
+            ).with_for_update()
+        )}
+
+        inserts, pending = [], {}
+        for start, i, j in zip(starts, bounds[:-1], bounds[1:]):
+            block_ts, block_data = timestamps[i:j], data[i:j]
+            old = existing.get(start)
+            if old is not None:
+                old_ts, old_data = decode(old.start, old.offsets, old.data, old.channels)
+                block_ts, block_data = merge(old_ts, old_data, block_ts, block_data)
+            offsets, payload = encode((block_ts - np.datetime64(start, "us")).astype(np.int64), block_data)
+            values = {"count": len(block_ts), "end": block_ts[-1].astype(datetime), "channels": _channels(block_data),
+                      "offsets": offsets, "data": payload}
+            if old is not None:
+                session.execute(update(t).where(t.c.id == old.id).values(**values))
+            else:
+                inserts.append({"user_id": user_id, "sensor_type": sensor_type, "start": start, **values})
+                pending[start] = (i, j)
+
+        conflicts = [pending[start] for start in self._insert_new(session, inserts)]
+        if conflicts:
+            if retries <= 0:
+                raise RuntimeError(f"Concurrent writes kept conflicting on blocks of {sensor_type} for user {user_id}")
+            rest = np.concatenate([np.arange(i, j) for i, j in conflicts])
+            self.write(session, user_id, sensor_type, timestamps[rest], data[rest], retries - 1)
+
+    def _insert_new(self, session, inserts):
+        """Inserisce i blocchi nuovi saltando quelli già creati da altre transazioni; restituisce i loro inizi."""
+        if not inserts:
+            return []
+        dialect = session.get_bind().dialect.name
+        if dialect == "postgresql":
+            stmt = postgresql.insert(self.table)
+        elif dialect == "sqlite":
+            stmt = sqlite.insert(self.table)
+        else:
+            raise NotImplementedError(f"Block insert not supported on '{dialect}'")
+        stmt = stmt.on_conflict_do_nothing(index_elements=["user_id", "sensor_type", "start"])
+        written = set()
+        for k in range(0, len(inserts), INSERT_CHUNK):
+            chunk = inserts[k:k + INSERT_CHUNK]
+            written.update(session.execute(stmt.values(chunk).returning(self.table.c.start)).scalars())
+        return [row["start"] for row in inserts if row["start"] not in written]
+
+    def merge_duplicates(self, session):
+        """Unisce i blocchi con lo stesso (utente, sensore, inizio), prima di creare l'indice unico.
+
+        Restituisce il numero di blocchi riuniti.
+        """
+        t = self.table
+        key = (t.c.user_id, t.c.sensor_type, t.c.start)
+        duplicated = session.execute(select(*key).group_by(*key).having(func.count() > 1)).all()
+        for user_id, sensor_type, start in duplicated:
+            where = (t.c.user_id == user_id, t.c.sensor_type == sensor_type, t.c.start == start)
+            rows = session.execute(select(t.c.channels, t.c.offsets, t.c.data).where(*where)).all()
+            block_ts, block_data = decode(start, rows[0].offsets, rows[0].data, rows[0].channels)
+            for row in rows[1:]:
+                block_ts, block_data = merge(block_ts, block_data, *decode(start, row.offsets, row.data, row.channels))
+            offsets, payload = encode((block_ts - np.datetime64(start, "us")).astype(np.int64), block_data)
+            session.execute(delete(t).where(*where))
+            session.execute(t.insert().values(
+                user_id=user_id, sensor_type=sensor_type, start=start, end=block_ts[-1].astype(datetime),
+                count=len(block_ts), channels=_channels(block_data), offsets=offsets, data=payload))
+        return len(duplicated)
+
+    # ---------- letture ----------
+    def range_query(self, user_id, sensor_type, since=None, until=None):
+        """Blocchi della serie che intersecano [since, until), in ordine di inizio."""
+        t = self.table
+        query = select(t.c.start, t.c.channels, t.c.offsets, t.c.data).where(
+            t.c.user_id == user_id, t.c.sensor_type == sensor_type)
+        if since is not None:
+            # I blocchi sono allineati: quelli che contengono since iniziano al più un blocco prima
+            query = query.where(t.c.start > since - timedelta(seconds=self.block_seconds))
+        if until is not None:
+            query = query.where(t.c.start < until)
+        return query.order_by(t.c.start)
+
+    def read(self, session, user_id, sensor_type, since=None, until=None):
+        """Serie nell'intervallo come (timestamps datetime64[us], valori float64, assi n x 3 o None).
+
+        Per i blocchi a tre canali il valore è il modulo degli assi.
+        """
+        parts = [decode(row.start, row.offsets, row.data, row.channels) + (row.channels,)
+                 for row in session.execute(self.range_query(user_id, sensor_type, since, until))]
+        if not parts:
+            return np.array([], dtype="datetime64[us]"), np.array([], dtype=np.float64), None
+        timestamps = np.concatenate([p[0] for p in parts])
+        if all(p[2] == 3 for p in parts):
+            axes = np.concatenate([p[1] for p in parts]).astype(np.float64)
+            values = motion.magnitude(*axes.T)
+        else:
+            axes = None
+            values = np.concatenate([motion.magnitude(*p[1].astype(np.float64).T) if p[2] == 3 else p[1]
+                                     for p in parts]).astype(np.float64)
+        if len(parts) > 1 and (timestamps[1:] < timestamps[:-1]).any():
+            # Blocchi con lo stesso inizio ma canali diversi: si riordina
+            order = np.argsort(timestamps, kind="stable")
+            timestamps, values = timestamps[order], values[order]
+            axes = axes[order] if axes is not None else None
+        keep = np.ones(len(timestamps), dtype=bool)
+        if since is not None:
+            keep &= timestamps >= np.datetime64(since, "us")
+        if until is not None:
+            keep &= timestamps < np.datetime64(until, "us")
+        if not keep.all():
+            timestamps, values = timestamps[keep], values[keep]
+            axes = axes[keep] if axes is not None else None
+        return timestamps, values, axes
+
+    def extent(self, session, user_id, sensor_type, until=None):
+        """(primo, ultimo) timestamp della serie, come series_extent_query."""
+        t = self.table
+        query = select(func.min(t.c.start), func.max(t.c.end)).where(
+            t.c.user_id == user_id, t.c.sensor_type == sensor_type)
+        if until is not None:
+            query = query.where(t.c.start < until)
+        first_block, last = session.execute(query).one()
+        if first_block is None:
+            return None, None
+        # Il primo campione può essere dopo l'inizio del blocco
+        first = self.read(session, user_id, sensor_type, first_block,
+                          first_block + timedelta(seconds=self.block_seconds))[0]
+        if until is not None and last >= until:
+            # L'ultimo blocco supera until: si cerca l'ultimo campione prima di until
+            tail = self.read(session, user_id, sensor_type, until - timedelta(seconds=self.block_seconds), until)[0]
+            earlier = session.execute(query.with_only_columns(func.max(t.c.end)).where(t.c.end < until)).scalar()
+            candidates = [ts for ts in (earlier, tail[-1].astype(datetime) if len(tail) else None) if ts is not None]
+            last = max(candidates) if candidates else first_block
+        return (first[0].astype(datetime) if len(first) else first_block), last
+
+    def series(self, session, since=None):
+        """Serie (user_id, sensor_type) con blocchi, dall'istante since se indicato."""
+        t = self.table
+        query = select(t.c.user_id, t.c.sensor_type).distinct()
+        if since is not None:
+            query = query.where(t.c.start > since - timedelta(seconds=self.block_seconds))
+        return session.execute(query).all()
+
+    def count(self, session, user_id, sensor_type, since, until):
+        return len(self.read(session, user_id, sensor_type, since, until)[0])
+
+    # ---------- cancellazioni ----------
+    def delete(self, session, user_id, sensor_type, since, until):
+        """Elimina i campioni della serie in [since, until); i blocchi a cavallo vengono riscritti."""
+        t = self.table
+        series = (t.c.user_id == user_id, t.c.sensor_type == sensor_type)
+        edges = []
+        for ts in (since, until):
+            slot = self._slot(ts).astype(datetime)
+            if slot != ts:
+                edges.append(slot)
+        kept = []
+        for start in edges:
+            row = session.execute(select(t.c.start, t.c.channels, t.c.offsets, t.c.data).where(
+                *series, t.c.start == start)).first()
+            if row is not None:
+                timestamps, data = decode(row.start, row.offsets, row.data, row.channels)
+                outside = (timestamps < np.datetime64(since, "us")) | (timestamps >= np.datetime64(until, "us"))
+                kept.append((timestamps[outside], data[outside]))
+        session.execute(delete(t).where(
+            *series, t.c.start > since - timedelta(seconds=self.block_seconds), t.c.start < until))
+        for timestamps, data in kept:
+            self.write(session, user_id, sensor_type, timestamps, np.array(data))
+
+    def count_before(self, session, cutoff):
+        """Campioni nei blocchi che finiscono prima di cutoff (allineato ai blocchi)."""
+        t = self.table
+        return session.execute(select(func.coalesce(func.sum(t.c.count), 0)).where(
+            t.c.start <= cutoff - timedelta(seconds=self.block_seconds))).scalar()
+
+    def delete_before(self, session, cutoff):
+        """Elimina i blocchi che finiscono prima di cutoff (allineato ai blocchi); restituisce i campioni."""
+        t = self.table
+        samples = self.count_before(session, cutoff)
+        session.execute(delete(t).where(t.c.start <= cutoff - timedelta(seconds=self.block_seconds)))
+        return samples
@@ -0,0 +1,110 @@
+"""Cache in memoria (LRU con scadenza) per lookup utenti e aggregati delle dashboard.
+
+Ogni cache è limitata in numero di voci e, opzionalmente, in durata; conta hit,
+miss, espulsioni e invalidazioni. Le cache create con register() compaiono in
+stats(), esposto dalle route di monitoraggio. Come il broker live, le cache sono
+per processo.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+# Valore restituito da get() quando la chiave manca: None è un valore memorizzabile
+MISSING = object()
+
+_registry = {}
+
+
+class LRUCache:
+    """Dizionario limitato: espelle la voce usata meno di recente e quelle più vecchie di ttl secondi."""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # chiave -> (scadenza, valore)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            expires, value = entry
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def update(self, predicate, fn):
+        """Sostituisce il valore delle voci con predicate(chiave) vero con fn(chiave, valore).
+
+        La scadenza resta quella originale; se fn restituisce MISSING la voce viene rimossa.
+        """
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                expires, value = self._data[key]
+                value = fn(key, value)
+                if value is MISSING:
+                    del self._data[key]
+                    self.invalidations += 1
+                else:
+                    self._data[key] = (expires, value)
+
+    def invalidate(self, predicate=None):
+        """Rimuove le voci con predicate(chiave) vero (tutte se predicate è None)."""
+        with self._lock:
+            keys = [k for k in self._data if predicate is None or predicate(k)]
+            for key in keys:
+                del self._data[key]
+            self.invalidations += len(keys)
+
+    def pop(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+
+def register(name, maxsize=1024, ttl=None):
+    """Crea una cache e la rende visibile in stats() con il nome indicato."""
+    cache = LRUCache(maxsize, ttl)
+    _registry[name] = cache
+    return cache
+
+
+def stats():
+    """Contatori di tutte le cache registrate: {nome: {...}}."""
+    return {name: cache.stats() for name, cache in _registry.items()}
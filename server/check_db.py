@@ -1,13 +1,105 @@
-import sqlite3
+"""Controllo del database: colonne e indici di sensor_data e piano di esecuzione
+(EXPLAIN) delle query usate dalle dashboard.
 
-conn = sqlite3.connect("health_monitoring.db")
-cursor = conn.cursor()
+    python check_db.py            # usa DATABASE_URL o health_monitoring.db
+    python check_db.py --strict   # esce con codice 1 se una query scansiona un'intera tabella
+"""
+import sys
+import argparse
+from datetime import datetime, timedelta
 
-cursor.execute("PRAGMA table_info(sensor_data)")
-columns = cursor.fetchall()
+from sqlalchemy import inspect
 
-print("📋 Colonne della tabella sensor_data:")
-for col in columns:
-    print(col)
+import partitions
 
-conn.close()
+from app import (app, db, User, stats_query, sensor_types_query, chart_query,
+                 recent_anomalies_query, rollup_stats_query, rollup_chart_query,
+                 series_extent_query, block_query)
+
+
+def dashboard_queries(user_id, days=7):
+    """Query eseguite da calculate_stats, prepare_chart_data e get_recent_anomalies."""
+    since = datetime.utcnow() - timedelta(days=days)
+    return [
+        ("calculate_stats (admin, grezzi)", stats_query(since)),
+        ("calculate_stats (utente, grezzi)", stats_query(since, user_id)),
+        ("calculate_stats (admin, rollup)", rollup_stats_query("hour", since)),
+        ("calculate_stats (utente, rollup)", rollup_stats_query("hour", since, user_id)),
+        ("prepare_chart_data (sensori)", sensor_types_query(user_id, since)),
+        ("prepare_chart_data (estensione)", series_extent_query(user_id, "wrist_hr")),
+        ("prepare_chart_data (serie grezza)", chart_query(user_id, "wrist_hr", since)),
+        ("prepare_chart_data (serie rollup)", rollup_chart_query(user_id, "wrist_hr", "minute", since)),
+        ("prepare_chart_data (blocchi)", block_query(user_id, "wrist_bvp", since)),
+        ("get_recent_anomalies (admin)", recent_anomalies_query()),
+        ("get_recent_anomalies (utente)", recent_anomalies_query(user_id=user_id)),
+    ]
+
+
+def explain(query):
+    """Restituisce le righe del piano di esecuzione per il dialetto in uso."""
+    dialect = db.engine.dialect
+    # Query ORM o select() Core
+    compiled = getattr(query, "statement", query).compile(dialect=dialect)
+    params = compiled.params
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    prefix = "EXPLAIN QUERY PLAN " if dialect.name == "sqlite" else "EXPLAIN "
+    with db.engine.connect() as conn:
+        rows = conn.exec_driver_sql(prefix + str(compiled), params).fetchall()
+    if dialect.name == "sqlite":
+        return [row[-1] for row in rows]
+    return [row[0] for row in rows]
+
+
+def is_full_scan(plan):
+    # Subquery (es. la UNION ALL delle partizioni) e partizioni, già limitate alla finestra, non contano
+    subqueries = {line.split()[-1] for line in plan if line.startswith(("CO-ROUTINE ", "MATERIALIZE "))}
+    for line in plan:
+        if line.startswith("SCAN ") and "INDEX" not in line:
+            name = line.split()[1]
+            if name not in subqueries and not partitions.is_partition(name):
+                return True
+        if "Seq Scan on" in line:
+            return True
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--strict", action="store_true", help="fallisce se una query fa una scansione completa")
+    args = parser.parse_args()
+
+    with app.app_context():
+        inspector = inspect(db.engine)
+
+        print("📋 Colonne della tabella sensor_data:")
+        for col in inspector.get_columns("sensor_data"):
+            print(f"   {col['name']} {col['type']}")
+
+        print("\n🗂️ Indici della tabella sensor_data:")
+        for index in inspector.get_indexes("sensor_data"):
+            print(f"   {index['name']}: {', '.join(index['column_names'])}")
+
+        user = User.query.filter_by(is_admin=False).first() or User.query.first()
+        user_id = user.id if user else 1
+
+        regressions = []
+        print(f"\n🔍 Piani di esecuzione ({db.engine.dialect.name}):")
+        for name, query in dashboard_queries(user_id):
+            plan = explain(query)
+            print(f"\n-- {name}")
+            for line in plan:
+                print(f"   {line}")
+            if is_full_scan(plan):
+                regressions.append(name)
+
+    if regressions:
+        print(f"\n⚠️ Scansione completa di una tabella in: {', '.join(regressions)}")
+        if args.strict:
+            sys.exit(1)
+    else:
+        print("\n✅ Nessuna scansione completa")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""Import bulk di una cartella di CSV in stile Empatica (dataset_mattia/) nel database.
+
+Ogni file <sensore>.csv ha una colonna timestamp (epoch in ms) e le colonne di
+valori indicate in SENSOR_FILES (controllate sull'intestazione); viene letto a blocchi con pandas e convertito in array NumPy, con gli
+stessi valori che invierebbe client_send_multi.py ma con i timestamp originali.
+Per wrist_acc si salvano i tre assi e, come valore, il loro modulo (vedi
+motion.py). Le righe vengono scritte con INSERT bulk
+(executemany sul driver) su SQLite e con COPY su PostgreSQL, nelle partizioni
+giuste se il partizionamento è attivo.
+"""
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import motion
+
+# Sensore -> colonne dei valori nel CSV (intestazioni dei file Empatica)
+SENSOR_FILES = {
+    "wrist_acc": ["ax", "ay", "az"],
+    "wrist_bvp": ["bvp"],
+    "wrist_eda": ["eda"],
+    "wrist_hr": ["hr"],
+    "wrist_ibi": ["duration"],
+    "wrist_skin_temperature": ["temp"]
+}
+TIMESTAMP_COLUMN = "timestamp"
+
+CHUNK_ROWS = 200_000
+
+# Timestamp senza fuso orario nel CSV per COPY
+_COPY_DATETIME = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def sensor_paths(folder):
+    """{sensore: percorso} dei file presenti nella cartella."""
+    paths = {}
+    for sensor in SENSOR_FILES:
+        path = os.path.join(folder, f"{sensor}.csv")
+        if os.path.exists(path):
+            paths[sensor] = path
+    return paths
+
+
+def missing_columns(path, sensor):
+    """Colonne attese (timestamp e quelle di SENSOR_FILES) assenti dall'intestazione del file."""
+    header = pd.read_csv(path, nrows=0).columns
+    return [column for column in [TIMESTAMP_COLUMN, *SENSOR_FILES[sensor]] if column not in header]
+
+
+def check_folder(folder):
+    """[(file, colonne mancanti)] dei file della cartella con un'intestazione diversa da quella attesa."""
+    problems = []
+    for sensor, path in sensor_paths(folder).items():
+        missing = missing_columns(path, sensor)
+        if missing:
+            problems.append((path, missing))
+    return problems
+
+
+def read_sensor_file(path, sensor, chunk_rows=CHUNK_ROWS):
+    """Legge un CSV sensore; restituisce (timestamps datetime64[ms], values, axes, scartate) ordinati per tempo.
+
+    axes è un array (n, 3) per wrist_acc (values è il modulo), None per gli altri
+    sensori. Righe con timestamp o valori mancanti o non finiti vengono scartate
+    (come fa l'API); ValueError se mancano colonne di SENSOR_FILES.
+    """
+    columns = SENSOR_FILES[sensor]
+    missing = missing_columns(path, sensor)
+    if missing:
+        raise ValueError(f"{path}: missing columns {', '.join(missing)}")
+    parts = []
+    rows = 0
+    for chunk in pd.read_csv(path, usecols=[TIMESTAMP_COLUMN, *columns], chunksize=chunk_rows):
+        rows += len(chunk)
+        timestamps = pd.to_numeric(chunk[TIMESTAMP_COLUMN], errors="coerce").to_numpy(dtype=np.float64)
+        data = chunk[columns].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=np.float64)
+        keep = np.isfinite(timestamps) & np.isfinite(data).all(axis=1)
+        parts.append((timestamps[keep].astype(np.int64), data[keep]))
+    if not parts:
+        parts = [(np.array([], dtype=np.int64), np.empty((0, len(columns))))]
+    timestamps = np.concatenate([p[0] for p in parts])
+    data = np.concatenate([p[1] for p in parts])
+    order = np.argsort(timestamps, kind="stable")
+    timestamps, data = timestamps[order].astype("datetime64[ms]"), data[order]
+    if sensor == motion.ACC_SENSOR:
+        return timestamps, motion.magnitude(*data.T), data, rows - len(timestamps)
+    return timestamps, data[:, 0], None, rows - len(timestamps)
+
+
+def read_folder(folder, jobs=1, chunk_rows=CHUNK_ROWS):
+    """Legge tutti i file della cartella; con jobs > 1 un file per processo.
+
+    Genera (sensore, timestamps, values, axes, scartate) nell'ordine di SENSOR_FILES.
+    """
+    paths = sensor_paths(folder)
+    if jobs > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(paths))) as pool:
+            futures = {sensor: pool.submit(read_sensor_file, path, sensor, chunk_rows)
+                       for sensor, path in paths.items()}
+            for sensor, future in futures.items():
+                yield (sensor, *future.result())
+    else:
+        for sensor, path in paths.items():
+            yield (sensor, *read_sensor_file(path, sensor, chunk_rows))
+
+
+def bulk_insert(session, table, user_id, sensor_type, timestamps, values, axes=None):
+    """Scrive una serie in table senza passare dall'ORM: executemany su SQLite, COPY su PostgreSQL.
+
+    axes, se presente, è l'array (n, 3) degli assi x/y/z.
+    """
+    n = len(values)
+    names = ["user_id", "sensor_type", "value", "timestamp"] + (list(motion.AXES) if axes is not None else [])
+    columns = [[user_id] * n, [sensor_type] * n, values.tolist()]
+    connection = session.connection()
+    dialect = connection.dialect.name
+    if dialect == "sqlite":
+        # Stessa rappresentazione testuale dei DateTime scritti da SQLAlchemy
+        text_ts = np.datetime_as_string(timestamps.astype("datetime64[us]"), unit="us").astype("U26")
+        # "2021-08-19T10:53:43.000000" -> "2021-08-19 10:53:43.000000" sostituendo il carattere in posizione 10
+        text_ts.view(np.uint32).reshape(-1, 26)[:, 10] = ord(" ")
+        columns.append(text_ts.tolist())
+        if axes is not None:
+            columns.extend(axes.T.tolist())
+        cursor = connection.connection.driver_connection.cursor()
+        cursor.executemany(
+            f"INSERT INTO {table.name} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})",
+            zip(*columns)
+        )
+        cursor.close()
+    elif dialect == "postgresql":
+        frame = pd.DataFrame({"user_id": user_id, "sensor_type": sensor_type, "value": values,
+                              "timestamp": timestamps.astype("datetime64[us]")})
+        if axes is not None:
+            for axis, column in zip(motion.AXES, axes.T):
+                frame[axis] = column
+        buffer = io.StringIO()
+        frame.to_csv(buffer, header=False, index=False, date_format=_COPY_DATETIME)
+        buffer.seek(0)
+        cursor = connection.connection.driver_connection.cursor()
+        cursor.copy_expert(f"COPY {table.name} ({', '.join(names)}) FROM STDIN WITH (FORMAT csv)", buffer)
+        cursor.close()
+    else:
+        columns.append(timestamps.astype("datetime64[us]").tolist())
+        if axes is not None:
+            columns.extend(axes.T.tolist())
+        session.execute(table.insert(), [dict(zip(names, row)) for row in zip(*columns)])
@@ -0,0 +1,65 @@
+"""Configurazione del database da DATABASE_URL.
+
+SQLite (default) viene aperto in WAL con synchronous=NORMAL, busy timeout e mmap,
+così più processi (es. gunicorn -w 4) leggono mentre uno scrive e gli scrittori
+attendono il lock invece di fallire con "database is locked". Su PostgreSQL si
+usa un pool di connessioni dimensionato per worker, con pre-ping e riciclo.
+"""
+import os
+
+from sqlalchemy import event
+
+DEFAULT_DATABASE_URL = "sqlite:///health_monitoring.db"
+
+# Nell'ordine in cui vengono eseguiti su ogni nuova connessione: il busy timeout
+# per primo, così anche il passaggio a WAL attende un eventuale lock
+SQLITE_PRAGMAS = {
+    "busy_timeout": 5000,         # ms di attesa sul lock prima di "database is locked"
+    "journal_mode": "WAL",        # lettori e scrittore non si bloccano a vicenda
+    "synchronous": "NORMAL",      # fsync al checkpoint, non a ogni commit (sicuro in WAL)
+    "mmap_size": 256 * 1024 * 1024,
+}
+
+# Pool PostgreSQL per processo: con gunicorn -w 4 al massimo 4 * (5 + 10) connessioni
+POSTGRES_POOL_SIZE = 5
+POSTGRES_MAX_OVERFLOW = 10
+POSTGRES_POOL_RECYCLE = 1800
+POSTGRES_POOL_TIMEOUT = 30
+
+
+def database_url(environ=os.environ):
+    """URL del database da DATABASE_URL (default: SQLite locale)."""
+    url = environ.get("DATABASE_URL") or DEFAULT_DATABASE_URL
+    # "postgres://" (usato da alcuni provider) non è più accettato da SQLAlchemy 1.4+;
+    # senza driver esplicito si usa psycopg2, quello installato da requirements.txt
+    for scheme in ("postgres://", "postgresql://"):
+        if url.startswith(scheme):
+            url = "postgresql+psycopg2://" + url[len(scheme):]
+    return url
+
+
+def engine_options(url, environ=os.environ):
+    """SQLALCHEMY_ENGINE_OPTIONS per il backend dell'URL; il pool è regolabile con DB_POOL_*."""
+    if url.startswith("postgresql"):
+        return {
+            "pool_size": int(environ.get("DB_POOL_SIZE", POSTGRES_POOL_SIZE)),
+            "max_overflow": int(environ.get("DB_MAX_OVERFLOW", POSTGRES_MAX_OVERFLOW)),
+            "pool_recycle": int(environ.get("DB_POOL_RECYCLE", POSTGRES_POOL_RECYCLE)),
+            "pool_timeout": int(environ.get("DB_POOL_TIMEOUT", POSTGRES_POOL_TIMEOUT)),
+            # Scarta le connessioni chiuse dal server (riavvii, timeout di inattività)
+            "pool_pre_ping": True,
+        }
+    return {}
+
+
+def apply_sqlite_pragmas(engine, pragmas=SQLITE_PRAGMAS):
+    """Esegue i PRAGMA su ogni connessione SQLite aperta dall'engine (no-op sugli altri backend)."""
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
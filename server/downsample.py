@@ -0,0 +1,105 @@
+"""Downsampling delle serie temporali per i grafici delle dashboard.
+
+Le serie arrivano come array NumPy di tempi (secondi epoch) e valori ordinati per
+tempo. L'ampiezza dei bucket viene scelta dall'intervallo richiesto, così il numero
+di punti resta entro il budget qualunque sia la frequenza del sensore.
+"""
+import math
+
+import numpy as np
+
+# Ampiezze "leggibili" dei bucket, in secondi
+NICE_BUCKETS_S = [
+    1, 2, 5, 10, 15, 30,
+    60, 2 * 60, 5 * 60, 10 * 60, 15 * 60, 30 * 60,
+    3600, 2 * 3600, 3 * 3600, 6 * 3600, 12 * 3600, 86400
+]
+
+METHODS = ("lttb", "minmax")
+
+
+def choose_bucket_seconds(range_seconds, max_buckets):
+    """Ampiezza di bucket più piccola tra quelle leggibili che sta in max_buckets."""
+    if range_seconds <= 0 or max_buckets <= 0:
+        return NICE_BUCKETS_S[0]
+    target = range_seconds / max_buckets
+    for width in NICE_BUCKETS_S:
+        if width >= target:
+            return width
+    return math.ceil(target / 86400) * 86400
+
+
+def _bucket_starts(x, x0, width):
+    """Indici di inizio di ogni bucket non vuoto (x ordinato)."""
+    ids = np.floor((x - x0) / width).astype(np.int64)
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    return ids, starts
+
+
+def minmax(x, y, width, x0=None):
+    """Indici del minimo e del massimo di ogni bucket, in ordine di tempo."""
+    if len(x) == 0:
+        return np.empty(0, dtype=np.int64)
+    x0 = x[0] if x0 is None else x0
+    ids, starts = _bucket_starts(x, x0, width)
+    # Ordinando per (bucket, valore) il primo e l'ultimo di ogni gruppo sono min e max
+    order = np.lexsort((y, ids))
+    ends = np.r_[starts[1:], len(x)] - 1
+    picked = np.unique(np.concatenate([order[starts], order[ends]]))
+    return picked
+
+
+def lttb(x, y, width, x0=None):
+    """Largest-Triangle-Three-Buckets con bucket temporali di ampiezza fissa.
+
+    Mantiene il primo e l'ultimo punto e, per ogni bucket, il punto che forma il
+    triangolo di area massima con il punto scelto in precedenza e la media del
+    bucket successivo.
+    """
+    n = len(x)
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+    x0 = x[0] if x0 is None else x0
+    _, starts = _bucket_starts(x, x0, width)
+    ends = np.r_[starts[1:], n]
+    if len(starts) <= 2:
+        return np.unique(np.r_[0, n - 1])
+
+    # Media di ogni bucket (serve come vertice "successivo")
+    counts = ends - starts
+    mean_x = np.add.reduceat(x, starts) / counts
+    mean_y = np.add.reduceat(y, starts) / counts
+
+    picked = np.empty(len(starts), dtype=np.int64)
+    picked[0] = 0
+    picked[-1] = n - 1
+    prev = 0
+    for b in range(1, len(starts) - 1):
+        s, e = starts[b], ends[b]
+        ax, ay = x[prev], y[prev]
+        cx, cy = mean_x[b + 1], mean_y[b + 1]
+        area = np.abs((ax - cx) * (y[s:e] - ay) - (ax - x[s:e]) * (cy - ay))
+        prev = s + int(np.argmax(area))
+        picked[b] = prev
+    return picked
+
+
+def downsample(x, y, max_points, method="lttb", range_seconds=None):
+    """Riduce la serie a circa max_points punti; restituisce gli indici scelti.
+
+    range_seconds è l'intervallo richiesto dalla dashboard (di default l'estensione
+    della serie) e determina l'ampiezza dei bucket.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown downsampling method '{method}'")
+    n = len(x)
+    if n <= max_points:
+        return np.arange(n)
+    if range_seconds is None:
+        range_seconds = float(x[-1] - x[0])
+    if method == "minmax":
+        # Due punti (min e max) per bucket
+        width = choose_bucket_seconds(range_seconds, max_points // 2)
+        return minmax(x, y, width)
+    width = choose_bucket_seconds(range_seconds, max_points)
+    return lttb(x, y, width)
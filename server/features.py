@@ -0,0 +1,276 @@
+"""Feature fisiologiche per finestra, ricavate da IBI, BVP ed EDA.
+
+Come l'attività di motion.py, le feature sono serie a bassa frequenza salvate
+come letture normali (una riga per finestra di FEATURE_WINDOW_SECONDS secondi,
+con il timestamp di inizio finestra): rollup, grafici, report e API dello
+storico le leggono senza rielaborare i segnali grezzi a 64 Hz.
+
+    wrist_ibi -> wrist_hrv_rmssd, wrist_hrv_sdnn (ms), wrist_hrv_pnn50 (%)
+    wrist_bvp -> wrist_bvp_hr (bpm, dai picchi sistolici)
+    wrist_eda -> wrist_eda_tonic, wrist_eda_phasic (µS), wrist_eda_scr (risposte per finestra)
+
+Tutti i calcoli sono vettoriali sull'intera serie (solo NumPy): extract() lavora
+su una serie ordinata qualsiasi (import) e FeatureExtractor la applica ai batch
+in ingestione, una finestra alla volta man mano che si chiudono.
+"""
+import threading
+from datetime import datetime
+
+import numpy as np
+
+FEATURE_WINDOW_SECONDS = 60
+_WINDOW_US = FEATURE_WINDOW_SECONDS * 1_000_000
+
+# ---------- HRV (IBI in ms) ----------
+HRV_RMSSD = "wrist_hrv_rmssd"
+HRV_SDNN = "wrist_hrv_sdnn"
+HRV_PNN50 = "wrist_hrv_pnn50"
+# Intervalli plausibili; fuori sono artefatti e si scartano
+IBI_RANGE_MS = (300, 2000)
+# Due battiti sono consecutivi se il tempo tra loro è l'intervallo dichiarato (±20%)
+IBI_GAP_TOLERANCE = 0.2
+# Intervalli minimi in una finestra per calcolare l'HRV
+MIN_IBI_BEATS = 5
+
+# ---------- frequenza cardiaca da BVP ----------
+BVP_HR = "wrist_bvp_hr"
+BVP_HZ = 64
+# Media mobile sottratta al segnale (toglie la deriva lenta) e smoothing prima dei picchi
+BVP_DETREND_SECONDS = 1.0
+BVP_SMOOTH_SAMPLES = 5
+# Un picco è il massimo entro ±0.25 s: frequenza massima rilevabile 240 bpm
+BVP_PEAK_HALF_SECONDS = 0.25
+# Intervalli tra picchi accettati (200-30 bpm); quelli a cavallo di buchi nei dati restano fuori
+BVP_INTERVAL_SECONDS = (0.3, 2.0)
+MIN_BVP_BEATS = 10
+
+# ---------- EDA (µS) ----------
+EDA_TONIC = "wrist_eda_tonic"
+EDA_PHASIC = "wrist_eda_phasic"
+EDA_SCR = "wrist_eda_scr"
+EDA_HZ = 4
+# Componente tonica: passa-basso (media mobile centrata); la fasica è il resto
+EDA_TONIC_SECONDS = 10
+# Risposta di conduttanza (SCR): picco della fasica entro ±1 s, salito di almeno
+# SCR_MIN_AMPLITUDE rispetto al minimo dei SCR_RISE_SECONDS precedenti
+SCR_PEAK_HALF_SECONDS = 1
+SCR_RISE_SECONDS = 4
+SCR_MIN_AMPLITUDE = 0.01
+# Campioni minimi in una finestra (metà di quelli attesi)
+MIN_EDA_SAMPLES = EDA_HZ * FEATURE_WINDOW_SECONDS // 2
+
+# Campioni della finestra precedente tenuti come contesto per i filtri
+CONTEXT_SECONDS = max(EDA_TONIC_SECONDS, SCR_RISE_SECONDS)
+
+
+# ================== FILTRI ==================
+def moving_mean(values, width):
+    """Media mobile centrata su width campioni (ai bordi sui campioni disponibili)."""
+    n = len(values)
+    cumulative = np.r_[0.0, np.cumsum(values)]
+    index = np.arange(n)
+    low = np.maximum(index - width // 2, 0)
+    high = np.minimum(index + width // 2 + 1, n)
+    return (cumulative[high] - cumulative[low]) / (high - low)
+
+
+def rolling_extreme(values, before, after, function=np.maximum):
+    """Massimo (o minimo con np.minimum) sui campioni da i - before a i + after."""
+    out = values.copy()
+    for shift in range(1, after + 1):
+        out[:-shift] = function(out[:-shift], values[shift:])
+    for shift in range(1, before + 1):
+        out[shift:] = function(out[shift:], values[:-shift])
+    return out
+
+
+def find_peaks(values, half_width, min_rise=None, rise_width=0):
+    """Indici dei massimi locali entro ±half_width campioni (un solo indice per plateau).
+
+    Con min_rise il picco deve superare di almeno min_rise il minimo dei
+    rise_width campioni precedenti.
+    """
+    peaks = values == rolling_extreme(values, half_width, half_width)
+    peaks[1:] &= ~peaks[:-1]
+    if min_rise is not None:
+        peaks &= values - rolling_extreme(values, rise_width, 0, np.minimum) >= min_rise
+    return np.flatnonzero(peaks)
+
+
+# ================== FEATURE ==================
+def _windows(timestamps):
+    """Indice di finestra di ogni campione, finestre presenti e posizione di ogni campione tra queste."""
+    ids = timestamps.astype("datetime64[us]").astype(np.int64) // _WINDOW_US
+    windows, group = np.unique(ids, return_inverse=True)
+    return ids, windows, group
+
+
+def _per_window(group, size, weights=None):
+    return np.bincount(group, weights, minlength=size)
+
+
+def hrv(timestamps, ibi):
+    """RMSSD, SDNN e pNN50 per finestra da una serie ordinata di intervalli tra battiti (ms)."""
+    valid = (ibi >= IBI_RANGE_MS[0]) & (ibi <= IBI_RANGE_MS[1])
+    timestamps, ibi = timestamps[valid], ibi[valid]
+    if not len(ibi):
+        return {}
+    ids, windows, group = _windows(timestamps)
+    size = len(windows)
+    counts = _per_window(group, size)
+    sums = _per_window(group, size, ibi)
+    sums_sq = _per_window(group, size, ibi * ibi)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sdnn = np.sqrt(np.maximum(sums_sq - sums * sums / counts, 0) / (counts - 1))
+
+    # Differenze tra battiti consecutivi della stessa finestra
+    gaps = np.diff(timestamps.astype("datetime64[us]").astype(np.int64)) / 1000
+    diffs = np.diff(ibi)
+    successive = (ids[1:] == ids[:-1]) & (np.abs(gaps - ibi[1:]) <= IBI_GAP_TOLERANCE * ibi[1:])
+    diff_group = group[1:][successive]
+    diffs = diffs[successive]
+    pairs = _per_window(diff_group, size)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rmssd = np.sqrt(_per_window(diff_group, size, diffs * diffs) / pairs)
+        pnn50 = 100 * _per_window(diff_group, size, (np.abs(diffs) > 50).astype(np.float64)) / pairs
+
+    enough = pairs >= MIN_IBI_BEATS - 1
+    return {HRV_RMSSD: (windows[enough], rmssd[enough]),
+            HRV_SDNN: (windows[enough], sdnn[enough]),
+            HRV_PNN50: (windows[enough], pnn50[enough])}
+
+
+def bvp_heart_rate(timestamps, bvp):
+    """Frequenza cardiaca per finestra dagli intervalli tra i picchi sistolici del BVP."""
+    if len(bvp) < 2:
+        return {}
+    signal = bvp.astype(np.float64)
+    signal = moving_mean(signal - moving_mean(signal, int(BVP_DETREND_SECONDS * BVP_HZ)), BVP_SMOOTH_SAMPLES)
+    peaks = find_peaks(signal, int(BVP_PEAK_HALF_SECONDS * BVP_HZ))
+    peaks = peaks[signal[peaks] > 0]
+    if len(peaks) < 2:
+        return {}
+    ids, windows, group = _windows(timestamps[peaks])
+    intervals = np.diff(timestamps[peaks].astype("datetime64[us]").astype(np.int64)) / 1e6
+    valid = ((ids[1:] == ids[:-1]) & (intervals >= BVP_INTERVAL_SECONDS[0])
+             & (intervals <= BVP_INTERVAL_SECONDS[1]))
+    beats = _per_window(group[1:][valid], len(windows))
+    total = _per_window(group[1:][valid], len(windows), intervals[valid])
+    enough = beats >= MIN_BVP_BEATS
+    return {BVP_HR: (windows[enough], 60 * beats[enough] / total[enough])}
+
+
+def eda_components(timestamps, eda):
+    """Livello tonico medio, fasica media (parte positiva) e numero di SCR per finestra."""
+    if not len(eda):
+        return {}
+    signal = eda.astype(np.float64)
+    tonic = moving_mean(signal, EDA_TONIC_SECONDS * EDA_HZ)
+    phasic = signal - tonic
+    peaks = find_peaks(phasic, SCR_PEAK_HALF_SECONDS * EDA_HZ, SCR_MIN_AMPLITUDE, SCR_RISE_SECONDS * EDA_HZ)
+    _, windows, group = _windows(timestamps)
+    size = len(windows)
+    counts = _per_window(group, size)
+    enough = counts >= MIN_EDA_SAMPLES
+    tonic_mean = _per_window(group, size, tonic) / counts
+    phasic_mean = _per_window(group, size, np.maximum(phasic, 0)) / counts
+    scr = _per_window(group[peaks], size)
+    return {EDA_TONIC: (windows[enough], tonic_mean[enough]),
+            EDA_PHASIC: (windows[enough], phasic_mean[enough]),
+            EDA_SCR: (windows[enough], scr[enough])}
+
+
+# Sensore grezzo -> funzione (timestamps, valori) -> {sensore feature: (finestre, valori)}
+EXTRACTORS = {
+    "wrist_ibi": hrv,
+    "wrist_bvp": bvp_heart_rate,
+    "wrist_eda": eda_components,
+}
+FEATURE_SENSORS = (HRV_RMSSD, HRV_SDNN, HRV_PNN50, BVP_HR, EDA_TONIC, EDA_PHASIC, EDA_SCR)
+
+
+def window_start(windows):
+    """Inizio delle finestre (datetime64[us]) dai loro indici."""
+    return (np.asarray(windows, dtype=np.int64) * _WINDOW_US).astype("datetime64[us]")
+
+
+def extract(sensor_type, timestamps, values):
+    """Feature di una serie ordinata come [(sensore feature, inizi finestra datetime64[us], valori)]."""
+    extractor = EXTRACTORS.get(sensor_type)
+    if extractor is None or not len(values):
+        return []
+    return [(feature, window_start(windows), feature_values)
+            for feature, (windows, feature_values) in extractor(timestamps, values).items() if len(windows)]
+
+
+class FeatureExtractor:
+    """Feature per utente e sensore, calcolate quando una finestra si chiude.
+
+    I campioni della finestra aperta restano in memoria (per BVP al più una
+    finestra a 64 Hz) finché arriva un campione di una finestra successiva, più
+    CONTEXT_SECONDS della finestra precedente come contesto per i filtri. Campioni
+    più vecchi della finestra aperta arrivano quando le feature di quella finestra
+    sono già state salvate e vengono ignorati. Come ActivityCounter, lo stato è
+    per processo: in app.py si usa solo dove un processo riceve tutte le letture
+    di un paziente (ONLINE_FEATURES).
+    """
+
+    def __init__(self):
+        self._open = {}  # (user_id, sensor_type) -> [finestra aperta, [(timestamps, valori)]]
+        self._lock = threading.Lock()
+
+    def add(self, user_id, sensor_type, timestamps, values):
+        """Aggiunge una serie ordinata; restituisce le feature delle finestre chiuse come [(sensore, inizio, valore)]."""
+        key = (user_id, sensor_type)
+        ids = timestamps.astype("datetime64[us]").astype(np.int64) // _WINDOW_US
+        with self._lock:
+            window, chunks = self._open.get(key, (None, []))
+            if window is not None:
+                recent = ids >= window
+                timestamps, values, ids = timestamps[recent], values[recent], ids[recent]
+                if not len(ids):
+                    return []
+            last = int(ids[-1])
+            if window is not None and last == window:
+                chunks.append((timestamps, values))
+                return []
+            chunks.append((timestamps, values))
+            series_t = np.concatenate([c[0] for c in chunks])
+            series_v = np.concatenate([c[1] for c in chunks])
+            if (series_t[1:] < series_t[:-1]).any():
+                # Batch arrivati in disordine dentro la finestra aperta
+                order = np.argsort(series_t, kind="stable")
+                series_t, series_v = series_t[order], series_v[order]
+            # Si tiene la finestra aperta più il contesto per i filtri
+            keep = series_t >= window_start(last) - np.timedelta64(CONTEXT_SECONDS, "s")
+            self._open[key] = [last, [(series_t[keep], series_v[keep])]]
+
+        closed = []
+        for feature, starts, feature_values in extract(sensor_type, series_t, series_v):
+            windows = starts.astype(np.int64) // _WINDOW_US
+            emit = windows < last
+            if window is not None:
+                # Le finestre prima di quella aperta erano solo contesto
+                emit &= windows >= window
+            closed.extend((feature, start.astype(datetime), float(value))
+                          for start, value in zip(starts[emit], feature_values[emit]))
+        return closed
+
+
+def derive(rows, extractor):
+    """Righe delle feature delle finestre chiuse dalle letture IBI, BVP ed EDA del batch."""
+    series = {}
+    for row in rows:
+        if row["sensor_type"] in EXTRACTORS:
+            series.setdefault((row["user_id"], row["sensor_type"]), []).append(row)
+
+    derived = []
+    for (user_id, sensor_type), sensor_rows in series.items():
+        sensor_rows.sort(key=lambda r: r["timestamp"])
+        n = len(sensor_rows)
+        timestamps = np.array([r["timestamp"] for r in sensor_rows], dtype="datetime64[us]")
+        values = np.fromiter((r["value"] for r in sensor_rows), np.float64, n)
+        derived.extend({"user_id": user_id, "sensor_type": feature, "value": value,
+                        "timestamp": start, "x": None, "y": None, "z": None}
+                       for feature, start, value in extractor.add(user_id, sensor_type, timestamps, values))
+    return derived
@@ -0,0 +1,194 @@
+"""Lettura paginata dello storico di una serie per l'API /api/users/<id>/sensors/<tipo>.
+
+Le pagine usano un cursore keyset opaco (timestamp in µs e una chiave che
+distingue le letture con lo stesso istante: l'id della riga in sensor_data, la
+posizione tra i campioni con lo stesso timestamp nei blocchi, 0 per i rollup):
+la pagina successiva riparte con WHERE (timestamp, chiave) > cursore sull'indice
+della serie, senza OFFSET, quindi costa uguale alla prima pagina o alla
+millesima.
+
+Le sorgenti sono generatori che leggono dal database a blocchi (yield_per) e le
+risposte si serializzano riga per riga: la memoria per richiesta non dipende
+dall'ampiezza della finestra né dalla dimensione della pagina. Il cursore della
+pagina successiva si conosce solo alla fine, leggendo una riga oltre il limite,
+e chiude la risposta ("next_cursor", null all'ultima pagina).
+"""
+import json
+import math
+import base64
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import and_, or_, select
+
+import blocks
+import motion
+import rollups
+
+RESOLUTIONS = ("raw",) + tuple(rollups.RESOLUTIONS)
+# Righe lette dal database per volta
+FETCH_ROWS = 2000
+# Blocchi binari letti per volta (ognuno ~640 campioni BVP)
+FETCH_BLOCKS = 16
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def encode_cursor(ts, key):
+    """Cursore opaco per (timestamp, chiave)."""
+    micros = (ts - EPOCH) // timedelta(microseconds=1)
+    return base64.urlsafe_b64encode(f"{micros}.{key}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    """(timestamp, chiave) dal cursore; ValueError se non valido."""
+    try:
+        micros, key = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode().split(".")
+        return EPOCH + timedelta(microseconds=int(micros)), int(key)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def choose_resolution(requested, since, until, raw_count, max_points, extent=None):
+    """Risoluzione da leggere: quella richiesta, oppure con "auto" la più fine che sta in max_points.
+
+    raw_count è una stima delle letture nella finestra (dai rollup orari). Se manca
+    since o until, extent() restituisce (prima, ultima) lettura della serie e ne
+    prende il posto: conta l'ampiezza reale dei dati, non quella della finestra aperta.
+    """
+    if requested != "auto":
+        return requested
+    if raw_count <= max_points:
+        return "raw"
+    if (since is None or until is None) and extent is not None:
+        first, last = extent()
+        since = since if since is not None else first
+        until = until if until is not None else last
+    if since is None or until is None:
+        return "day"
+    seconds = (until - since).total_seconds()
+    for resolution, width in sorted(rollups.RESOLUTIONS.items(), key=lambda r: r[1]):
+        if seconds / width <= max_points:
+            return resolution
+    return "day"
+
+
+def after_cursor(ts_column, key_column, cursor):
+    """Condizione keyset (timestamp, chiave) > cursore."""
+    ts, key = cursor
+    return or_(ts_column > ts, and_(ts_column == ts, key_column > key))
+
+
+# ================== SORGENTI ==================
+# Ogni sorgente produce (timestamp datetime, chiave, {campi}) in ordine di (timestamp, chiave)
+
+def raw_rows(session, source, user_id, sensor_type, since, until, cursor):
+    """Letture di sensor_data (o della UNION ALL delle partizioni) con chiave id."""
+    c = source.c
+    query = select(c.timestamp, c.id, c.value).where(c.user_id == user_id, c.sensor_type == sensor_type)
+    if since is not None:
+        query = query.where(c.timestamp >= since)
+    if until is not None:
+        query = query.where(c.timestamp < until)
+    if cursor is not None:
+        query = query.where(after_cursor(c.timestamp, c.id, cursor))
+    result = session.execute(query.order_by(c.timestamp, c.id).execution_options(yield_per=FETCH_ROWS))
+    for ts, key, value in result:
+        yield ts, key, {"value": value}
+
+
+def rollup_rows(session, rollup_table, user_id, sensor_type, resolution, since, until, cursor):
+    """Bucket dei rollup: media, minimo, massimo e numero di letture; chiave sempre 0."""
+    r = rollup_table
+    query = select(r.c.bucket, r.c.count, r.c.sum, r.c.min, r.c.max).where(
+        r.c.user_id == user_id, r.c.sensor_type == sensor_type, r.c.resolution == resolution)
+    if since is not None:
+        query = query.where(r.c.bucket >= rollups.truncate(since, resolution))
+    if until is not None:
+        query = query.where(r.c.bucket < until)
+    if cursor is not None:
+        query = query.where(r.c.bucket > cursor[0])
+    result = session.execute(query.order_by(r.c.bucket).execution_options(yield_per=FETCH_ROWS))
+    for bucket, count, total, vmin, vmax in result:
+        yield bucket, 0, {"mean": total / count, "min": vmin, "max": vmax, "count": count}
+
+
+def block_rows(session, store, user_id, sensor_type, since, until, cursor):
+    """Campioni dei blocchi binari, un blocco alla volta; chiave = posizione tra i campioni con lo stesso istante."""
+    start = since
+    if cursor is not None:
+        start = max(cursor[0], since) if since is not None else cursor[0]
+    query = store.range_query(user_id, sensor_type, start, until)
+    result = session.execute(query.execution_options(yield_per=FETCH_BLOCKS))
+    # Per i blocchi a tre canali il valore è il modulo degli assi, come in BlockStore.read
+    low = np.datetime64(start, "us") if start is not None else None
+    high = np.datetime64(until, "us") if until is not None else None
+    previous, ordinal = None, 0
+    for row in result:
+        timestamps, data = blocks.decode(row.start, row.offsets, row.data, row.channels)
+        if row.channels == 3:
+            data = motion.magnitude(*data.astype(np.float64).T)
+        keep = np.ones(len(timestamps), dtype=bool)
+        if low is not None:
+            keep &= timestamps >= low
+        if high is not None:
+            keep &= timestamps < high
+        for ts, value in zip(timestamps[keep].astype(datetime), data[keep].tolist()):
+            ordinal = ordinal + 1 if ts == previous else 0
+            previous = ts
+            if cursor is not None and ts == cursor[0] and ordinal <= cursor[1]:
+                continue
+            yield ts, ordinal, {"value": value}
+
+
+# ================== RISPOSTE ==================
+def _clean(fields):
+    # NaN e infiniti non esistono in JSON
+    return {k: (None if isinstance(v, float) and not math.isfinite(v) else v) for k, v in fields.items()}
+
+
+def paginate(rows, limit):
+    """(righe della pagina, cursore successivo o None) come generatore: le righe, poi ("end", cursore)."""
+    last = None
+    for n, row in enumerate(rows):
+        if n == limit:
+            yield "end", encode_cursor(last[0], last[1])
+            return
+        last = row
+        yield "row", row
+    yield "end", None
+
+
+def ndjson_stream(pages):
+    """Una riga JSON per lettura, poi {"next_cursor": ...}."""
+    buffer = []
+    for kind, item in pages:
+        if kind == "end":
+            buffer.append(json.dumps({"next_cursor": item}) + "\n")
+            break
+        ts, _, fields = item
+        buffer.append(json.dumps({"timestamp": ts.isoformat(timespec="milliseconds"), **_clean(fields)},
+                                 separators=(",", ":")) + "\n")
+        if len(buffer) >= FETCH_ROWS:
+            yield "".join(buffer)
+            buffer = []
+    yield "".join(buffer)
+
+
+def json_stream(meta, pages):
+    """Oggetto JSON {**meta, "data": [...], "next_cursor": ...} scritto a pezzi."""
+    head = json.dumps(meta, separators=(",", ":"))
+    buffer = [head[:-1] + ',"data":[']
+    first = True
+    for kind, item in pages:
+        if kind == "end":
+            buffer.append("]," + json.dumps({"next_cursor": item}, separators=(",", ":"))[1:])
+            break
+        ts, _, fields = item
+        buffer.append(("" if first else ",") + json.dumps(
+            {"timestamp": ts.isoformat(timespec="milliseconds"), **_clean(fields)}, separators=(",", ":")))
+        first = False
+        if len(buffer) >= FETCH_ROWS:
+            yield "".join(buffer)
+            buffer = []
+    yield "".join(buffer)
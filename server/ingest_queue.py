@@ -0,0 +1,189 @@
+"""Coda di ingestione write-behind con group commit.
+
+Le route mettono in coda le letture già validate e rispondono subito; un thread
+di scrittura le raccoglie in gruppi (fino a group_rows letture o max_latency
+secondi dalla prima in attesa) e chiama writer(rows) una volta per gruppo, cioè
+un solo commit. La coda è limitata in numero di letture: quando è piena submit()
+rifiuta e la route risponde 429/503. Il thread parte alla prima submit(), così
+nei server pre-fork (gunicorn) vive nel processo worker.
+
+Le letture in coda sono già state confermate al client (202): se il commit di un
+gruppo fallisce, il gruppo si riscrive a metà, ricorsivamente fino alle singole
+letture, così una lettura che il database rifiuta non trascina con sé le altre.
+Le scritture per gruppo sono al più MAX_WRITES_PER_GROUP (un database fermo non
+moltiplica i tentativi): le letture rimaste contano come fallite.
+"""
+import time
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Tentativi di scrittura per gruppo, compresi quelli sulle metà dopo un errore
+MAX_WRITES_PER_GROUP = 64
+
+
+class WriteBehindQueue:
+    """Coda limitata di letture con un thread che le scrive a gruppi."""
+
+    def __init__(self, writer, max_rows=50000, group_rows=2000, max_latency=0.2):
+        self.writer = writer
+        self.max_rows = max_rows
+        self.group_rows = group_rows
+        self.max_latency = max_latency
+        self._items = deque()  # (istante di arrivo, righe)
+        self._depth = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+        self._busy = False
+        self._flushing = 0
+
+        self.submitted = 0
+        self.rejected = 0
+        self.written = 0
+        self.failed = 0
+        self.commits = 0
+        self.commit_seconds_total = 0.0
+        self.commit_seconds_max = 0.0
+        self.last_commit_seconds = None
+        self.max_depth = 0
+
+    def submit(self, rows):
+        """Mette in coda le righe di una richiesta; False se la coda è piena o chiusa."""
+        with self._cond:
+            if self._closed or self._depth + len(rows) > self.max_rows:
+                self.rejected += len(rows)
+                return False
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="ingest-writer", daemon=True)
+                self._thread.start()
+            self._items.append((time.monotonic(), rows))
+            self._depth += len(rows)
+            self.submitted += len(rows)
+            self.max_depth = max(self.max_depth, self._depth)
+            if self._depth >= self.group_rows:
+                self._cond.notify()
+            elif len(self._items) == 1:
+                # Prima richiesta in attesa: il writer deve conoscere la scadenza di latenza
+                self._cond.notify()
+            return True
+
+    def _next_group(self):
+        """Attende un gruppo pronto (per numero o latenza) e lo toglie dalla coda."""
+        with self._cond:
+            while True:
+                if self._items:
+                    deadline = self._items[0][0] + self.max_latency
+                    if (self._depth >= self.group_rows or self._closed or self._flushing
+                            or time.monotonic() >= deadline):
+                        break
+                    self._cond.wait(deadline - time.monotonic())
+                elif self._closed:
+                    return None
+                else:
+                    self._cond.wait()
+
+            group = []
+            while self._items and len(group) + len(self._items[0][1]) <= self.group_rows:
+                group.extend(self._items.popleft()[1])
+            if not group:
+                # Una sola richiesta più grande del gruppo: si scrive intera
+                group = self._items.popleft()[1]
+            self._depth -= len(group)
+            self._busy = True
+            return group
+
+    def _run(self):
+        while True:
+            group = self._next_group()
+            if group is None:
+                return
+            try:
+                self._write_group(group)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _write_group(self, group):
+        """Scrive il gruppo; dopo un errore riprova sulle due metà, fino alle singole letture."""
+        pending = [group]
+        writes = 0
+        while pending:
+            rows = pending.pop()
+            if writes >= MAX_WRITES_PER_GROUP:
+                logger.error("Scrittura abbandonata dopo %d tentativi: %d letture perse", writes, len(rows))
+                with self._cond:
+                    self.failed += len(rows)
+                continue
+            writes += 1
+            start = time.perf_counter()
+            try:
+                self.writer(rows)
+            except Exception:
+                if len(rows) > 1:
+                    logger.warning("Scrittura di %d letture fallita, riprovo a metà", len(rows), exc_info=True)
+                    middle = len(rows) // 2
+                    pending.extend((rows[middle:], rows[:middle]))
+                    continue
+                logger.exception("Lettura scartata dal database: %r", rows[0])
+                with self._cond:
+                    self.failed += 1
+            else:
+                elapsed = time.perf_counter() - start
+                with self._cond:
+                    self.written += len(rows)
+                    self.commits += 1
+                    self.commit_seconds_total += elapsed
+                    self.commit_seconds_max = max(self.commit_seconds_max, elapsed)
+                    self.last_commit_seconds = elapsed
+
+    def flush(self, timeout=None):
+        """Attende che la coda sia vuota e l'ultimo gruppo scritto; False se scade il timeout."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            # Niente attesa della latenza: il writer scrive subito quello che c'è
+            self._flushing += 1
+            self._cond.notify_all()
+            try:
+                while self._items or self._busy:
+                    remaining = deadline - time.monotonic() if deadline is not None else None
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                return True
+            finally:
+                self._flushing -= 1
+
+    def close(self, timeout=30):
+        """Rifiuta nuove letture, scrive quelle in coda e ferma il thread (es. allo spegnimento)."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        with self._cond:
+            if self._depth:
+                logger.warning("Spegnimento: %d letture in coda non scritte", self._depth)
+            return self._depth == 0
+
+    def metrics(self):
+        with self._cond:
+            return {
+                "depth": self._depth,
+                "max_depth": self.max_depth,
+                "capacity": self.max_rows,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "written": self.written,
+                "failed": self.failed,
+                "commits": self.commits,
+                "rows_per_commit": round(self.written / self.commits, 1) if self.commits else None,
+                "commit_ms_avg": round(self.commit_seconds_total / self.commits * 1000, 2) if self.commits else None,
+                "commit_ms_max": round(self.commit_seconds_max * 1000, 2),
+                "commit_ms_last": round(self.last_commit_seconds * 1000, 2)
+                if self.last_commit_seconds is not None else None,
+            }
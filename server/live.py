@@ -0,0 +1,111 @@
+"""Canale push (Server-Sent Events) per le dashboard.
+
+Il percorso di ingestione pubblica le nuove letture e anomalie sul Broker; ogni
+dashboard aperta è un iscritto con la propria coda, filtrata per user_id (None =
+tutti gli utenti, per l'admin). Il broker vive nel processo, come lo stato di
+AnomalyDetector: con più processi ogni dashboard riceve le letture arrivate al
+processo che la serve. Con gli shard di ingestione (vedi shards.py) le letture
+si scrivono negli shard, che inoltrano gli eventi ai front-end con add_relay().
+"""
+import json
+import queue
+import threading
+
+# Messaggi in attesa per iscritto: oltre questo limite si scartano i più vecchi
+SUBSCRIBER_QUEUE_SIZE = 256
+# Secondi tra due commenti di keep-alive (servono anche a notare i client disconnessi)
+HEARTBEAT_SECONDS = 15
+# Attesa suggerita al browser prima di riconnettersi, in millisecondi
+RETRY_MS = 3000
+
+
+def format_event(event, data):
+    """Messaggio SSE: tipo di evento e payload JSON su una riga."""
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+class Broker:
+    """Pub/sub in memoria tra il percorso di ingestione e gli stream SSE."""
+
+    def __init__(self, queue_size=SUBSCRIBER_QUEUE_SIZE, max_subscribers=None):
+        self.queue_size = queue_size
+        # Ogni stream aperto occupa un thread del server: oltre il limite subscribe() rifiuta
+        self.max_subscribers = max_subscribers
+        self._lock = threading.Lock()
+        self._subscribers = {}  # coda -> user_id seguito (None = tutti)
+        self._relays = []       # (watched(), publish(user_id, messaggio)) verso altri processi
+        self.dropped = 0
+
+    def subscribe(self, user_id=None):
+        """Nuova coda di iscritto; None se ci sono già max_subscribers stream aperti."""
+        subscriber = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            if self.max_subscribers is not None and len(self._subscribers) >= self.max_subscribers:
+                return None
+            self._subscribers[subscriber] = user_id
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.pop(subscriber, None)
+
+    def add_relay(self, watched, publish):
+        """Inoltra gli eventi anche a publish(user_id, messaggio), es. ai front-end degli shard di ingestione.
+
+        watched() restituisce gli utenti seguiti dall'altra parte, come watched_users().
+        """
+        with self._lock:
+            self._relays.append((watched, publish))
+
+    def watched_users(self):
+        """user_id seguiti da almeno un iscritto; None nell'insieme se qualcuno segue tutti."""
+        with self._lock:
+            users = set(self._subscribers.values())
+            relays = list(self._relays)
+        for watched, _ in relays:
+            users |= watched()
+        return users
+
+    def publish(self, user_id, event, data):
+        """Invia l'evento agli iscritti che seguono user_id (serializzato una volta sola)."""
+        with self._lock:
+            targets = [s for s, watched in self._subscribers.items() if watched is None or watched == user_id]
+            relays = [publish for watched, publish in self._relays]
+        if not targets and not relays:
+            return
+        message = format_event(event, data)
+        for relay in relays:
+            relay(user_id, message)
+        self._deliver(targets, message)
+
+    def deliver(self, user_id, message):
+        """Consegna un messaggio già formattato (ricevuto da un altro processo) agli iscritti di user_id."""
+        with self._lock:
+            targets = [s for s, watched in self._subscribers.items() if watched is None or watched == user_id]
+        self._deliver(targets, message)
+
+    def _deliver(self, targets, message):
+        for subscriber in targets:
+            while True:
+                try:
+                    subscriber.put_nowait(message)
+                    break
+                except queue.Full:
+                    # Client lento: meglio perdere i punti più vecchi che bloccare l'ingestione
+                    try:
+                        subscriber.get_nowait()
+                        self.dropped += 1
+                    except queue.Empty:
+                        pass
+
+    def stream(self, subscriber, heartbeat=HEARTBEAT_SECONDS):
+        """Generatore dei messaggi per la risposta text/event-stream; alla chiusura si disiscrive."""
+        try:
+            yield f"retry: {RETRY_MS}\n\n"
+            while True:
+                try:
+                    yield subscriber.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ": ping\n\n"
+        finally:
+            self.unsubscribe(subscriber)
@@ -0,0 +1,260 @@
+"""Metriche del processo in formato Prometheus e profiler a campionamento.
+
+Contatori, gauge e istogrammi con etichette, registrati in un Registry che li
+espone come testo (render(), servito da /metrics). I valori non esposti
+direttamente (cache, coda di ingestione) arrivano da collector chiamati a ogni
+render. Come cache e broker live, le metriche sono per processo: con più worker
+gunicorn ogni worker ha le sue (Prometheus le somma per istanza).
+
+instrument_engine() conta query e tempo SQL con gli eventi di SQLAlchemy, in
+totale e per la richiesta in corso sul thread (start_request/finish_request),
+così un N+1 si vede come numero di query per route.
+
+SamplingProfiler campiona lo stack di un thread a intervalli fissi da un thread
+separato e restituisce gli stack "piegati" (formato di flamegraph.pl/speedscope).
+"""
+import os
+import sys
+import math
+import time
+import threading
+from collections import Counter as _Tally
+
+from sqlalchemy import event
+
+# Secondi: dalle query veloci alle dashboard lente
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Query SQL per richiesta
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+# Secondi per campione nel rilevatore di anomalie
+SAMPLE_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 1e-3)
+
+_local = threading.local()
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def samples(self):
+        """Righe (nome, etichette, valore) da esporre."""
+        with self._lock:
+            return [(self.name, _format_labels(self.labelnames, key), value)
+                    for key, value in sorted(self._values.items())]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        rows = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    labels = _format_labels(self.labelnames + ("le",), key + (_format_value(bound),))
+                    rows.append((f"{self.name}_bucket", labels, cumulative))
+                labels = _format_labels(self.labelnames, key)
+                rows.append((f"{self.name}_sum", labels, total))
+                rows.append((f"{self.name}_count", labels, count))
+        return rows
+
+
+class Registry:
+    """Metriche del processo e collector per i valori calcolati al momento."""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._add(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def add_collector(self, collect):
+        """collect() restituisce metriche (Counter/Gauge) costruite al momento dell'esposizione."""
+        self._collectors.append(collect)
+
+    def render(self):
+        """Testo nel formato di esposizione di Prometheus (text/plain; version=0.0.4)."""
+        metrics = list(self._metrics)
+        for collect in self._collectors:
+            metrics.extend(collect())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# ================== QUERY SQL ==================
+def instrument_engine(engine, queries, query_seconds):
+    """Conta le query di engine nel contatore queries e ne osserva la durata in query_seconds."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["metrics_start"].pop()
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        queries.inc(operation=operation)
+        query_seconds.observe(elapsed, operation=operation)
+        current = getattr(_local, "request", None)
+        if current is not None:
+            current[0] += 1
+            current[1] += elapsed
+
+
+def start_request():
+    """Inizia a contare query e tempo SQL del thread corrente."""
+    _local.request = [0, 0.0]
+
+
+def finish_request():
+    """Smette di contare; restituisce (query, secondi SQL) dall'ultimo start_request."""
+    current = getattr(_local, "request", None)
+    _local.request = None
+    return tuple(current) if current is not None else (0, 0.0)
+
+
+# ================== PROFILER ==================
+class SamplingProfiler:
+    """Campiona lo stack di un thread ogni interval secondi, da un thread separato.
+
+    Il costo per il thread campionato è solo il GIL ceduto al campionatore; gli
+    stack vengono contati per percorso completo (dal più esterno al più interno).
+    """
+
+    def __init__(self, thread_id=None, interval=0.005):
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+        self.stacks = _Tally()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = None
+        self.elapsed = None
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.elapsed = time.perf_counter() - self._started
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def folded(self):
+        """Stack piegati, uno per riga con il numero di campioni, dal più frequente."""
+        return "\n".join(f"{stack} {n}" for stack, n in self.stacks.most_common())
+
+    def top(self, limit=20):
+        """Funzioni più presenti negli stack: [(funzione, campioni in cui compare, campioni in cima)]."""
+        inclusive, own = _Tally(), _Tally()
+        for stack, n in self.stacks.items():
+            frames = stack.split(";")
+            for name in set(frames):
+                inclusive[name] += n
+            own[frames[-1]] += n
+        return [(name, n, own[name]) for name, n in inclusive.most_common(limit)]
+
+    def report(self, limit=20):
+        """Riepilogo testuale: funzioni più presenti e stack piegati."""
+        lines = [f"# {self.samples} campioni in {self.elapsed * 1000:.0f} ms "
+                 f"(ogni {self.interval * 1000:g} ms)",
+                 "# campioni  in cima  funzione"]
+        lines += [f"# {n:8d}  {own:7d}  {name}" for name, n, own in self.top(limit)]
+        return "\n".join(lines) + "\n\n" + self.folded() + "\n"
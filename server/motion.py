@@ -0,0 +1,111 @@
+"""Canali derivati dell'accelerometro a tre assi (wrist_acc).
+
+Le letture wrist_acc arrivano con i tre assi (x, y, z in g) e vengono salvate in
+una sola riga con gli assi nelle colonne x/y/z e, come valore, il modulo del
+vettore: è il valore su cui lavorano statistiche, rollup e rilevamento anomalie.
+
+Dal modulo si ricava anche l'attività: ENMO (Euclidean Norm Minus One, cioè
+max(modulo - 1 g, 0), in mg) mediato su epoche di ACTIVITY_EPOCH_SECONDS secondi
+e salvato come serie a bassa frequenza ACTIVITY_SENSOR (una riga per epoca).
+Tutti i calcoli sono vettoriali sull'intero batch.
+"""
+import threading
+from datetime import datetime
+
+import numpy as np
+
+ACC_SENSOR = "wrist_acc"
+ACTIVITY_SENSOR = "wrist_activity"
+AXES = ("x", "y", "z")
+ACTIVITY_EPOCH_SECONDS = 60
+
+_EPOCH = datetime(1970, 1, 1)
+_EPOCH_US = ACTIVITY_EPOCH_SECONDS * 1_000_000
+
+
+def magnitude(x, y, z):
+    """Modulo del vettore accelerazione, elemento per elemento."""
+    return np.sqrt(x * x + y * y + z * z)
+
+
+def enmo(magnitudes):
+    """Accelerazione oltre la gravità in mg (0 a riposo in qualsiasi orientamento)."""
+    return np.maximum(magnitudes - 1.0, 0.0) * 1000.0
+
+
+def activity_epochs(timestamps, magnitudes):
+    """ENMO medio per epoca di una serie ordinata: (inizio epoca datetime64[us], somma, campioni)."""
+    epochs = timestamps.astype("datetime64[us]").astype(np.int64) // _EPOCH_US
+    starts = np.flatnonzero(np.r_[True, epochs[1:] != epochs[:-1]])
+    sums = np.add.reduceat(enmo(magnitudes), starts) if len(starts) else np.array([])
+    counts = np.diff(np.r_[starts, len(epochs)])
+    return (epochs[starts] * _EPOCH_US).astype("datetime64[us]"), sums, counts
+
+
+class ActivityCounter:
+    """Epoche di attività per utente, costruite man mano che arrivano i batch.
+
+    L'ultima epoca di ogni batch resta aperta finché un campione successivo non la
+    chiude, così un'epoca divisa tra due batch produce una sola riga. Come le
+    finestre di AnomalyDetector, lo stato è per processo.
+    """
+
+    def __init__(self):
+        self._open = {}  # user_id -> [inizio epoca, somma ENMO, campioni]
+        self._lock = threading.Lock()
+
+    def add(self, user_id, timestamps, magnitudes):
+        """Aggiunge una serie ordinata; restituisce le epoche chiuse come [(inizio, ENMO medio)]."""
+        starts, sums, counts = activity_epochs(timestamps, magnitudes)
+        closed = []
+        with self._lock:
+            pending = self._open.pop(user_id, None)
+            if pending is not None:
+                # L'epoca aperta riceve i campioni del batch che cadono in essa
+                same = starts == pending[0]
+                pending[1] += sums[same].sum()
+                pending[2] += counts[same].sum()
+                starts, sums, counts = starts[~same], sums[~same], counts[~same]
+                if len(starts) and starts[-1] > pending[0]:
+                    # Il batch va oltre l'epoca aperta: si chiude
+                    closed.append((pending[0], pending[1] / pending[2]))
+                else:
+                    # Solo campioni più vecchi dell'epoca aperta: restano epoche a sé, chiuse
+                    self._open[user_id] = pending
+            if user_id not in self._open:
+                self._open[user_id] = [starts[-1], sums[-1], counts[-1]]
+                starts, sums, counts = starts[:-1], sums[:-1], counts[:-1]
+        closed.extend(zip(starts, sums / counts))
+        closed.sort(key=lambda epoch: epoch[0])
+        return [(start.astype(datetime), float(mean)) for start, mean in closed]
+
+
+def derive(rows, counter):
+    """Completa le letture wrist_acc del batch e restituisce le righe di attività chiuse.
+
+    Ogni riga riceve le chiavi x/y/z (None per i sensori a un canale); per quelle con
+    gli assi il valore diventa il modulo del vettore. L'attività si conta solo sulle
+    letture a tre assi di ACC_SENSOR.
+    """
+    vectors = {}
+    for row in rows:
+        if row.get("x") is None:
+            row["x"] = row["y"] = row["z"] = None
+        elif row["sensor_type"] == ACC_SENSOR:
+            vectors.setdefault(row["user_id"], []).append(row)
+        else:
+            row["value"] = float(magnitude(row["x"], row["y"], row["z"]))
+
+    activity = []
+    for user_id, acc_rows in vectors.items():
+        acc_rows.sort(key=lambda r: r["timestamp"])
+        n = len(acc_rows)
+        x, y, z = (np.fromiter((r[axis] for r in acc_rows), np.float64, n) for axis in AXES)
+        magnitudes = magnitude(x, y, z)
+        for row, value in zip(acc_rows, magnitudes.tolist()):
+            row["value"] = value
+        timestamps = np.array([r["timestamp"] for r in acc_rows], dtype="datetime64[us]")
+        activity.extend({"user_id": user_id, "sensor_type": ACTIVITY_SENSOR, "value": mean,
+                         "timestamp": start, "x": None, "y": None, "z": None}
+                        for start, mean in counter.add(user_id, timestamps, magnitudes))
+    return activity
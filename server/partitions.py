@@ -0,0 +1,315 @@
+"""Partizionamento temporale dei dati grezzi (sensor_data) e retention.
+
+Con un periodo "day" o "week" le letture vengono scritte in partizioni
+sensor_data_<periodo>_<AAAAMMGG>, dove la data è l'inizio del periodo:
+- su SQLite sono tabelle separate con lo stesso schema e indice; le query leggono
+  solo le partizioni che intersecano la finestra (UNION ALL, più la tabella
+  sensor_data con le righe scritte prima del partizionamento);
+- su PostgreSQL sensor_data è una tabella partizionata nativa (PARTITION BY RANGE)
+  e il planner esclude da solo le partizioni fuori finestra.
+
+La retention elimina i dati grezzi più vecchi di una data solo dopo aver
+verificato che i rollup (rollups.py) li contengano tutti, ricostruendoli se mancano:
+una partizione si elimina con DROP TABLE, la tabella non partizionata con DELETE.
+"""
+import re
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import MetaData, Table, Column, Index, select, union_all, func, delete, text
+from sqlalchemy.schema import CreateTable, CreateIndex
+
+import rollups
+
+PERIODS = {"day": 1, "week": 7}
+
+# Colonne lette dalle dashboard, coperte dall'indice di ogni partizione
+READ_COLUMNS = ("user_id", "sensor_type", "value", "timestamp")
+
+_NAME_RE = re.compile(r"^(?P<base>\w+?)_(?P<period>day|week)_(?P<start>\d{8})$")
+
+
+def is_partition(name):
+    """True se name è il nome di una partizione (sensor_data_day_20240101, ...)."""
+    return _NAME_RE.match(name) is not None
+
+
+def period_start(ts, period):
+    """Inizio del periodo (giorno, o lunedì della settimana) che contiene ts."""
+    day = ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == "week":
+        day -= timedelta(days=day.weekday())
+    return day
+
+
+class Partition:
+    """Una partizione esistente: nome, periodo e intervallo [start, end)."""
+
+    def __init__(self, name, period, start):
+        self.name = name
+        self.period = period
+        self.start = start
+        self.end = start + timedelta(days=PERIODS[period])
+
+    def overlaps(self, since=None, until=None):
+        return (since is None or self.end > since) and (until is None or self.start < until)
+
+
+class PartitionedTable:
+    """Instrada scritture e letture di sensor_data sulle partizioni (period=None: tabella unica)."""
+
+    def __init__(self, base_table, period=None):
+        if period is not None and period not in PERIODS:
+            raise ValueError(f"Unknown partition period '{period}' (use {', '.join(PERIODS)})")
+        self.base = base_table
+        self.period = period
+        self._metadata = MetaData()
+        self._base_empty = False
+
+    @property
+    def enabled(self):
+        return self.period is not None
+
+    def partition_name(self, start, period=None):
+        return f"{self.base.name}_{period or self.period}_{start:%Y%m%d}"
+
+    def _partition_table(self, name):
+        """Tabella SQLAlchemy di una partizione SQLite: colonne e indice di sensor_data."""
+        table = self._metadata.tables.get(name)
+        if table is None:
+            table = Table(name, self._metadata, *(
+                Column(c.name, c.type, primary_key=c.primary_key, nullable=c.nullable) for c in self.base.columns
+            ))
+            Index(f"ix_{name}_user_sensor_ts", table.c.user_id, table.c.sensor_type,
+                  table.c.timestamp, table.c.value)
+        return table
+
+    # ---------- schema ----------
+    def create_parent(self, connection):
+        """Su PostgreSQL crea sensor_data come tabella partizionata, se non esiste ancora.
+
+        Va chiamata prima di create_all; una tabella sensor_data già esistente e non
+        partizionata resta com'è (la retention userà DELETE).
+        """
+        if not self.enabled or connection.dialect.name != "postgresql":
+            return
+        connection.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {self.base.name} (
+                id BIGSERIAL,
+                user_id INTEGER NOT NULL REFERENCES "user" (id),
+                sensor_type VARCHAR(50),
+                value DOUBLE PRECISION,
+                timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+                x DOUBLE PRECISION,
+                y DOUBLE PRECISION,
+                z DOUBLE PRECISION,
+                PRIMARY KEY (id, timestamp)
+            ) PARTITION BY RANGE (timestamp)
+        """))
+
+    def list_partitions(self, session):
+        """Partizioni esistenti, ordinate per inizio."""
+        dialect = session.get_bind().dialect.name
+        if dialect == "sqlite":
+            names = session.execute(text(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE :prefix ESCAPE '\\'"
+            ), {"prefix": f"{self.base.name}\\_%"}).scalars()
+        elif dialect == "postgresql":
+            names = session.execute(text(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+                "WHERE p.relname = :base"
+            ), {"base": self.base.name}).scalars()
+        else:
+            return []
+        partitions = []
+        for name in names:
+            match = _NAME_RE.match(name)
+            if match and match["base"] == self.base.name:
+                start = datetime.strptime(match["start"], "%Y%m%d")
+                partitions.append(Partition(name, match["period"], start))
+        return sorted(partitions, key=lambda p: p.start)
+
+    def ensure(self, session, start):
+        """Crea (se manca) la partizione del periodo che inizia a start; ne restituisce il nome."""
+        name = self.partition_name(start)
+        connection = session.connection()
+        if connection.dialect.name == "postgresql":
+            if session.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar() is None:
+                end = start + timedelta(days=PERIODS[self.period])
+                session.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {self.base.name} "
+                    f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+                ))
+        else:
+            table = self._partition_table(name)
+            connection.execute(CreateTable(table, if_not_exists=True))
+            for index in table.indexes:
+                connection.execute(CreateIndex(index, if_not_exists=True))
+        return name
+
+    # ---------- scritture ----------
+    def insert(self, session, rows):
+        """Inserimento bulk, una INSERT per partizione toccata dalle righe."""
+        if not rows:
+            return
+        if not self.enabled:
+            session.execute(self.base.insert(), rows)
+            return
+        groups = {}
+        for row in rows:
+            groups.setdefault(period_start(row["timestamp"], self.period), []).append(row)
+        for start, group in groups.items():
+            session.execute(self.write_table(session, start).insert(), group)
+
+    def write_table(self, session, start=None):
+        """Tabella in cui scrivere le righe del periodo che contiene start (creando la partizione).
+
+        Su PostgreSQL è sempre sensor_data: è il database a instradare le righe.
+        """
+        if not self.enabled:
+            return self.base
+        name = self.ensure(session, period_start(start, self.period))
+        return self.base if session.get_bind().dialect.name == "postgresql" else self._partition_table(name)
+
+    def split(self, timestamps):
+        """Divide un array ordinato di datetime64 nei tratti dello stesso periodo: [(inizio, da, a)]."""
+        if not self.enabled or not len(timestamps):
+            return [(None, 0, len(timestamps))]
+        days = timestamps.astype("datetime64[D]")
+        if self.period == "week":
+            monday = np.datetime64("1969-12-29", "D")  # un lunedì: le settimane partono da lì
+            days = (days - monday) // 7 * 7 + monday
+        cuts = np.flatnonzero(days[1:] != days[:-1]) + 1
+        bounds = [0] + cuts.tolist() + [len(timestamps)]
+        return [(days[i].astype("datetime64[us]").astype(datetime), i, j) for i, j in zip(bounds, bounds[1:])]
+
+    # ---------- letture ----------
+    def tables(self, session, since=None, until=None):
+        """Tabelle fisiche da leggere per la finestra [since, until).
+
+        Su SQLite si cercano le partizioni anche a partizionamento disattivato, così i
+        dati scritti quando era attivo restano visibili.
+        """
+        if session.get_bind().dialect.name != "sqlite":
+            return [self.base]
+        overlapping = [self._partition_table(p.name)
+                       for p in self.list_partitions(session) if p.overlaps(since, until)]
+        # sensor_data resta tra le sorgenti finché contiene righe scritte prima del partizionamento
+        if not overlapping or not self._base_is_empty(session):
+            return [self.base] + overlapping
+        return overlapping
+
+    def _base_is_empty(self, session):
+        """True se sensor_data è vuota; col partizionamento attivo non riceve più righe,
+        quindi una volta vuota resta tale e il controllo non si ripete."""
+        if not self._base_empty:
+            empty = session.execute(select(self.base.c.id).limit(1)).first() is None
+            self._base_empty = empty and self.enabled
+            return empty
+        return True
+
+    def source(self, session, since=None, until=None, columns=READ_COLUMNS):
+        """Selezionabile con le colonne indicate (default user_id, sensor_type, value, timestamp)
+        limitato alla finestra.
+
+        Con una sola tabella è la tabella stessa; altrimenti una UNION ALL delle
+        partizioni, ciascuna già filtrata sulla finestra (SQLite spinge nelle parti
+        anche i filtri esterni su utente e sensore, e usa l'indice di ognuna, che
+        copre le colonne di default).
+        """
+        tables = self.tables(session, since, until)
+        if len(tables) == 1:
+            return tables[0]
+        legs = []
+        for table in tables:
+            leg = select(*(table.c[name] for name in columns))
+            if since is not None:
+                leg = leg.where(table.c.timestamp >= since)
+            if until is not None:
+                leg = leg.where(table.c.timestamp < until)
+            legs.append(leg)
+        return union_all(*legs).subquery("sensor_data_window")
+
+    # ---------- retention ----------
+    def _series_counts(self, session, source, rollup_table, start, end):
+        """Letture per (utente, sensore) in [start, end): nei dati grezzi e nei rollup giornalieri."""
+        raw = dict(((u, s), n) for u, s, n in session.execute(
+            select(source.c.user_id, source.c.sensor_type, func.count(source.c.value))
+            .where(source.c.timestamp >= start, source.c.timestamp < end)
+            .group_by(source.c.user_id, source.c.sensor_type)
+        ))
+        rolled = dict(((u, s), n) for u, s, n in session.execute(
+            select(rollup_table.c.user_id, rollup_table.c.sensor_type, func.sum(rollup_table.c.count))
+            .where(rollup_table.c.resolution == "day",
+                   rollup_table.c.bucket >= start, rollup_table.c.bucket < end)
+            .group_by(rollup_table.c.user_id, rollup_table.c.sensor_type)
+        ))
+        return raw, rolled
+
+    def fold(self, session, rollup_table, start, end):
+        """Verifica che i rollup di [start, end) contengano tutte le letture grezze.
+
+        Se per qualche serie i rollup contano meno letture dei dati grezzi (es. dati
+        importati prima dei rollup) li ricostruisce da quelli. Restituisce True se ha
+        ricostruito.
+        """
+        source = self.source(session, start, end)
+        raw, rolled = self._series_counts(session, source, rollup_table, start, end)
+        missing = [key for key, count in raw.items() if rolled.get(key, 0) < count]
+        # Solo le serie incomplete: le altre (es. quelle salvate a blocchi) non hanno righe qui
+        for user_id, sensor_type in missing:
+            rollups.backfill(session, source, rollup_table, start, end, user_id, sensor_type)
+        return bool(missing)
+
+    def retention_plan(self, session, cutoff):
+        """Intervalli di dati grezzi da eliminare, come (descrizione, start, end, azione)."""
+        cutoff = period_start(cutoff, "day")
+        plan = []
+        dropped_until = None
+        for partition in self.list_partitions(session):
+            if partition.end <= cutoff:
+                plan.append((partition.name, partition.start, partition.end, ("drop", partition.name)))
+                dropped_until = partition.end
+        oldest = select(func.min(self.base.c.timestamp))
+        if dropped_until is not None and session.get_bind().dialect.name == "postgresql":
+            # Su PostgreSQL sensor_data comprende le partizioni: restano solo le righe dopo quelle eliminate
+            oldest = oldest.where(self.base.c.timestamp >= dropped_until)
+        oldest = session.execute(oldest).scalar()
+        if oldest is not None and oldest < cutoff:
+            plan.append((f"{self.base.name} < {cutoff:%Y-%m-%d}", period_start(oldest, "day"), cutoff,
+                         ("delete", None)))
+        return plan
+
+    def apply_retention(self, session, rollup_table, cutoff, dry_run=False, before_delete=None):
+        """Elimina i dati grezzi prima di cutoff (allineato al giorno), un intervallo per transazione.
+
+        before_delete(table, start, end), se indicata, riceve la tabella con i dati
+        dell'intervallo prima dell'eliminazione (es. per archiviarli); se solleva un'eccezione
+        l'intervallo non viene eliminato. Restituisce [(descrizione, righe, rollup
+        ricostruiti)]; con dry_run non modifica nulla.
+        """
+        report = []
+        for description, start, end, (action, name) in self.retention_plan(session, cutoff):
+            if action == "drop":
+                rows = session.execute(text(f"SELECT count(*) FROM {name}")).scalar()
+            else:
+                rows = session.execute(select(func.count()).select_from(self.base)
+                                       .where(self.base.c.timestamp >= start, self.base.c.timestamp < end)).scalar()
+            if dry_run:
+                report.append((description, rows, None))
+                continue
+            rebuilt = self.fold(session, rollup_table, start, end)
+            if before_delete is not None:
+                # La partizione SQLite da eliminare, altrimenti sensor_data (su PostgreSQL comprende le partizioni)
+                sqlite_drop = action == "drop" and session.get_bind().dialect.name == "sqlite"
+                before_delete(self._partition_table(name) if sqlite_drop else self.base, start, end)
+            if action == "drop":
+                session.execute(text(f"DROP TABLE IF EXISTS {name}"))
+            else:
+                session.execute(delete(self.base).where(self.base.c.timestamp >= start,
+                                                        self.base.c.timestamp < end))
+            # Rollup e cancellazione nella stessa transazione: o entrambi o nessuno
+            session.commit()
+            report.append((description, rows, rebuilt))
+        return report
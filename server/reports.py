@@ -0,0 +1,236 @@
+"""Riepiloghi giornalieri per paziente e sensore, calcolati dai rollup e salvati.
+
+Per ogni (user_id, sensor_type, giorno) la tabella dei riepiloghi contiene
+conteggio, media, deviazione standard, minimo e massimo (esatti, dai rollup al
+minuto), percentili e tempo nel range normale (calcolati sulle medie al minuto,
+pesate per numero di letture) e le anomalie del giorno. I percentili e il tempo
+nel range sono quindi quelli del segnale mediato su un minuto, non dei singoli
+campioni: per HR, EDA e temperatura la differenza è trascurabile.
+
+refresh() è incrementale: confronta il conteggio del rollup giornaliero e il
+numero di anomalie di ogni serie con quelli salvati nel riepilogo e ricalcola
+solo i giorni cambiati (nuove letture, import, rescore). Se i rollup al minuto
+di un giorno sono già stati eliminati da `flask maintain` si usano quelli orari.
+
+Il report si costruisce leggendo solo i riepiloghi di un giorno (load_report)
+e si passa ai template Jinja; report_data() lo riporta al formato di
+calculate_stats usato da EmailNotifier.send_daily_report.
+"""
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+
+import numpy as np
+from sqlalchemy import select, delete, func, case, tuple_
+
+from rollups import RESOLUTIONS, bucket_expr, truncate
+
+PERCENTILES = (5, 25, 50, 75, 95)
+# Fino a tante serie stale in un giorno si leggono una per una, oltre con una scansione del giorno
+SERIES_QUERY_LIMIT = 200
+# Righe lette per volta nella scansione di un giorno
+FETCH_ROWS = 50000
+# Serie per DELETE dei riepiloghi da ricalcolare (limite ai parametri delle query)
+DELETE_CHUNK = 500
+
+
+def _as_day(value):
+    """Giorno restituito da bucket_expr (stringa in SQLite, datetime in PostgreSQL)."""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return truncate(value, "day")
+
+
+def summarize(counts, sums, sums_sq, mins, maxs, bucket_seconds=60, low=None, high=None):
+    """Riepilogo di un giorno dai bucket di una serie (array NumPy, uno per bucket)."""
+    count = int(counts.sum())
+    mean = float(sums.sum() / count)
+    variance = max(float(sums_sq.sum() / count) - mean * mean, 0.0)
+    summary = {"count": count, "mean": mean, "std": variance ** 0.5,
+               "min": float(mins.min()), "max": float(maxs.max())}
+
+    # Percentili delle medie per bucket, pesati con le letture di ciascun bucket
+    means = sums / counts
+    order = np.argsort(means, kind="stable")
+    cumulative = np.cumsum(counts[order])
+    positions = np.searchsorted(cumulative, np.array(PERCENTILES) / 100 * count)
+    for p, value in zip(PERCENTILES, means[order][np.minimum(positions, len(means) - 1)]):
+        summary[f"p{p:02d}"] = float(value)
+
+    minutes = bucket_seconds / 60
+    summary["minutes"] = int(len(counts) * minutes)
+    if low is not None and high is not None:
+        below, above = means < low, means > high
+        summary["minutes_below"] = int(below.sum() * minutes)
+        summary["minutes_above"] = int(above.sum() * minutes)
+        summary["minutes_in_range"] = summary["minutes"] - summary["minutes_below"] - summary["minutes_above"]
+    else:
+        summary["minutes_below"] = summary["minutes_above"] = summary["minutes_in_range"] = None
+    return summary
+
+
+def stale_days(session, rollup_table, anomaly_table, summary_table, since=None, until=None):
+    """{giorno: {(user_id, sensor_type): (letture, anomalie, anomalie high)}} dei riepiloghi da ricalcolare.
+
+    Ci sono i giorni con letture il cui conteggio o numero di anomalie differisce da
+    quello salvato, e con (0, 0, 0) i riepiloghi di giorni che non hanno più letture.
+    """
+    r, a, s = rollup_table, anomaly_table, summary_table
+    dialect = session.get_bind().dialect.name
+
+    query = select(r.c.user_id, r.c.sensor_type, r.c.bucket, r.c.count).where(r.c.resolution == "day")
+    if since is not None:
+        query = query.where(r.c.bucket >= since)
+    if until is not None:
+        query = query.where(r.c.bucket < until)
+    current = {(u, st, day): [n, 0, 0] for u, st, day, n in session.execute(query)}
+
+    day = bucket_expr(dialect, a.c.timestamp, "day")
+    query = select(a.c.user_id, a.c.sensor_type, day, func.count(),
+                   func.sum(case((a.c.severity == "high", 1), else_=0)))
+    if since is not None:
+        query = query.where(a.c.timestamp >= since)
+    if until is not None:
+        query = query.where(a.c.timestamp < until)
+    for u, st, d, n, high in session.execute(query.group_by(a.c.user_id, a.c.sensor_type, day)):
+        entry = current.get((u, st, _as_day(d)))
+        if entry is not None:
+            entry[1], entry[2] = n, int(high or 0)
+
+    query = select(s.c.user_id, s.c.sensor_type, s.c.day, s.c.count, s.c.anomalies, s.c.anomalies_high)
+    if since is not None:
+        query = query.where(s.c.day >= since)
+    if until is not None:
+        query = query.where(s.c.day < until)
+    stored = {(u, st, d): (n, an, high) for u, st, d, n, an, high in session.execute(query)}
+
+    stale = {}
+    for key, entry in current.items():
+        if stored.get(key) != tuple(entry):
+            stale.setdefault(key[2], {})[key[:2]] = tuple(entry)
+    for key in stored.keys() - current.keys():
+        stale.setdefault(key[2], {})[key[:2]] = (0, 0, 0)
+    return stale
+
+
+def _bucket_columns(session, rollup_table, resolution, day, series):
+    """Bucket del giorno delle serie indicate come array (utenti, codici sensore, dati 5 x n, sensori).
+
+    Con poche serie una lettura per serie sulla chiave primaria, altrimenti un'unica
+    scansione del giorno sull'indice (resolution, bucket), letta a blocchi di
+    FETCH_ROWS righe; None se non ci sono bucket.
+    """
+    r = rollup_table
+    columns = (r.c.user_id, r.c.sensor_type, r.c.count, r.c.sum, r.c.sum_sq, r.c.min, r.c.max)
+    in_day = (r.c.resolution == resolution, r.c.bucket >= day, r.c.bucket < day + timedelta(days=1))
+    if len(series) <= SERIES_QUERY_LIMIT:
+        results = (session.execute(select(*columns).where(r.c.user_id == user_id, r.c.sensor_type == sensor_type,
+                                                          *in_day))
+                   for user_id, sensor_type in sorted(series))
+    else:
+        results = [session.execute(select(*columns).where(*in_day).execution_options(yield_per=FETCH_ROWS))]
+    codes = {}
+    users, sensors, data = [], [], []
+    for result in results:
+        for batch in result.partitions(FETCH_ROWS):
+            batch_columns = list(zip(*batch))
+            users.append(np.array(batch_columns[0], dtype=np.int64))
+            sensors.append(np.fromiter((codes.setdefault(st, len(codes)) for st in batch_columns[1]),
+                                       np.int64, len(batch)))
+            data.append(np.array(batch_columns[2:], dtype=np.float64))
+    if not users:
+        return None
+    return np.concatenate(users), np.concatenate(sensors), np.concatenate(data, axis=1), list(codes)
+
+
+def _group_summaries(columns, wanted, resolution, ranges):
+    """Riepiloghi delle serie in wanted dai bucket di un giorno (in qualunque ordine)."""
+    summaries = {}
+    if columns is None:
+        return summaries
+    users, sensors, data, sensor_types = columns
+    order = np.lexsort((sensors, users))
+    users, sensors, data = users[order], sensors[order], data[:, order]
+    bounds = np.flatnonzero(np.r_[True, (users[1:] != users[:-1]) | (sensors[1:] != sensors[:-1]), True])
+    for i, j in zip(bounds[:-1], bounds[1:]):
+        key = (int(users[i]), sensor_types[sensors[i]])
+        if key not in wanted:
+            continue
+        low, high = ranges.get(key[1], (None, None))
+        counts, sums, sums_sq, mins, maxs = data[:, i:j]
+        summaries[key] = summarize(counts, sums, sums_sq, mins, maxs, RESOLUTIONS[resolution], low, high)
+        summaries[key]["resolution"] = resolution
+    return summaries
+
+
+def refresh(session, rollup_table, anomaly_table, summary_table, since=None, until=None, ranges=None):
+    """Ricalcola i riepiloghi cambiati nei giorni [since, until); restituisce quelli scritti.
+
+    ranges: {sensor_type: (min, max)} per il tempo nel range (sensori assenti: nessun range).
+    """
+    ranges = ranges or {}
+    since = truncate(since, "day") if since is not None else None
+    until = truncate(until, "day") if until is not None else None
+    stale = stale_days(session, rollup_table, anomaly_table, summary_table, since, until)
+    s = summary_table
+    written = 0
+    now = datetime.utcnow()
+    for day, series in sorted(stale.items()):
+        keys = sorted(series)
+        for k in range(0, len(keys), DELETE_CHUNK):
+            session.execute(delete(s).where(
+                s.c.day == day, tuple_(s.c.user_id, s.c.sensor_type).in_(keys[k:k + DELETE_CHUNK])))
+        wanted = {key for key, entry in series.items() if entry[0]}
+        summaries = _group_summaries(_bucket_columns(session, rollup_table, "minute", day, wanted),
+                                     wanted, "minute", ranges)
+        missing = wanted - summaries.keys()
+        if missing:
+            # Rollup al minuto già eliminati dalla manutenzione: si usano quelli orari
+            summaries.update(_group_summaries(_bucket_columns(session, rollup_table, "hour", day, missing),
+                                              missing, "hour", ranges))
+        rows = [{"user_id": user_id, "sensor_type": sensor_type, "day": day, **summary,
+                 "anomalies": series[(user_id, sensor_type)][1],
+                 "anomalies_high": series[(user_id, sensor_type)][2], "updated_at": now}
+                for (user_id, sensor_type), summary in summaries.items()]
+        if rows:
+            session.execute(s.insert(), rows)
+        written += len(rows)
+    return written
+
+
+# ================== REPORT ==================
+def load_report(session, summary_table, usernames, day):
+    """Riepiloghi del giorno per paziente: [(username, [riepilogo per sensore])], in ordine di nome.
+
+    Ogni riepilogo ha anche mean_change, la variazione della media dal giorno prima
+    (None se quel giorno non c'è).
+    """
+    s = summary_table
+    rows = session.execute(select(s).where(s.c.day.in_([day - timedelta(days=1), day]))
+                           .order_by(s.c.user_id, s.c.sensor_type)).mappings().all()
+    previous = {(row["user_id"], row["sensor_type"]): row["mean"] for row in rows if row["day"] != day}
+    patients = {}
+    for row in rows:
+        if row["day"] != day or row["user_id"] not in usernames:
+            continue
+        summary = dict(row)
+        before = previous.get((row["user_id"], row["sensor_type"]))
+        summary["mean_change"] = row["mean"] - before if before is not None else None
+        patients.setdefault(usernames[row["user_id"]], []).append(summary)
+    return sorted(patients.items())
+
+
+def report_data(patients):
+    """Report nel formato di calculate_stats ({utente: {sensore: {mean, min, max, count, ...}}})."""
+    return {username: {summary["sensor_type"]: summary for summary in sensors}
+            for username, sensors in patients}
+
+
+def build_message(sender, recipients, subject, text_body, html_body):
+    message = EmailMessage()
+    message["From"] = sender
+    message["To"] = ", ".join(recipients)
+    message["Subject"] = subject
+    message["Date"] = datetime.now().astimezone()
+    message.set_content(text_body)
+    message.add_alternative(html_body, subtype="html")
+    return message
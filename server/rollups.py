@@ -0,0 +1,206 @@
+"""Aggregati pre-calcolati (rollup) delle letture a 1 minuto, 1 ora e 1 giorno.
+
+Per ogni (user_id, sensor_type, resolution, bucket) si mantengono count, sum,
+sum_sq, min e max: bastano per media, deviazione standard, minimo e massimo di
+qualunque unione di bucket. Le funzioni lavorano sulla tabella passata come
+argomento e supportano SQLite e PostgreSQL (upsert ON CONFLICT).
+"""
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import func, literal, select, delete
+from sqlalchemy.dialects import postgresql, sqlite
+
+RESOLUTIONS = {"minute": 60, "hour": 3600, "day": 86400}
+
+# Un rollup viene usato solo se la finestra contiene almeno questi bucket:
+# l'errore ai bordi (al più un bucket) resta sotto ~4% della finestra
+ROLLUP_MIN_BUCKETS = 24
+
+# Formati usati da SQLite per troncare i timestamp; coincidono con il modo in cui
+# SQLAlchemy salva i DateTime, così bucket scritti in Python e in SQL si confrontano
+_SQLITE_FORMATS = {
+    "minute": "%Y-%m-%d %H:%M:00.000000",
+    "hour": "%Y-%m-%d %H:00:00.000000",
+    "day": "%Y-%m-%d 00:00:00.000000",
+}
+
+
+def truncate(ts, resolution):
+    """Inizio del bucket che contiene ts."""
+    if resolution == "minute":
+        return ts.replace(second=0, microsecond=0)
+    if resolution == "hour":
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def choose_resolution(range_seconds, min_buckets=ROLLUP_MIN_BUCKETS, max_width=None):
+    """Rollup più grossolano che lascia almeno min_buckets bucket nella finestra.
+
+    max_width limita l'ampiezza del bucket (es. quella richiesta dal grafico).
+    Restituisce None se la finestra è troppo corta: in quel caso si leggono i dati grezzi.
+    """
+    for resolution, width in sorted(RESOLUTIONS.items(), key=lambda r: -r[1]):
+        if max_width is not None and width > max_width:
+            continue
+        if range_seconds / width >= min_buckets:
+            return resolution
+    return None
+
+
+def aggregate(rows):
+    """Aggrega le letture {user_id, sensor_type, value, timestamp} per bucket di ogni risoluzione."""
+    buckets = {}
+    for row in rows:
+        value = row["value"]
+        for resolution in RESOLUTIONS:
+            key = (row["user_id"], row["sensor_type"], resolution, truncate(row["timestamp"], resolution))
+            agg = buckets.get(key)
+            if agg is None:
+                buckets[key] = [1, value, value * value, value, value]
+            else:
+                agg[0] += 1
+                agg[1] += value
+                agg[2] += value * value
+                if value < agg[3]:
+                    agg[3] = value
+                if value > agg[4]:
+                    agg[4] = value
+    return buckets
+
+
+def aggregate_series(user_id, sensor_type, timestamps, values):
+    """Come aggregate(), per una serie ordinata in array NumPy (timestamps datetime64, values float)."""
+    buckets = {}
+    if not len(values):
+        return buckets
+    minutes = timestamps.astype("datetime64[m]")
+    starts = np.flatnonzero(np.r_[True, minutes[1:] != minutes[:-1]])
+    stats = [np.diff(np.r_[starts, len(values)]), np.add.reduceat(values, starts),
+             np.add.reduceat(values * values, starts), np.minimum.reduceat(values, starts),
+             np.maximum.reduceat(values, starts)]
+    keys = minutes[starts]
+    for resolution, unit in (("minute", "m"), ("hour", "h"), ("day", "D")):
+        if resolution != "minute":
+            # Ore e giorni dai minuti, come in backfill
+            coarse = keys.astype(f"datetime64[{unit}]")
+            starts = np.flatnonzero(np.r_[True, coarse[1:] != coarse[:-1]])
+            keys = coarse[starts]
+            stats = [np.add.reduceat(stats[0], starts), np.add.reduceat(stats[1], starts),
+                     np.add.reduceat(stats[2], starts), np.minimum.reduceat(stats[3], starts),
+                     np.maximum.reduceat(stats[4], starts)]
+        for key, *agg in zip(keys.astype("datetime64[us]").astype(datetime).tolist(), *(s.tolist() for s in stats)):
+            buckets[(user_id, sensor_type, resolution, key)] = agg
+    return buckets
+
+
+def upsert(session, table, buckets):
+    """Somma gli aggregati ai bucket esistenti (INSERT ... ON CONFLICT DO UPDATE)."""
+    if not buckets:
+        return
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        stmt = postgresql.insert(table)
+        lowest, highest = func.least, func.greatest
+    elif dialect == "sqlite":
+        stmt = sqlite.insert(table)
+        # In SQLite min/max con due argomenti sono funzioni scalari
+        lowest, highest = func.min, func.max
+    else:
+        raise NotImplementedError(f"Rollup upsert not supported on '{dialect}'")
+
+    excluded = stmt.excluded
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["user_id", "sensor_type", "resolution", "bucket"],
+        set_={
+            "count": table.c.count + excluded.count,
+            "sum": table.c.sum + excluded.sum,
+            "sum_sq": table.c.sum_sq + excluded.sum_sq,
+            "min": lowest(table.c.min, excluded.min),
+            "max": highest(table.c.max, excluded.max),
+        }
+    )
+    # Sempre nello stesso ordine di chiave: due transazioni concorrenti bloccano le
+    # righe nella stessa sequenza e non possono attendersi a vicenda (deadlock)
+    session.execute(stmt, [
+        {"user_id": user_id, "sensor_type": sensor_type, "resolution": resolution, "bucket": bucket,
+         "count": agg[0], "sum": agg[1], "sum_sq": agg[2], "min": agg[3], "max": agg[4]}
+        for (user_id, sensor_type, resolution, bucket), agg in sorted(buckets.items())
+    ])
+
+
+def _scoped(query, table, time_column, since=None, until=None, user_id=None, sensor_type=None):
+    if since is not None:
+        query = query.where(time_column >= since)
+    if until is not None:
+        query = query.where(time_column < until)
+    if user_id is not None:
+        query = query.where(table.c.user_id == user_id)
+    if sensor_type is not None:
+        query = query.where(table.c.sensor_type == sensor_type)
+    return query
+
+
+def clear(session, rollup_table, since=None, until=None, user_id=None, sensor_type=None):
+    """Elimina i rollup dei giorni [since, until) (allineati al giorno), di un utente o di una serie."""
+    since = truncate(since, "day") if since is not None else None
+    until = truncate(until, "day") if until is not None else None
+    session.execute(_scoped(delete(rollup_table), rollup_table, rollup_table.c.bucket,
+                            since, until, user_id, sensor_type))
+
+
+def bucket_expr(dialect, column, resolution):
+    """Espressione SQL che tronca column all'inizio del bucket."""
+    if dialect == "postgresql":
+        return func.date_trunc(resolution, column)
+    if dialect == "sqlite":
+        return func.strftime(_SQLITE_FORMATS[resolution], column)
+    raise NotImplementedError(f"Rollup backfill not supported on '{dialect}'")
+
+
+def backfill(session, raw_table, rollup_table, since=None, until=None, user_id=None, sensor_type=None):
+    """Ricostruisce i rollup dai dati grezzi (tutti, oppure dal giorno di `since` a quello di `until`).
+
+    I minuti vengono calcolati da raw_table (tabella o selezionabile con le stesse
+    colonne) con una INSERT ... SELECT raggruppata, le ore dai minuti e i giorni
+    dalle ore. user_id e sensor_type limitano la ricostruzione a un utente o a una
+    serie. Restituisce i bucket scritti per risoluzione.
+    """
+    dialect = session.get_bind().dialect.name
+    if since is not None:
+        since = truncate(since, "day")
+    if until is not None:
+        until = truncate(until, "day")
+
+    def scoped(query, table, time_column):
+        return _scoped(query, table, time_column, since, until, user_id, sensor_type)
+
+    clear(session, rollup_table, since, until, user_id, sensor_type)
+
+    columns = ["user_id", "sensor_type", "resolution", "bucket", "count", "sum", "sum_sq", "min", "max"]
+    written = {}
+
+    bucket = bucket_expr(dialect, raw_table.c.timestamp, "minute")
+    query = select(
+        raw_table.c.user_id, raw_table.c.sensor_type, literal("minute"), bucket,
+        func.count(raw_table.c.value), func.sum(raw_table.c.value),
+        func.sum(raw_table.c.value * raw_table.c.value),
+        func.min(raw_table.c.value), func.max(raw_table.c.value)
+    ).where(raw_table.c.value.isnot(None))
+    query = scoped(query, raw_table, raw_table.c.timestamp)
+    query = query.group_by(raw_table.c.user_id, raw_table.c.sensor_type, bucket)
+    written["minute"] = session.execute(rollup_table.insert().from_select(columns, query)).rowcount
+
+    for finer, coarser in (("minute", "hour"), ("hour", "day")):
+        bucket = bucket_expr(dialect, rollup_table.c.bucket, coarser)
+        query = select(
+            rollup_table.c.user_id, rollup_table.c.sensor_type, literal(coarser), bucket,
+            func.sum(rollup_table.c.count), func.sum(rollup_table.c.sum), func.sum(rollup_table.c.sum_sq),
+            func.min(rollup_table.c.min), func.max(rollup_table.c.max)
+        ).where(rollup_table.c.resolution == finer)
+        query = scoped(query, rollup_table, rollup_table.c.bucket)
+        query = query.group_by(rollup_table.c.user_id, rollup_table.c.sensor_type, bucket)
+        written[coarser] = session.execute(rollup_table.insert().from_select(columns, query)).rowcount
+
+    return written
@@ -0,0 +1,257 @@
+"""Ingestione su processi worker partizionati per utente (shard).
+
+Con INGEST_SHARDS le route non scrivono: dividono le letture per shard
+(user_id % numero di shard, fisso finché non cambia la lista) e le passano al
+processo che possiede quegli utenti. Ogni shard ha la propria coda write-behind
+(group commit), il proprio AnomalyDetector e il proprio ActivityCounter: tutte le
+letture di un paziente passano dallo stesso processo, quindi le finestre di
+rilevamento e le epoche di attività restano coerenti qualunque worker gunicorn
+abbia ricevuto la richiesta.
+
+Il canale è multiprocessing.connection (socket TCP locale o Unix, messaggi
+serializzati con pickle, autenticati con authkey):
+
+    ("rows", letture)  -> True se accettate, False se la coda dello shard è piena
+    ("stats",)         -> metriche della coda dello shard
+    ("watch",)         -> la connessione diventa un flusso di eventi live
+                          (user_id, messaggio SSE), per le dashboard servite
+                          dai processi front-end
+
+Cache delle dashboard e broker live restano per processo (vedi live.py): gli
+eventi live arrivano ai front-end tramite "watch", le cache scadono per TTL.
+"""
+import os
+import time
+import queue
+import logging
+import threading
+from multiprocessing.connection import Client, Listener
+
+logger = logging.getLogger(__name__)
+
+# L'authkey è l'unica protezione del canale, che deserializza con pickle: niente
+# chiavi corte né i valori di esempio di app.py e docker-compose.yml
+MIN_AUTHKEY_LENGTH = 16
+EXAMPLE_AUTHKEYS = {b"supersecretkey", b"your-secret-key-here", b"secure_password_here"}
+# Attesa massima di una risposta dello shard prima di considerarlo irraggiungibile
+REPLY_TIMEOUT = 5
+# Eventi live in attesa per connessione "watch": oltre si scartano i più vecchi
+WATCH_QUEUE_SIZE = 1024
+# Secondi tra due heartbeat su una connessione "watch" (servono a notare le chiusure)
+WATCH_HEARTBEAT_SECONDS = 15
+# Attesa prima di riaprire una connessione "watch" caduta
+WATCH_RETRY_SECONDS = 1
+
+
+def parse_address(address):
+    """"host:porta" -> (host, porta); un percorso resta il nome di un socket Unix."""
+    if address.startswith("/"):
+        return address
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def check_authkey(authkey):
+    """ValueError se l'authkey manca, è corta o è un valore di esempio."""
+    if not authkey or len(authkey) < MIN_AUTHKEY_LENGTH or authkey in EXAMPLE_AUTHKEYS:
+        raise ValueError(f"INGEST_SHARD_AUTHKEY must be set to a secret of at least {MIN_AUTHKEY_LENGTH} "
+                         "characters (not an example value)")
+
+
+def shard_of(user_id, shards):
+    return user_id % shards
+
+
+class ShardUnavailable(Exception):
+    """Lo shard non risponde (processo fermo, rete, timeout)."""
+
+
+class ShardClient:
+    """Lato front-end: instrada le letture agli shard, con connessioni riusate tra le richieste."""
+
+    def __init__(self, addresses, authkey, timeout=REPLY_TIMEOUT):
+        check_authkey(authkey)
+        self.addresses = [parse_address(a) for a in addresses]
+        self.authkey = authkey
+        self.timeout = timeout
+        # Connessioni libere per shard: ogni richiesta ne prende una, i thread non le condividono
+        self._idle = [queue.LifoQueue() for _ in self.addresses]
+        self._watchers = []
+
+    def _connect(self, shard):
+        try:
+            return Client(self.addresses[shard], authkey=self.authkey)
+        except (OSError, EOFError) as e:
+            raise ShardUnavailable(f"shard {shard}: {e}") from e
+
+    def _call(self, shard, message):
+        try:
+            conn, fresh = self._idle[shard].get_nowait(), False
+        except queue.Empty:
+            conn, fresh = self._connect(shard), True
+        try:
+            try:
+                conn.send(message)
+            except (OSError, EOFError):
+                if fresh:
+                    raise
+                # Connessione inattiva chiusa dallo shard (es. riavviato): se ne apre una nuova
+                conn.close()
+                conn = self._connect(shard)
+                conn.send(message)
+            if not conn.poll(self.timeout):
+                raise ShardUnavailable(f"shard {shard}: nessuna risposta in {self.timeout}s")
+            reply = conn.recv()
+        except (OSError, EOFError) as e:
+            conn.close()
+            raise ShardUnavailable(f"shard {shard}: {e}") from e
+        except ShardUnavailable:
+            conn.close()
+            raise
+        self._idle[shard].put(conn)
+        return reply
+
+    def shard_of(self, user_id):
+        return shard_of(user_id, len(self.addresses))
+
+    def submit(self, rows):
+        """Invia a ogni shard le sue letture; False se almeno uno shard le rifiuta.
+
+        Le letture già accettate dagli altri shard restano accettate: un nuovo invio
+        dopo il rifiuto può quindi duplicarle, come con due richieste distinte.
+        Solleva ShardUnavailable se uno shard non risponde.
+        """
+        parts = {}
+        for row in rows:
+            parts.setdefault(self.shard_of(row["user_id"]), []).append(row)
+        accepted = True
+        for shard, part in sorted(parts.items()):
+            accepted = self._call(shard, ("rows", part)) and accepted
+        return accepted
+
+    def stats(self):
+        """Metriche della coda di ogni shard (None per quelli irraggiungibili)."""
+        result = []
+        for shard in range(len(self.addresses)):
+            try:
+                result.append(self._call(shard, ("stats",)))
+            except ShardUnavailable:
+                result.append(None)
+        return result
+
+    def watch(self, deliver):
+        """Avvia un thread per shard che passa a deliver(user_id, messaggio) gli eventi live."""
+        for shard in range(len(self.addresses)):
+            thread = threading.Thread(target=self._watch, args=(shard, deliver),
+                                      name=f"ingest-shard-watch-{shard}", daemon=True)
+            thread.start()
+            self._watchers.append(thread)
+
+    def _watch(self, shard, deliver):
+        while True:
+            try:
+                conn = self._connect(shard)
+                try:
+                    conn.send(("watch",))
+                    while True:
+                        event = conn.recv()
+                        if event is not None:
+                            deliver(*event)
+                finally:
+                    conn.close()
+            except (ShardUnavailable, OSError, EOFError):
+                time.sleep(WATCH_RETRY_SECONDS)
+
+
+class ShardServer:
+    """Lato shard: riceve le letture e le passa a submit(rows); una connessione per thread."""
+
+    def __init__(self, address, authkey, submit, stats):
+        check_authkey(authkey)
+        self.address = parse_address(address) if isinstance(address, str) else address
+        self.authkey = authkey
+        self.submit = submit
+        self.stats = stats
+        self._listener = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._watchers = []
+        self.dropped_events = 0
+
+    def serve_forever(self):
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            # Socket Unix rimasto da un processo precedente
+            os.unlink(self.address)
+        self._listener = Listener(self.address, authkey=self.authkey)
+        while True:
+            try:
+                conn = self._listener.accept()
+            except Exception:
+                if self._closed:
+                    return
+                # Client non autenticato o handshake interrotto
+                logger.warning("Connessione allo shard rifiutata", exc_info=True)
+                continue
+            threading.Thread(target=self._handle, args=(conn,), name="ingest-shard-conn", daemon=True).start()
+
+    def close(self):
+        self._closed = True
+        if self._listener is not None:
+            self._listener.close()
+
+    def _handle(self, conn):
+        try:
+            while True:
+                message = conn.recv()
+                kind = message[0]
+                if kind == "rows":
+                    conn.send(self.submit(message[1]))
+                elif kind == "stats":
+                    conn.send(self.stats())
+                elif kind == "watch":
+                    self._watch(conn)
+                    return
+                else:
+                    raise ValueError(f"Unknown shard message '{kind}'")
+        except (EOFError, OSError):
+            pass
+        except Exception:
+            logger.exception("Errore nella connessione allo shard")
+        finally:
+            conn.close()
+
+    # ---------- eventi live ----------
+    def watched(self):
+        """Utenti seguiti dai front-end collegati: tutti (None) se c'è almeno una connessione "watch"."""
+        with self._lock:
+            return {None} if self._watchers else set()
+
+    def publish(self, user_id, message):
+        """Evento live verso i front-end collegati; i più vecchi si perdono se non leggono."""
+        with self._lock:
+            watchers = list(self._watchers)
+        for events in watchers:
+            while True:
+                try:
+                    events.put_nowait((user_id, message))
+                    break
+                except queue.Full:
+                    try:
+                        events.get_nowait()
+                        self.dropped_events += 1
+                    except queue.Empty:
+                        pass
+
+    def _watch(self, conn):
+        events = queue.Queue(maxsize=WATCH_QUEUE_SIZE)
+        with self._lock:
+            self._watchers.append(events)
+        try:
+            while True:
+                try:
+                    conn.send(events.get(timeout=WATCH_HEARTBEAT_SECONDS))
+                except queue.Empty:
+                    conn.send(None)
+        finally:
+            with self._lock:
+                self._watchers.remove(events)